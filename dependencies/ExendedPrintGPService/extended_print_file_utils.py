@@ -1,14 +1,66 @@
 # helper functions to work with the Auckland Council 10.2 print service for Portal
 # David Aalbers, Geographic Information Systems, 18/7/14
 #
-from os import path, listdir
+from os import path, listdir, stat, remove, rename, getpid
 from os.path import join
-from arcpy import mapping
+import shutil
+import time
+import hashlib
+import json
+
+# scandir returns file types without an extra stat per entry, which is much faster on network shares
+# it is built in from Python 3.5, otherwise use the scandir package if it has been installed
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 LAYOUT_DIR_NAME = ""
 REPLACE_DIR_NAME = ""
 LEGEND_DIR_NAME = ""
 
+# seconds between checking template directory modified times for changes
+CATALOGUE_CHECK_SECONDS = 30
+
+# template catalogues by templates root path, kept between requests in the server process
+_templateCatalogues = {}
+# the catalogue last written to each template catalogue file, see writeTemplateCatalogueFile
+_writtenCatalogues = {}
+
+# prints in the output cache are named with this prefix and the hash of the print request
+OUTPUT_CACHE_PREFIX = "_ags_oc_"
+# legend pages kept for reuse by later prints are named with this prefix and the hash of the legend content
+LEGEND_PAGE_CACHE_PREFIX = "_ags_lc_"
+
+# temporary files and folders written to the output directory start with this prefix
+TEMP_ARTIFACT_PREFIX = "_ags_"
+
+# outputs younger than this are never removed by sweepOutputDirectory, they may not have been downloaded yet
+SWEEP_MIN_AGE_SECONDS = 600
+
+# temporary files and geodatabases created during the current request
+_tempArtifacts = []
+# temporary files and geodatabases kept between requests, e.g. the gdbs of converted webmaps, not swept
+_retainedArtifacts = set()
+# time the output directory was last swept by this process
+_lastSweepTime = 0
+
+# webmap operational layer properties that change between identical prints, e.g. ids generated by the client
+VOLATILE_WEBMAP_LAYER_KEYS = ["id"]
+
+# number of map documents opened from and saved to disk during the current request
+mapDocIoCounts = {"opens": 0, "saves": 0}
+
+# symbology class counts older than this are counted again, e.g. in case the map service has been republished
+CLASS_COUNT_MAX_AGE_SECONDS = 86400
+
+# symbology class counts by layer key, read from and saved to a JSON file shared by all server processes
+# "counts" is {layer key: {"count": class count, "time": when counted}}, "changed" holds counts not yet saved
+_classCountCache = {"path": None, "modified": None, "counts": {}, "changed": {}}
+
 
 def getFileNameList(dirPath, fileTypeList , includeDirs = False):
     # get file names
@@ -41,35 +93,427 @@ def getFileList(dirPath, fileTypeList):
 
 
 
+def _scanDir(dirPath):
+    # returns lists of (name, path, modified time) for sub directories and (name, path) for files
+    dirs = []
+    files = []
+    if scandir:
+        for entry in scandir(dirPath):
+            if entry.is_dir():
+                dirs.append((entry.name, entry.path, entry.stat().st_mtime))
+            elif entry.is_file():
+                files.append((entry.name, entry.path))
+    else:
+        for file in listdir(dirPath):
+            filePath = join(dirPath, file)
+            if path.isdir(filePath):
+                dirs.append((file, filePath, path.getmtime(filePath)))
+            elif path.isfile(filePath):
+                files.append((file, filePath))
+    return dirs, files
+
+
+def _buildTemplateCatalogue(templatesPath):
+    # walks the template root once, indexing the layout, replace and legend files of every template
+    catalogue = {"templateNames": [], "templates": {}, "mtimes": {}, "checked": time.time()}
+    if not path.isdir(templatesPath):
+        return catalogue
+
+    catalogue["mtimes"][templatesPath] = path.getmtime(templatesPath)
+    templateDirs, rootFiles = _scanDir(templatesPath)
+    indexDirNames = [a.lower() for a in [LAYOUT_DIR_NAME, REPLACE_DIR_NAME, LEGEND_DIR_NAME] if a]
+
+    for templateName, templatePath, templateMtime in templateDirs:
+        catalogue["mtimes"][templatePath] = templateMtime
+        template = {"name": templateName, "path": templatePath, "dirs": {}}
+
+        subDirs, templateFiles = _scanDir(templatePath)
+        for subDirName, subDirPath, subDirMtime in subDirs:
+            if subDirName.lower() in indexDirNames:
+                catalogue["mtimes"][subDirPath] = subDirMtime
+                template["dirs"][subDirName.lower()] = _scanDir(subDirPath)[1]
+
+        catalogue["templateNames"].append(templateName)
+        catalogue["templates"][templateName.lower()] = template
+
+    return catalogue
+
+
+def _isCatalogueCurrent(catalogue):
+    for dirPath, mtime in catalogue["mtimes"].items():
+        try:
+            if stat(dirPath).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def getTemplateCatalogue(templatesPath):
+    # cached between requests, directory modified times are checked at most every CATALOGUE_CHECK_SECONDS
+    catalogue = _templateCatalogues.get(templatesPath)
+    if catalogue and time.time() - catalogue["checked"] < CATALOGUE_CHECK_SECONDS:
+        return catalogue
+
+    if catalogue and _isCatalogueCurrent(catalogue):
+        catalogue["checked"] = time.time()
+    else:
+        catalogue = _buildTemplateCatalogue(templatesPath)
+        _templateCatalogues[templatesPath] = catalogue
+    return catalogue
+
+
+def _getCatalogueTemplate(rootTemplatePath):
+    templatesPath, templateName = path.split(path.normpath(rootTemplatePath))
+    catalogue = getTemplateCatalogue(templatesPath)
+    return catalogue["templates"].get(templateName.lower())
+
+
+def _getCatalogueFiles(rootTemplatePath, dirName, fileTypeList):
+    # full file paths of a template sub directory, from the template catalogue
+    fileList = []
+    template = _getCatalogueTemplate(rootTemplatePath)
+    if template and dirName:
+        for file, filePath in template["dirs"].get(dirName.lower(), []):
+            if getExtension(file) in fileTypeList:
+                fileList.append(filePath)
+    return fileList
+
+
+def getTemplateNameList(templatesPath):
+    return list(getTemplateCatalogue(templatesPath)["templateNames"])
+
+
+def templateExists(rootTemplatePath):
+    return _getCatalogueTemplate(rootTemplatePath) is not None
+
+
 def getLayoutNameList(rootTemplatePath):
-    layoutRoot = join(rootTemplatePath, LAYOUT_DIR_NAME)
-    layoutList = getFileNameList(layoutRoot, ["mxd"])
+    layoutList = [getName(a) for a in _getCatalogueFiles(rootTemplatePath, LAYOUT_DIR_NAME, ["mxd"])]
     return layoutList
 
 
+def writeTemplateCatalogueFile(templatesPath, filePath, hiddenLayoutSuffix):
+    # writes the template names and the layouts of each template to a json file, which clients can read from the
+    # output directory without submitting a job. layouts with hiddenLayoutSuffix in their name are left out
+    # the file is only written again when the catalogue has changed. returns False if it couldn't be written
+    catalogue = getTemplateCatalogue(templatesPath)
+    if _writtenCatalogues.get(filePath) is catalogue and path.exists(filePath):
+        return True
+
+    layouts = {}
+    for templateName in catalogue["templateNames"]:
+        layoutNames = getLayoutNameList(join(templatesPath, templateName))
+        layouts[templateName] = [a for a in layoutNames if a.lower().find(hiddenLayoutSuffix) < 0]
+
+    tempFilePath = filePath + "." + str(getpid()) + ".tmp"
+    try:
+        catalogueFile = open(tempFilePath, "w")
+        try:
+            json.dump({"templates": catalogue["templateNames"], "layouts": layouts}, catalogueFile)
+        finally:
+            catalogueFile.close()
+        if path.exists(filePath):
+            remove(filePath)
+        rename(tempFilePath, filePath)
+    except (IOError, OSError):
+        return False
+
+    _writtenCatalogues[filePath] = catalogue
+    return True
+
+
 def getReplaceLayerOrMapDocList(rootTemplatePath):
-    replaceRoot = join(rootTemplatePath, REPLACE_DIR_NAME)
-    replaceList = getFileList(replaceRoot, ["mxd", "lyr"])
+    replaceList = _getCatalogueFiles(rootTemplatePath, REPLACE_DIR_NAME, ["mxd", "lyr"])
     return replaceList
 
 def getLegendPdfList(rootTemplatePath):
-    legendRoot = join(rootTemplatePath, LEGEND_DIR_NAME)
-    legendList = getFileList(legendRoot, ["pdf"])
+    legendList = _getCatalogueFiles(rootTemplatePath, LEGEND_DIR_NAME, ["pdf"])
     return legendList
 
 def getLegendMxdList(rootTemplatePath):
-    legendRoot = join(rootTemplatePath, LEGEND_DIR_NAME)
-    legendList = getFileList(legendRoot, ["mxd"])
+    legendList = _getCatalogueFiles(rootTemplatePath, LEGEND_DIR_NAME, ["mxd"])
     return legendList
 
 
 def getLayoutMapDoc(rootTemplatePath, layoutName):
 
-    layoutMxdPath = path.join(rootTemplatePath, LAYOUT_DIR_NAME, layoutName)
-    if not path.isfile(layoutMxdPath):
-        raise Exception("Layout does not exist: " + layoutMxdPath)
+    layoutMxdPath = None
+    for layoutPath in _getCatalogueFiles(rootTemplatePath, LAYOUT_DIR_NAME, ["mxd"]):
+        if path.split(layoutPath)[-1].lower() == layoutName.lower():
+            layoutMxdPath = layoutPath
+            break
+
+    if not layoutMxdPath:
+        raise Exception("Layout does not exist: " + path.join(rootTemplatePath, LAYOUT_DIR_NAME, layoutName))
+
+    # layouts are opened from disk for every print, they can't be kept open between requests and handed out
+    # unchanged. arcpy has no in-memory MapDocument copy, a copy is made by saving an mxd and opening it, which costs
+    # as much as opening the layout. reopening used layouts after a request can't be moved off the request either,
+    # arcpy objects must not be created on another thread
+    return openMapDoc(layoutMxdPath)
+
+
+def resetMapDocIoCounts():
+    mapDocIoCounts["opens"] = 0
+    mapDocIoCounts["saves"] = 0
+
+
+def addMapDocIoCounts(counts):
+    # adds the counts returned by a worker process to the counts of this process
+    mapDocIoCounts["opens"] += counts["opens"]
+    mapDocIoCounts["saves"] += counts["saves"]
+
+
+def openMapDoc(mxdPath):
+    # all map documents should be opened through here so they are counted
+    mapDocIoCounts["opens"] += 1
+    from arcpy import mapping
+    return mapping.MapDocument(mxdPath)
+
+
+def saveMapDocCopy(mapDoc, mxdPath):
+    mapDocIoCounts["saves"] += 1
+    mapDoc.saveACopy(mxdPath)
+
+
+def normalizeWebmapForCache(webmapObj):
+    # copy of the webmap without properties that don't change the print, used for the output cache key
+    if not webmapObj or "operationalLayers" not in webmapObj:
+        return webmapObj
+
+    normalizedWebmap = dict(webmapObj)
+    normalizedWebmap["operationalLayers"] = []
+    for jsonOperLayerObj in webmapObj["operationalLayers"]:
+        normalizedLayer = dict(jsonOperLayerObj)
+        for volatileKey in VOLATILE_WEBMAP_LAYER_KEYS:
+            normalizedLayer.pop(volatileKey, None)
+        normalizedWebmap["operationalLayers"].append(normalizedLayer)
+    return normalizedWebmap
+
+
+def getOutputCacheKey(requestParams):
+    requestJson = json.dumps(requestParams, sort_keys = True)
+    return hashlib.sha1(requestJson.encode("utf-8")).hexdigest()
+
+
+def _listOutputCacheFiles(outputFolder, prefix):
+    # returns (path, modified time, size) of cached files, newest first
+    cacheFiles = []
+    if path.isdir(outputFolder):
+        for file, filePath in _scanDir(outputFolder)[1]:
+            if file.startswith(prefix):
+                try:
+                    fileStat = stat(filePath)
+                    cacheFiles.append((filePath, fileStat.st_mtime, fileStat.st_size))
+                except OSError:
+                    pass
+    cacheFiles.sort(key = lambda a: a[1], reverse = True)
+    return cacheFiles
+
+
+def getCachedOutput(outputFolder, cacheKey, ttlSeconds, prefix = OUTPUT_CACHE_PREFIX):
+    # returns the path of a print made for the same request within ttlSeconds, or None
+    for ext in [".pdf", ".jpg", ".png", ".zip"]:
+        cachedFilePath = join(outputFolder, prefix + cacheKey + ext)
+        try:
+            if time.time() - path.getmtime(cachedFilePath) < ttlSeconds:
+                return cachedFilePath
+        except OSError:
+            pass
+    return None
+
+
+def storeCachedOutput(filePath, cacheKey, prefix = OUTPUT_CACHE_PREFIX):
+    # renames a finished print so it can be found by getCachedOutput, returns the new path
+    # the print is left where it is if it can't be renamed, e.g. another request has cached the same print
+    cachedFilePath = join(path.dirname(filePath), prefix + cacheKey + path.splitext(filePath)[1])
+    try:
+        if path.exists(cachedFilePath):
+            remove(cachedFilePath)
+        rename(filePath, cachedFilePath)
+    except OSError:
+        return filePath
+    return cachedFilePath
+
+
+def evictOutputCache(outputFolder, ttlSeconds, maxMb, prefix = OUTPUT_CACHE_PREFIX):
+    # deletes expired cached prints, then the oldest until the cache fits in maxMb
+    totalBytes = 0
+    maxBytes = maxMb * 1024 * 1024
+    for cachedFilePath, mtime, size in _listOutputCacheFiles(outputFolder, prefix):
+        if time.time() - mtime >= ttlSeconds or totalBytes + size > maxBytes:
+            try:
+                remove(cachedFilePath)
+            except OSError:
+                # may be being downloaded, try again next time
+                pass
+        else:
+            totalBytes += size
+
+
+def _readClassCountFile(filePath):
+    try:
+        classCountFile = open(filePath, "r")
+        try:
+            return json.load(classCountFile)
+        finally:
+            classCountFile.close()
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def loadClassCountCache(filePath):
+    # reads the class count file if it hasn't been read by this process or has been changed by another one
+    if not filePath:
+        return
+    try:
+        modified = stat(filePath).st_mtime
+    except OSError:
+        modified = None
+    if filePath == _classCountCache["path"] and modified == _classCountCache["modified"]:
+        return
+
+    counts = _readClassCountFile(filePath) if modified else {}
+    counts.update(_classCountCache["changed"])
+    _classCountCache["counts"] = counts
+    _classCountCache["path"] = filePath
+    _classCountCache["modified"] = modified
+
+
+def getCachedClassCount(layerKey):
+    # returns the class count saved for the layer, or None if it's unknown or older than CLASS_COUNT_MAX_AGE_SECONDS
+    classCount = _classCountCache["counts"].get(layerKey)
+    if classCount is None or time.time() - classCount["time"] > CLASS_COUNT_MAX_AGE_SECONDS:
+        return None
+    return classCount["count"]
+
+
+def storeClassCount(layerKey, count):
+    classCount = {"count": count, "time": time.time()}
+    _classCountCache["counts"][layerKey] = classCount
+    _classCountCache["changed"][layerKey] = classCount
+
+
+def saveClassCountCache():
+    # adds the class counts found by this process to the file, keeping counts saved by other processes
+    # returns False if the file couldn't be written, the counts are kept and saved with the next request
+    filePath = _classCountCache["path"]
+    if not filePath or not _classCountCache["changed"]:
+        return True
+
+    counts = _readClassCountFile(filePath)
+    counts.update(_classCountCache["changed"])
+    tempFilePath = filePath + "." + str(getpid()) + ".tmp"
+    try:
+        classCountFile = open(tempFilePath, "w")
+        try:
+            json.dump(counts, classCountFile)
+        finally:
+            classCountFile.close()
+        if path.exists(filePath):
+            remove(filePath)
+        rename(tempFilePath, filePath)
+    except (IOError, OSError):
+        return False
+
+    _classCountCache["counts"] = counts
+    _classCountCache["changed"] = {}
+    _classCountCache["modified"] = stat(filePath).st_mtime
+    return True
+
+
+def isTempArtifactName(fileName):
+    # cached prints and legend pages have their own expiry, see evictOutputCache
+    return fileName.startswith(TEMP_ARTIFACT_PREFIX) and not fileName.startswith(OUTPUT_CACHE_PREFIX) \
+        and not fileName.startswith(LEGEND_PAGE_CACHE_PREFIX)
+
+
+def registerTempArtifact(artifactPath):
+    # records an intermediate file or geodatabase, deleted by deleteTempArtifacts once the print is finished
+    if artifactPath not in _tempArtifacts:
+        _tempArtifacts.append(artifactPath)
+
+
+def takeTempArtifacts():
+    # returns and forgets the artifacts registered so far, used by worker processes to hand them to the main process
+    artifactPaths = list(_tempArtifacts)
+    del _tempArtifacts[:]
+    return artifactPaths
+
+
+def retainArtifact(artifactPath):
+    # keeps a temporary file or gdb still in use by this process out of sweepOutputDirectory
+    _retainedArtifacts.add(artifactPath)
+
+
+def releaseArtifact(artifactPath):
+    _retainedArtifacts.discard(artifactPath)
+
+
+def _deleteArtifact(artifactPath):
+    try:
+        if path.isdir(artifactPath):
+            shutil.rmtree(artifactPath)
+        elif path.exists(artifactPath):
+            remove(artifactPath)
+        return True
+    except (OSError, IOError):
+        # may still be locked by arcpy, sweepOutputDirectory will remove it later
+        return False
+
+
+def deleteTempArtifacts(keepPaths = None):
+    # deletes the intermediate files of the current request, except those in keepPaths
+    # returns the number of artifacts that could not be deleted
+    keepPaths = keepPaths or []
+    failedCount = 0
+    for artifactPath in _tempArtifacts:
+        if artifactPath not in keepPaths and not _deleteArtifact(artifactPath):
+            failedCount += 1
+    del _tempArtifacts[:]
+    return failedCount
+
+
+def sweepOutputDirectory(outputFolder, maxAgeSeconds, maxMb, intervalSeconds):
+    # deletes temporary files and geodatabases older than maxAgeSeconds, then the oldest files until the
+    # directory is under maxMb. runs at most once every intervalSeconds in each server process
+    # returns the number of items deleted
+    global _lastSweepTime
+
+    if time.time() - _lastSweepTime < intervalSeconds or not path.isdir(outputFolder):
+        return 0
+    _lastSweepTime = time.time()
+
+    artifacts = []
+    for dirName, dirPath, dirMtime in _scanDir(outputFolder)[0]:
+        if isTempArtifactName(dirName):
+            artifacts.append((dirPath, dirMtime, 0))
+    for fileName, filePath in _scanDir(outputFolder)[1]:
+        if isTempArtifactName(fileName):
+            try:
+                fileStat = stat(filePath)
+                artifacts.append((filePath, fileStat.st_mtime, fileStat.st_size))
+            except OSError:
+                pass
+    artifacts.sort(key = lambda a: a[1], reverse = True)
+
+    deletedCount = 0
+    totalBytes = 0
+    maxBytes = maxMb * 1024 * 1024
+    for artifactPath, mtime, size in artifacts:
+        if artifactPath in _retainedArtifacts:
+            totalBytes += size
+            continue
+        age = time.time() - mtime
+        if age >= SWEEP_MIN_AGE_SECONDS and (age >= maxAgeSeconds or totalBytes + size > maxBytes):
+            if _deleteArtifact(artifactPath):
+                deletedCount += 1
+                continue
+        totalBytes += size
+
+    return deletedCount
 
-    return mapping.MapDocument(layoutMxdPath)
 
 def getExtension(file):
     ext = path.splitext(file)[1].lower()
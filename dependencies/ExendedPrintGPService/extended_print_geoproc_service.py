@@ -5,6 +5,9 @@
 ##   ac_print_geoproc_service.py - the main service uploaded to ArcGIS Server
 ##   ac_print_file_utils.py - helper module with functions for accessing and changing files
 ##   ac_print_map_utils.py - helper module with functions for manipulating map
+##   extended_print_parallel_utils.py - helper module for running print pages in worker processes
+##   extended_print_profile_utils.py - helper module for counting arcpy.mapping calls, see PROFILE_MAPPING_CALLS
+##   extended_print_job_utils.py - helper module for reporting print progress and cancelling prints
 ##   ac_print_geoproc_service_settings.py - settings module containing environment specific variables
 ##   ACPrint102.tbx - toolbox used to publish the service, to be run in ArcMap
 ##
@@ -23,22 +26,48 @@
 ##   - Publish as an asynchronous geoprocessing service. Set message logging to "info" to be able to check for errors.
 ##
 ## 2. Install modules on Server
-##   -Place the additional three modules (ac_print_map_utils, ac_print_file_utils, ac_print_geoproc_service_settings)
+##   -Place the additional modules (ac_print_map_utils, ac_print_file_utils, extended_print_parallel_utils, extended_print_profile_utils,
+##   extended_print_job_utils, ac_print_geoproc_service_settings)
 ##   in the site-packages folder for EACH ArcGIS Server that is running the service. This will usually be the 64 bit installation of Python:
 ##   D:\Python27\ArcGISx6410.2\Lib\site-packages
 ##
 ##   Configure the settings file correctly for the environment
 ##
+##   - Optional: install PyPDF2 into the same Python on each server, e.g.
+##   D:\Python27\ArcGISx6410.2\python.exe -m pip install "PyPDF2<2"
+##   PyPDF2 1.x is the last for Python 2.7. Multi page pdfs are then combined in one pass, without it
+##   arcpy.mapping.PDFDocument is used
+##
 
 import arcpy
-from arcpy import mapping
-import uuid
 from os import path
 import json
 import extended_print_geoproc_service_settings as settings
 import extended_print_file_utils as fileUtils
-import extended_print_map_utils as mapUtils
+import extended_print_job_utils as jobUtils
 from datetime import datetime
+from contextlib import contextmanager
+import time
+import uuid
+
+# layouts with this suffix are used when the legend is not printed on the map page
+noLegendMxdNameSuffix = " no legend"
+
+# arcpy.mapping and the modules that use it are only needed to print, not to list templates and layouts
+# they are imported by importPrintModules
+mapping = None
+mapUtils = None
+parallelUtils = None
+profileUtils = None
+
+# messages logged by this process, returned to the main process when running in a worker
+logMessages = []
+
+# how long each stage of the request took, returned in resultObj["timings"]
+stageTimings = []
+
+# legend size estimates compared with the arcpy overflow check, see LEGEND_ESTIMATE_TEST_MODE
+legendEstimateChecks = []
 
 
 def log(s, isError = False):
@@ -56,6 +85,7 @@ def log(s, isError = False):
     print(s)
 
     arcpy.AddMessage(s)
+    logMessages.append(s)
     if isError:
         if resultObj["error"] != "":
             resultObj["error"] += "; "
@@ -64,12 +94,52 @@ def log(s, isError = False):
 
 
 
+@contextmanager
+def timeStage(stageName):
+    # records the time taken by the code in a with block, e.g.
+    # with timeStage("combine"):
+    startTime = time.time()
+    try:
+        yield
+    finally:
+        addStageTiming(stageName, int((time.time() - startTime) * 1000))
+
+
+def addStageTiming(stageName, stageMs):
+    stageTimings.append({"stage": stageName, "ms": stageMs})
+
+
+def importPrintModules():
+    global mapping, mapUtils, parallelUtils, profileUtils
+    if mapUtils is not None:
+        return
+    with timeStage("importModules"):
+        from arcpy import mapping
+        import extended_print_map_utils as mapUtils
+        import extended_print_parallel_utils as parallelUtils
+        import extended_print_profile_utils as profileUtils
+
+
+def writeMetrics(metricsFilePath, resultObj):
+    # appends the request timings to a JSON lines file
+    metricsObj = {"time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "timings": resultObj.get("timings", []),
+                  "error": resultObj["error"]}
+    if "mappingCalls" in resultObj:
+        metricsObj["mappingCalls"] = resultObj["mappingCalls"]
+    metricsFile = open(metricsFilePath, "a")
+    try:
+        metricsFile.write(json.dumps(metricsObj) + "\n")
+    finally:
+        metricsFile.close()
+
+
 def getMapDocForStandardTemplates(webmapMapDoc, outputFolder, layoutMxd, extent, mapScale, lodsArray):
 
-    fromLayers = mapping.ListLayers(webmapMapDoc)
+    fromLayers = mapUtils.listLayers(webmapMapDoc)
     log("Copying webmap layers to layout map doc...")
-    outMapDoc = mapUtils.copyLayers(fromLayers, layoutMxd, outputFolder)
-    outMapDoc = mapUtils.setExtentAndScale(outMapDoc, extent, mapScale, lodsArray)
+    with timeStage("copyLayers"):
+        outMapDoc = mapUtils.copyLayers(fromLayers, layoutMxd, outputFolder)
+        outMapDoc = mapUtils.setExtentAndScale(outMapDoc, extent, mapScale, lodsArray)
 
     # debug - save webmap mxd
     #outMapDoc.saveACopy(path.join(outputFolder, str(newUuid) + "_WEBMAP_LAYERS_TEMP.mxd"))
@@ -87,16 +157,17 @@ def getMapDocsForPresetTemplates(replaceList, layoutMxd, outputFolder, extent, m
         log("Processing map: " + title)
 
         if fileUtils.getExtension(replaceLayerOrMapDocPath) == "mxd":
-            replaceMapDoc = mapping.MapDocument(replaceLayerOrMapDocPath)
-            layersToCopy = mapping.ListLayers(replaceMapDoc)
+            replaceMapDoc = fileUtils.openMapDoc(replaceLayerOrMapDocPath)
+            layersToCopy = mapUtils.listLayers(replaceMapDoc)
 
         elif fileUtils.getExtension(replaceLayerOrMapDocPath) == "lyr":
             replaceLayer = mapping.Layer(replaceLayerOrMapDocPath)
             layersToCopy.append(replaceLayer)
 
         log("Copying layers from: " + replaceLayerOrMapDocPath)
-        outMapDoc = mapUtils.copyLayers(layersToCopy, layoutMxd, outputFolder, True)
-        outMapDoc = mapUtils.setExtentAndScale(outMapDoc, extent, mapScale, lodsArray)
+        with timeStage("copyLayers"):
+            outMapDoc = mapUtils.copyLayers(layersToCopy, layoutMxd, outputFolder, True)
+            outMapDoc = mapUtils.setExtentAndScale(outMapDoc, extent, mapScale, lodsArray)
 
         log("Processing text elements...")
         mapUtils.processTextElements(outMapDoc, {settings.REPLACE_LAYER_ELEMENT_NAME: title})
@@ -107,7 +178,9 @@ def getMapDocsForPresetTemplates(replaceList, layoutMxd, outputFolder, extent, m
 
 def getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemLimit, templateRootPath,
                              newExtent, mapScale, lodsArray, textElementsList,
-                             layoutNameStr, legendMxdList):
+                             layoutNameStr, legendMxdList, includeLegend, pageLimit = None, legendPageCache = None):
+    # returns the list of pages to print, see mapUtils.createPage
+    # pageLimit stops map docs being prepared for pages that won't be delivered
 
     legendExcludeLayers = settings.LEGEND_EXCLUDE_LAYERS
     styleFile = settings.LEGEND_STYLE_FILE
@@ -115,15 +188,38 @@ def getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemL
     legendTemplateConfig = settings.LEGEND_TEMPLATE_CONFIG
 
     outMapDocsWithLegends = []
+    # map docs of the map pages, the client text is set on all of them once they're prepared
+    textMapDocs = []
 
     for outMapDoc in outputMapDocs:
 
         switchToNoLegendMxd = False
         legendItemCount = 0
-        if includeLegend:
+        # legend include / exclude decision per layer, shared by every legend of this output map
+        legendVerdicts = {}
+        mapDocCloneForLegend = None
+
+        # where the layout has a legend item limit, a legend that's estimated to overflow by more than
+        # LEGEND_ESTIMATE_OVERFLOW_MARGIN goes straight to a second page without cloning the map doc
+        # in test mode, the estimate is checked against arcpy instead
+        predictedOverflow = None
+        clearOverflow = False
+        if includeLegend and layoutItemLimit > -1:
+            with timeStage("legendEstimate"):
+                estimatedItemCount = mapUtils.estimateLegendItemCount(outMapDoc, webMapObj, log, legendVerdicts)
+            predictedOverflow = mapUtils.predictLegendOverflow(estimatedItemCount, layoutItemLimit)
+            clearOverflow = estimatedItemCount > layoutItemLimit * (1 + settings.LEGEND_ESTIMATE_OVERFLOW_MARGIN)
+            log("Legend item estimate: " + str(estimatedItemCount) + " - limit " + str(layoutItemLimit))
+
+        if includeLegend and clearOverflow and not settings.LEGEND_ESTIMATE_TEST_MODE:
+            log("Overflowing based on legend item estimate")
+            legendItemCount = estimatedItemCount
+            switchToNoLegendMxd = True
+        elif includeLegend:
             # get swatch count for map doc
-            mapDocCloneForLegend = mapUtils.getMapDocForLegend(outMapDoc, legendExcludeLayers, outputFolder, log, webMapObj)
-            legendLayers = mapping.ListLayers(mapDocCloneForLegend)
+            mapDocCloneForLegend = mapUtils.getMapDocForLegend(outMapDoc, legendExcludeLayers, outputFolder, log, webMapObj,
+                                                             legendVerdicts)
+            legendLayers = mapUtils.listLayers(mapDocCloneForLegend)
             # get approx swatch count, used for selecting legend mxd
             legendItemCount = mapUtils.getSwatchCount(legendLayers, log)
             log("Legend swatch count estimate: " + str(legendItemCount))
@@ -142,9 +238,18 @@ def getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemL
                     legendIsOverflowing = True
                     log("Overflowing based on client side count")
 
+            if settings.LEGEND_ESTIMATE_TEST_MODE and predictedOverflow is not None:
+                log("Legend overflow estimate: " + str(predictedOverflow) + ", checked: " + str(legendIsOverflowing))
+                legendEstimateChecks.append({"estimatedItemCount": estimatedItemCount, "swatchCount": legendItemCount,
+                                             "itemLimit": layoutItemLimit, "predictedOverflow": predictedOverflow,
+                                             "overflow": legendIsOverflowing})
+
             if not legendIsOverflowing:
-                outMapDoc = mapUtils.cloneMapDoc(outMapDoc, outputFolder)
-                mapUtils.processInlineLegend(outMapDoc, True, legendExcludeLayers, webMapObj, log)
+                # getMapDocForLegend has already removed excluded layers from the clone's legend, print it directly
+                # rather than cloning the map doc again. its layers were removed and added again, so the extent,
+                # LOD scale and basemap scale ranges are set again as for every other copy of the layers
+                outMapDoc = mapDocCloneForLegend
+                outMapDoc = mapUtils.setExtentAndScale(outMapDoc, newExtent, mapScale, lodsArray)
             else:
                 switchToNoLegendMxd = True
         else:
@@ -156,16 +261,16 @@ def getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemL
             newLayoutName = layoutNameStr.replace(".mxd", noLegendMxdNameSuffix + ".mxd")
             newLayoutMxd = fileUtils.getLayoutMapDoc(templateRootPath, newLayoutName)
             if newLayoutMxd:
-                fromLayers = mapping.ListLayers(outMapDoc)
+                fromLayers = mapUtils.listLayers(outMapDoc)
                 outMapDoc = mapUtils.copyLayers(fromLayers, newLayoutMxd, outputFolder)
                 outMapDoc = mapUtils.setExtentAndScale(outMapDoc, newExtent, mapScale, lodsArray)
 
-        log("Processing custom text elements...")
-        mapUtils.processTextElements(outMapDoc, textElementsList)
-
         # export maing print file
         log("Exporting file...")
-        outMapDocsWithLegends.append(outMapDoc)
+        textMapDocs.append(outMapDoc)
+        outMapDocsWithLegends.append(mapUtils.createPage(outMapDoc, isMapPage = True))
+        if pageLimit and len(outMapDocsWithLegends) >= pageLimit:
+            break
 
         # process mxd legends, attached as second page
         if includeLegend and switchToNoLegendMxd:
@@ -174,15 +279,100 @@ def getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemL
             targetLegendMxd = mapUtils.getTargetLegendMxd(legendItemCount, legendTemplateConfig, layoutNameStr)
             log("Using legend template: " + targetLegendMxd)
             processedLegendMxds = mapUtils.getMxdLegends(legendMxdList, outMapDoc, layoutNameStr, outputFolder, log,
-                                                         legendTemplateConfig, legendExcludeLayers, webMapObj, styleFile, styleName)
-            for legendMxd in processedLegendMxds:
-                outMapDocsWithLegends.append(legendMxd)
+                                                         legendTemplateConfig, legendExcludeLayers, webMapObj, styleFile, styleName,
+                                                         legendVerdicts, mapDocCloneForLegend, legendPageCache)
+            for legendPage in processedLegendMxds:
+                outMapDocsWithLegends.append(legendPage)
 
+    log("Processing custom text elements...")
+    mapUtils.processTextElementsForPages(textMapDocs, textElementsList)
 
     return outMapDocsWithLegends
 
 
 
+def exportMapDocs(pageList, formatStr, outputFolder, quality):
+    # exports the map doc of each page to a file, returning the files in the same order as pageList
+    # pages that were found in the legend page cache are already files and are not exported again
+    # with EXPORT_WORKER_PROCESSES set, map docs are saved to disk and exported at the same time in worker processes
+
+    exportPageList = [a for a in pageList if a["mapDoc"] is not None]
+    mapDocList = [a["mapDoc"] for a in exportPageList]
+
+    workerCount = settings.EXPORT_WORKER_PROCESSES
+    exportResults = None
+    if workerCount > 1 and len(mapDocList) > 1 and parallelUtils.canStartWorkers():
+        exportArgsList = []
+        for exportableMapDoc in mapDocList:
+            exportMxdPath = path.join(outputFolder, "_ags_ex_" + str(uuid.uuid4()) + ".mxd")
+            fileUtils.saveMapDocCopy(exportableMapDoc, exportMxdPath)
+            fileUtils.registerTempArtifact(exportMxdPath)
+            exportArgsList.append((exportMxdPath, formatStr, outputFolder, quality))
+
+        log("Exporting " + str(len(exportArgsList)) + " pages in worker processes...")
+        jobUtils.checkJobCancelled()
+        # each page is counted as its worker finishes, so progress moves while the others are still exporting
+        exportResults = parallelUtils.mapInProcessPool(mapUtils.exportSavedMapDocToFile, exportArgsList, workerCount, log,
+                                                       settings.WORKER_TIMEOUT_SECONDS,
+                                                       lambda exportResult: jobUtils.jobPageExported())
+
+    if exportResults is None:
+        exportResults = []
+        for exportableMapDoc in mapDocList:
+            jobUtils.checkJobCancelled()
+            startTime = time.time()
+            exportFile = mapUtils.exportMapDocToFile(exportableMapDoc, formatStr, outputFolder, quality)
+            exportResults.append((exportFile, int((time.time() - startTime) * 1000), None))
+            jobUtils.jobPageExported()
+
+    for pageIndex, exportResult in enumerate(exportResults):
+        exportFile, exportMs, exportMapDocIo = exportResult
+        log("Exported page " + str(pageIndex + 1) + " of " + str(len(exportResults)) + " in " + str(exportMs) + " ms: " + exportFile)
+
+        # files exported by worker processes are registered here, so they are tidied up by this process
+        fileUtils.registerTempArtifact(exportFile)
+        if exportMapDocIo is not None:
+            fileUtils.addMapDocIoCounts(exportMapDocIo)
+        addStageTiming("export", exportMs)
+        exportPage = exportPageList[pageIndex]
+        exportPage["file"] = exportFile
+        if exportPage["cacheKey"]:
+            exportPage["file"] = fileUtils.storeCachedOutput(exportFile, exportPage["cacheKey"], fileUtils.LEGEND_PAGE_CACHE_PREFIX)
+
+    return [a["file"] for a in pageList]
+
+
+def exportAtlasPages(pageList, atlasPages, textElementsList, mapScale, lodsArray, formatStr, outputFolder, quality,
+                     pageLimit = None):
+    # exports the map pages once for every atlas page, changing only the extent, scale and text between exports
+    # legend pages don't change between atlas pages, they are exported once and follow the map pages
+
+    mapPageList = [a for a in pageList if a["isMapPage"]]
+    otherPageList = [a for a in pageList if not a["isMapPage"]]
+
+    exportedFiles = []
+    for atlasIndex, atlasPage in enumerate(atlasPages):
+        if pageLimit and len(exportedFiles) >= pageLimit:
+            break
+        log("Printing atlas page " + str(atlasIndex + 1) + " of " + str(len(atlasPages)))
+
+        atlasScale = atlasPage["scale"] if atlasPage["scale"] else mapScale
+        # page text overrides the request's text, which is set again in case the previous page overrode it
+        atlasTextElements = dict(textElementsList)
+        atlasTextElements.update(atlasPage["textElements"])
+
+        for mapPage in mapPageList:
+            atlasMapDoc = mapPage["mapDoc"]
+            atlasExtent = mapUtils.setExtentFromJson(mapUtils.listDataFrames(atlasMapDoc)[0].extent, atlasPage["extent"])
+            mapUtils.setExtentAndScale(atlasMapDoc, atlasExtent, atlasScale, lodsArray)
+            mapUtils.processTextElements(atlasMapDoc, atlasTextElements)
+            exportedFiles.extend(exportMapDocs([mapUtils.createPage(atlasMapDoc)], formatStr, outputFolder, quality))
+
+    if pageLimit:
+        return exportedFiles[:pageLimit]
+    return exportedFiles + exportMapDocs(otherPageList, formatStr, outputFolder, quality)
+
+
 def process(templateRootPath,
             layoutNameStr,
             outputFolder,
@@ -193,33 +383,47 @@ def process(templateRootPath,
             textElementsList,
             lodsArray,
             includeLegend,
-            layoutItemLimit):
-
-
+            layoutItemLimit,
+            webmapJson,
+            webMapIndex,
+            replaceList = None,
+            appendLegendPdfs = True,
+            pageLimit = None,
+            atlasPages = None):
+
+    # replaceList can be set to print some of the template's replacement layers or mxds only, used when
+    # pages are split between worker processes. appendLegendPdfs is only set on the last page of a template
+    # pageLimit is the maximum number of pages to export, for outputs that can only deliver a single page
+    # atlasPages is a list of extents to print the map pages at, see mapUtils.getAtlasPages. the webmap is
+    # converted and the layout prepared once, at the first extent
 
     log("Using template root: " + templateRootPath)
-    if not path.isdir(templateRootPath):
+    if not fileUtils.templateExists(templateRootPath):
         raise Exception("No template exists for: " + templateRootPath)
 
     # process file lists
     legendPdfList = fileUtils.getLegendPdfList(templateRootPath)
     legendMxdList = fileUtils.getLegendMxdList(templateRootPath)
-    replaceList = fileUtils.getReplaceLayerOrMapDocList(templateRootPath)
+    if replaceList is None:
+        replaceList = fileUtils.getReplaceLayerOrMapDocList(templateRootPath)
+    if pageLimit:
+        replaceList = replaceList[:pageLimit]
 
     layoutMxd = fileUtils.getLayoutMapDoc(templateRootPath, layoutNameStr)
     log("Using layout map doc: " + layoutMxd.filePath)
 
     # webmaps
     log("Converting webmaps to map documents...")
-    webmapMapDoc = mapUtils.webmapToMapDocument(webmapJson, outputFolder, settings.SERVER_CONNECTIONS)
+    with timeStage("convertWebmap"):
+        webmapMapDoc = mapUtils.getWebmapMapDocument(webmapJson, outputFolder, settings.SERVER_CONNECTIONS)
+    jobUtils.setJobStage("webmapConverted")
 
-    webmapDataframe = mapping.ListDataFrames(webmapMapDoc)[0]
+    webmapDataframe = mapUtils.listDataFrames(webmapMapDoc)[0]
     newExtent = webmapDataframe.extent
+    if atlasPages:
+        extentObj = atlasPages[0]["extent"]
     if extentObj:
-        newExtent.XMin = extentObj['xmin']
-        newExtent.YMin = extentObj['ymin']
-        newExtent.XMax = extentObj['xmax']
-        newExtent.YMax = extentObj['ymax']
+        newExtent = mapUtils.setExtentFromJson(newExtent, extentObj)
 
 
     # create list of output pdf or image files for concatenating later
@@ -235,15 +439,31 @@ def process(templateRootPath,
         outMapDocList = getMapDocsForPresetTemplates(replaceList, layoutMxd, outputFolder, newExtent, mapScale, lodsArray)
         outputMapDocs.extend(outMapDocList)
 
-    mapDocListWithLegends = getMapDocListWithLegends(outputMapDocs, outputFolder, webMapObj, layoutItemLimit, templateRootPath, newExtent,
-                                                     mapScale, lodsArray, textElementsList, layoutNameStr, legendMxdList)
-    for legendMapDoc in mapDocListWithLegends:
-        exportLegendFile = mapUtils.exportMapDocToFile(legendMapDoc, formatStr, outputFolder, quality)
-        exportedImageFilePaths.append(exportLegendFile)
+    # legend pages are reused from earlier prints with the same legend layers and scale
+    legendPageCache = None
+    if settings.LEGEND_PAGE_CACHE_TTL_SECONDS > 0:
+        legendPageCache = {"folder": outputFolder, "format": formatStr, "quality": quality,
+                           "ttl": settings.LEGEND_PAGE_CACHE_TTL_SECONDS}
+
+    with timeStage("legends"):
+        mapDocListWithLegends = getMapDocListWithLegends(outputMapDocs, outputFolder, webMapIndex, layoutItemLimit, templateRootPath,
+                                                         newExtent, mapScale, lodsArray, textElementsList, layoutNameStr,
+                                                         legendMxdList, includeLegend, pageLimit, legendPageCache)
+    exportPageCount = len([a for a in mapDocListWithLegends if a["mapDoc"] is not None])
+    if atlasPages:
+        mapPageCount = len([a for a in mapDocListWithLegends if a["isMapPage"]])
+        exportPageCount += mapPageCount * (len(atlasPages) - 1)
+    jobUtils.addJobPages(exportPageCount)
+
+    if atlasPages:
+        exportedImageFilePaths.extend(exportAtlasPages(mapDocListWithLegends, atlasPages, textElementsList, mapScale, lodsArray,
+                                                       formatStr, outputFolder, quality, pageLimit))
+    else:
+        exportedImageFilePaths.extend(exportMapDocs(mapDocListWithLegends, formatStr, outputFolder, quality))
 
 
     # append pdf legends
-    if includeLegend:
+    if includeLegend and appendLegendPdfs and not pageLimit:
         for legendFile in legendPdfList:
             log("Appending legend file: " + legendFile)
             exportedImageFilePaths.append(legendFile)
@@ -251,6 +471,127 @@ def process(templateRootPath,
     return exportedImageFilePaths
 
 
+def configureModules():
+    # inject settings into file util module
+    fileUtils.LAYOUT_DIR_NAME = settings.TEMPLATE_LAYOUT_DIR_NAME
+    fileUtils.REPLACE_DIR_NAME = settings.TEMPLATE_REPLACE_DIR_NAME
+    fileUtils.LEGEND_DIR_NAME = settings.TEMPLATE_LEGEND_DIR_NAME
+    fileUtils.CATALOGUE_CHECK_SECONDS = settings.TEMPLATE_CATALOGUE_CHECK_SECONDS
+    fileUtils.CLASS_COUNT_MAX_AGE_SECONDS = settings.SYMBOLOGY_CLASS_COUNT_MAX_AGE_HOURS * 3600
+
+
+def signInToPortal():
+    # sign in to portal as an admin user so we have access to all webmap layers
+    if settings.PORTAL_USER:
+        log("Signing in to: " + settings.PORTAL_URL)
+        arcpy.SignInToPortal_server(settings.PORTAL_USER, settings.PORTAL_PASSWORD, settings.PORTAL_URL)
+
+
+def getPrintJobs(templateList, layoutNameStr, outputFolder, formatStr, quality, mapScale, extentObj,
+                 textElementsList, lodsArray, includeLegend, webmapJson, splitReplacePages, pageLimit = None,
+                 atlasPages = None):
+    # a print job is one call to process(), either a whole template or, if splitReplacePages is set,
+    # one page for each of the template's replacement layers or mxds
+
+    printJobs = []
+    for template in templateList:
+        templateRootPath = path.join(settings.TEMPLATES_PATH, template)
+        layoutItemLimit = mapUtils.getTemplateLegendItemLimit(settings.LEGEND_STYLE_TEMPLATE_LIMITS_CONFIG,
+                                                              template, layoutNameStr)
+        printJob = {
+            "templateRootPath": templateRootPath,
+            "layoutNameStr": layoutNameStr,
+            "outputFolder": outputFolder,
+            "formatStr": formatStr,
+            "quality": quality,
+            "mapScale": mapScale,
+            "extentObj": extentObj,
+            "textElementsList": textElementsList,
+            "lodsArray": lodsArray,
+            "includeLegend": includeLegend,
+            "layoutItemLimit": layoutItemLimit,
+            "webmapJson": webmapJson,
+            "replaceList": None,
+            "appendLegendPdfs": True,
+            "pageLimit": pageLimit,
+            "atlasPages": atlasPages,
+            "jobId": None
+        }
+
+        replaceList = []
+        if splitReplacePages and fileUtils.templateExists(templateRootPath):
+            replaceList = fileUtils.getReplaceLayerOrMapDocList(templateRootPath)
+            # pages past the limit would be dropped by process(), so don't start jobs for them
+            if pageLimit:
+                replaceList = replaceList[:pageLimit]
+
+        if len(replaceList) > 1:
+            for replaceIndex, replaceLayerOrMapDocPath in enumerate(replaceList):
+                replacePrintJob = dict(printJob)
+                replacePrintJob["replaceList"] = [replaceLayerOrMapDocPath]
+                replacePrintJob["appendLegendPdfs"] = replaceIndex == len(replaceList) - 1
+                printJobs.append(replacePrintJob)
+        else:
+            printJobs.append(printJob)
+
+    return printJobs
+
+
+def processJob(printJob, webMapIndex):
+    return process(printJob["templateRootPath"], printJob["layoutNameStr"], printJob["outputFolder"], printJob["formatStr"],
+                   printJob["quality"], printJob["mapScale"], printJob["extentObj"], printJob["textElementsList"],
+                   printJob["lodsArray"], printJob["includeLegend"], printJob["layoutItemLimit"], printJob["webmapJson"],
+                   webMapIndex, printJob["replaceList"], printJob["appendLegendPdfs"], printJob["pageLimit"],
+                   printJob["atlasPages"])
+
+
+def processJobInWorker(printJob):
+    # runs a print job in a worker process, see PRINT_WORKER_PROCESSES in the settings
+    # errors and log messages are returned to the main process rather than raised
+    del logMessages[:]
+    del stageTimings[:]
+    del legendEstimateChecks[:]
+    fileUtils.resetMapDocIoCounts()
+    # a new worker process has only imported this module, the print modules are loaded before anything uses them
+    importPrintModules()
+    mapUtils.clearMapDocListings()
+    workerResult = {"files": [], "messages": logMessages, "timings": stageTimings, "mappingCalls": [],
+                    "legendEstimateChecks": legendEstimateChecks, "artifacts": [], "pageCount": 0, "pagesExported": 0,
+                    "mapDocIo": fileUtils.mapDocIoCounts, "error": ""}
+    jobStatus = None
+    if settings.PROFILE_MAPPING_CALLS:
+        profileUtils.startMappingProfile()
+    try:
+        configureModules()
+        fileUtils.loadClassCountCache(settings.SYMBOLOGY_CLASS_COUNT_CACHE_FILE)
+        if printJob["jobId"]:
+            jobStatus = jobUtils.startJob(printJob["outputFolder"], printJob["jobId"], False)
+        signInToPortal()
+        webMapIndex = mapUtils.parseWebmap(json.loads(printJob["webmapJson"]))
+        workerResult["files"] = processJob(printJob, webMapIndex)
+    except Exception as e:
+        workerResult["error"] = str(e)
+    finally:
+        # the worker doesn't write the status file, its pages are added to the progress by the main process
+        if jobStatus is not None:
+            workerResult["pageCount"] = jobStatus["pageCount"]
+            workerResult["pagesExported"] = jobStatus["pagesExported"]
+        jobUtils.finishJob("failed" if workerResult["error"] else "succeeded")
+        mapUtils.clearMapDocListings()
+        # the worker process ends with the pool, so its converted webmaps aren't kept. its pages, clones, temporary
+        # mxds and webmap gdbs are deleted by the main process once the print has been combined
+        mapUtils.releaseWebmapMapDocuments(0)
+        workerResult["artifacts"] = fileUtils.takeTempArtifacts()
+        fileUtils.saveClassCountCache()
+        if settings.PROFILE_MAPPING_CALLS:
+            workerResult["mappingCalls"] = profileUtils.stopMappingProfile()
+    return workerResult
+
+
+def addWorkerJobPages(workerResult):
+    # called in the main process as each print job's worker finishes, see processJobInWorker
+    jobUtils.addJobPages(workerResult["pageCount"])
+    jobUtils.jobPageExported(workerResult["pagesExported"])
 
 
 # return this object when we're done
@@ -258,149 +599,302 @@ resultObj = {}
 # client can always check for error object
 resultObj["error"] = ""
 
-try:
-    # inject settings into file util module
-    fileUtils.LAYOUT_DIR_NAME = settings.TEMPLATE_LAYOUT_DIR_NAME
-    fileUtils.REPLACE_DIR_NAME = settings.TEMPLATE_REPLACE_DIR_NAME
-    fileUtils.LEGEND_DIR_NAME = settings.TEMPLATE_LEGEND_DIR_NAME
-
-
-    # start processing request
-    log("Collecting parameters...")
-
-    # first parameter (0) is return object
-    webmapJson = arcpy.GetParameterAsText(1)
-    templateStr = arcpy.GetParameterAsText(2)
-    layoutNameStr = arcpy.GetParameterAsText(3)
-    textElementsListJson = arcpy.GetParameterAsText(4)
-    formatStr = arcpy.GetParameterAsText(5)
-    qualityStr = arcpy.GetParameterAsText(6)
-    mapScaleStr = arcpy.GetParameterAsText(7)
-    elementVisibilityStr = arcpy.GetParameterAsText(8)
-    getLayoutsStr = arcpy.GetParameterAsText(9)
-    extentJson = arcpy.GetParameterAsText(10)
-    lodsJson = arcpy.GetParameterAsText(11)
-    includeLegendStr = arcpy.GetParameterAsText(12)
-
-    ## DEBUG ##
-    #webmapJson = '{"mapOptions":{"showAttribution":true,"extent":{"xmin":1755268.0160213956,"ymin":5920584.470725218,"xmax":1755841.2937333588,"ymax":5920863.645027658,"spatialReference":{"wkid":2193,"latestWkid":2193}},"spatialReference":{"wkid":2193,"latestWkid":2193}},"operationalLayers":[{"id":"Light_1246","title":"Light_1246","opacity":1,"minScale":18489297.737236,"maxScale":1128.497176,"url":"https://s1-ts.cloud.eaglegis.co.nz/arcgis/rest/services/Canvas/Light/MapServer"},{"id":"Landbase_5000","title":"Landbase","opacity":1,"minScale":0,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Landbase/MapServer","visibleLayers":[1,2,3,4,5,6,7,8,9,10,11,12,13,15,16,17,19,20,21,22],"layers":[{"id":0,"showLegend":false}]},{"id":"Address_2359","title":"Address","opacity":1,"minScale":16000,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Address/MapServer","visibleLayers":[1,2],"showLegend":false},{"id":"Contours_4135","title":"Contours","opacity":1,"minScale":0,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Contours/MapServer","visibleLayers":[1,2,4,5,7,8,10,11,13,14,16,17,19,20,21,22,23],"layers":[{"id":5,"showLegend":false},{"id":2,"showLegend":false},{"id":8,"showLegend":false},{"id":17,"showLegend":false},{"id":20,"showLegend":false},{"id":14,"showLegend":false},{"id":11,"showLegend":false}]},{"id":"map_graphics","opacity":1,"minScale":0,"maxScale":0,"featureCollection":{"layers":[]}}]}'
-    #mapScaleStr = '20000'
-    #layoutNameStr = 'A4 Landscape'
-    #templateStr = 'Standard'
-    #qualityStr = '96'
-    #getLayoutsStr = "true"
-    #textElementsListJson = '{"title": "Davids", "legal": "CUStLegal", "VALUATIONREF": ""}'
-    #formatStr = "pdf"
-    #extentJson = ''
-    #lodsJson = '[{"level":0,"resolution":264.5838625010584,"scale":1000000,"startTileRow":1,"startTileCol":1,"endTileRow":4,"endTileCol":4},{"level":1,"resolution":201.08373550080435,"scale":760000,"startTileRow":1,"startTileCol":2,"endTileRow":6,"endTileCol":5},{"level":2,"resolution":132.2919312505292,"scale":500000,"startTileRow":2,"startTileCol":3,"endTileRow":9,"endTileCol":9},{"level":3,"resolution":66.1459656252646,"scale":250000,"startTileRow":5,"startTileCol":6,"endTileRow":19,"endTileCol":18},{"level":4,"resolution":26.458386250105836,"scale":100000,"startTileRow":12,"startTileCol":15,"endTileRow":48,"endTileCol":45},{"level":5,"resolution":13.229193125052918,"scale":50000,"startTileRow":25,"startTileCol":31,"endTileRow":96,"endTileCol":90},{"level":6,"resolution":6.614596562526459,"scale":25000,"startTileRow":50,"startTileCol":62,"endTileRow":192,"endTileCol":180},{"level":7,"resolution":3.9687579375158752,"scale":15000,"startTileRow":84,"startTileCol":103,"endTileRow":320,"endTileCol":300},{"level":8,"resolution":2.116670900008467,"scale":8000,"startTileRow":158,"startTileCol":193,"endTileRow":601,"endTileCol":562},{"level":9,"resolution":1.3229193125052918,"scale":5000,"startTileRow":253,"startTileCol":310,"endTileRow":962,"endTileCol":900},{"level":10,"resolution":0.6614596562526459,"scale":2500,"startTileRow":507,"startTileCol":620,"endTileRow":1925,"endTileCol":1801},{"level":11,"resolution":0.26458386250105836,"scale":1000,"startTileRow":1269,"startTileCol":1550,"endTileRow":4812,"endTileCol":4502},{"level":12,"resolution":0.13229193125052918,"scale":500,"startTileRow":2539,"startTileCol":3100,"endTileRow":9625,"endTileCol":9005},{"level":13,"resolution":0.06614596562526459,"scale":250,"startTileRow":5078,"startTileCol":6200,"endTileRow":19251,"endTileCol":18011}]'
-    #includeLegendStr = "true"
-
-    mapScale = -1
+if __name__ == "__main__":
+    requestStartTime = time.time()
+    jobState = "succeeded"
+    # layout and cancel requests skip the class count file and the output directory sweep
+    isGetLayoutsRequest = False
+    if settings.PROFILE_MAPPING_CALLS:
+        importPrintModules()
+        profileUtils.startMappingProfile()
     try:
-        if mapScaleStr:
-            mapScale = float(mapScaleStr)
-    except Exception as ex:
-        log("Unable to convert scale values to numbers.")
-
-    if formatStr is None or formatStr == "":
-        formatStr = settings.DEFAULT_FORMAT
-    formatStr = formatStr.lower()
-    if "." not in formatStr:
-        formatStr = "." + formatStr
-
-    quality = settings.DEFAULT_QUALITY
-    if qualityStr is not None and qualityStr != "":
+        configureModules()
+
+
+        # start processing request
+        log("Collecting parameters...")
+        fileUtils.resetMapDocIoCounts()
+
+        # first parameter (0) is return object
+        webmapJson = arcpy.GetParameterAsText(1)
+        templateStr = arcpy.GetParameterAsText(2)
+        layoutNameStr = arcpy.GetParameterAsText(3)
+        textElementsListJson = arcpy.GetParameterAsText(4)
+        formatStr = arcpy.GetParameterAsText(5)
+        qualityStr = arcpy.GetParameterAsText(6)
+        mapScaleStr = arcpy.GetParameterAsText(7)
+        elementVisibilityStr = arcpy.GetParameterAsText(8)
+        getLayoutsStr = arcpy.GetParameterAsText(9)
+        extentJson = arcpy.GetParameterAsText(10)
+        lodsJson = arcpy.GetParameterAsText(11)
+        includeLegendStr = arcpy.GetParameterAsText(12)
+
+        # layout requests are answered from the template catalogue without loading arcpy.mapping
+        # getlayouts "cancel" is a request to stop the print job whose id is given as the template
+        isCancelRequest = getLayoutsStr == "cancel"
+        isGetLayoutsRequest = (getLayoutsStr and getLayoutsStr == "true") or isCancelRequest
+        if not isGetLayoutsRequest:
+            importPrintModules()
+            mapUtils.clearMapDocListings()
+            # a process may have been idle since its last print, other processes sweep the gdbs of old conversions
+            mapUtils.releaseWebmapMapDocuments(settings.WEBMAP_CACHE_SECONDS)
+            fileUtils.loadClassCountCache(settings.SYMBOLOGY_CLASS_COUNT_CACHE_FILE)
+
+        ## DEBUG ##
+        #webmapJson = '{"mapOptions":{"showAttribution":true,"extent":{"xmin":1755268.0160213956,"ymin":5920584.470725218,"xmax":1755841.2937333588,"ymax":5920863.645027658,"spatialReference":{"wkid":2193,"latestWkid":2193}},"spatialReference":{"wkid":2193,"latestWkid":2193}},"operationalLayers":[{"id":"Light_1246","title":"Light_1246","opacity":1,"minScale":18489297.737236,"maxScale":1128.497176,"url":"https://s1-ts.cloud.eaglegis.co.nz/arcgis/rest/services/Canvas/Light/MapServer"},{"id":"Landbase_5000","title":"Landbase","opacity":1,"minScale":0,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Landbase/MapServer","visibleLayers":[1,2,3,4,5,6,7,8,9,10,11,12,13,15,16,17,19,20,21,22],"layers":[{"id":0,"showLegend":false}]},{"id":"Address_2359","title":"Address","opacity":1,"minScale":16000,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Address/MapServer","visibleLayers":[1,2],"showLegend":false},{"id":"Contours_4135","title":"Contours","opacity":1,"minScale":0,"maxScale":0,"url":"https://secure.gbs.co.nz/arcgis_anon/rest/services/Contours/MapServer","visibleLayers":[1,2,4,5,7,8,10,11,13,14,16,17,19,20,21,22,23],"layers":[{"id":5,"showLegend":false},{"id":2,"showLegend":false},{"id":8,"showLegend":false},{"id":17,"showLegend":false},{"id":20,"showLegend":false},{"id":14,"showLegend":false},{"id":11,"showLegend":false}]},{"id":"map_graphics","opacity":1,"minScale":0,"maxScale":0,"featureCollection":{"layers":[]}}]}'
+        #mapScaleStr = '20000'
+        #layoutNameStr = 'A4 Landscape'
+        #templateStr = 'Standard'
+        #qualityStr = '96'
+        #getLayoutsStr = "true"
+        #textElementsListJson = '{"title": "Davids", "legal": "CUStLegal", "VALUATIONREF": ""}'
+        #formatStr = "pdf"
+        #extentJson = ''
+        #lodsJson = '[{"level":0,"resolution":264.5838625010584,"scale":1000000,"startTileRow":1,"startTileCol":1,"endTileRow":4,"endTileCol":4},{"level":1,"resolution":201.08373550080435,"scale":760000,"startTileRow":1,"startTileCol":2,"endTileRow":6,"endTileCol":5},{"level":2,"resolution":132.2919312505292,"scale":500000,"startTileRow":2,"startTileCol":3,"endTileRow":9,"endTileCol":9},{"level":3,"resolution":66.1459656252646,"scale":250000,"startTileRow":5,"startTileCol":6,"endTileRow":19,"endTileCol":18},{"level":4,"resolution":26.458386250105836,"scale":100000,"startTileRow":12,"startTileCol":15,"endTileRow":48,"endTileCol":45},{"level":5,"resolution":13.229193125052918,"scale":50000,"startTileRow":25,"startTileCol":31,"endTileRow":96,"endTileCol":90},{"level":6,"resolution":6.614596562526459,"scale":25000,"startTileRow":50,"startTileCol":62,"endTileRow":192,"endTileCol":180},{"level":7,"resolution":3.9687579375158752,"scale":15000,"startTileRow":84,"startTileCol":103,"endTileRow":320,"endTileCol":300},{"level":8,"resolution":2.116670900008467,"scale":8000,"startTileRow":158,"startTileCol":193,"endTileRow":601,"endTileCol":562},{"level":9,"resolution":1.3229193125052918,"scale":5000,"startTileRow":253,"startTileCol":310,"endTileRow":962,"endTileCol":900},{"level":10,"resolution":0.6614596562526459,"scale":2500,"startTileRow":507,"startTileCol":620,"endTileRow":1925,"endTileCol":1801},{"level":11,"resolution":0.26458386250105836,"scale":1000,"startTileRow":1269,"startTileCol":1550,"endTileRow":4812,"endTileCol":4502},{"level":12,"resolution":0.13229193125052918,"scale":500,"startTileRow":2539,"startTileCol":3100,"endTileRow":9625,"endTileCol":9005},{"level":13,"resolution":0.06614596562526459,"scale":250,"startTileRow":5078,"startTileCol":6200,"endTileRow":19251,"endTileCol":18011}]'
+        #includeLegendStr = "true"
+
+        mapScale = -1
         try:
-            quality = int(qualityStr)
-        except Exception as parseEx:
-            log("Could not parse quality value \"" + qualityStr + "\" as an integer. Using default quality.")
-
-
-    webMapObj = None
-    if webmapJson is None or webmapJson == "":
-        webmapJson = "{}"
-    webMapObj = json.loads(webmapJson)
-
-    if textElementsListJson is None or textElementsListJson == "":
-        textElementsListJson = "{}"
-    textElementsList = json.loads(textElementsListJson)
-
-    extentObj = None
-    if extentJson != None and extentJson != "":
-        extentObj = json.loads(extentJson)
-
-    if layoutNameStr is None or layoutNameStr == "":
-        layoutNameStr = settings.DEFAULT_LAYOUT
-    if not ".mxd" in layoutNameStr.lower():
-        layoutNameStr += ".mxd"
-
-    lodsArray = []
-    if lodsJson:
-        lodsArray = json.loads(lodsJson)
-
-    # include legend by default
-    includeLegend = True
-    if includeLegendStr == "false":
-        includeLegend = False
-
-    outputFolder = settings.AGS_OUTPUT_DIRECTORY
-    outputFolderUrl = settings.AGS_VIRTUAL_OUTPUT_DIRECTORY
-
-    noLegendMxdNameSuffix = " no legend"
-
-    # templates may be requested as a singele string 'standard', or a json array '["standard", "LIM 1"]'
-    templateList = []
-    if templateStr.find("[") == 0:
-        templateList = json.loads(templateStr)
-    else:
-        templateList = [templateStr]
-
-    # just return the layout styles from the template folders - NOT producing a map export
-    if getLayoutsStr and getLayoutsStr == "true":
-
-        templatesOnDiskList = fileUtils.getFileNameList(settings.TEMPLATES_PATH, [], True)
-        resultObj["templates"] = templatesOnDiskList
-
-        if len(templateList) > 0:
-            template = templateList[0]
-            templateRootPath = path.join(settings.TEMPLATES_PATH, template)
-            layoutNameList = fileUtils.getLayoutNameList(templateRootPath)
-            layoutNameList = [a for a in layoutNameList if a.lower().find(noLegendMxdNameSuffix) < 0]
-            resultObj["layouts"] = layoutNameList
-
-    else:
-        # sign in to portal as an admin user so we have access to all webmap layers
-        if settings.PORTAL_USER:
-            log("Signing in to: " + settings.PORTAL_URL)
-            arcpy.SignInToPortal_server(settings.PORTAL_USER, settings.PORTAL_PASSWORD, settings.PORTAL_URL)
-
-        # process each file and combine
-        outFiles = []
-        for template in templateList:
-            templateRootPath = path.join(settings.TEMPLATES_PATH, template)
-            layoutItemLimit = mapUtils.getTemplateLegendItemLimit(settings.LEGEND_STYLE_TEMPLATE_LIMITS_CONFIG,
-                                                                  template, layoutNameStr)
-            generatedOutFiles = process(templateRootPath, layoutNameStr, outputFolder, formatStr, quality, mapScale, extentObj,
-                textElementsList, lodsArray, includeLegend, layoutItemLimit)
-            outFiles.extend(generatedOutFiles)
-        if len(outFiles) > 0:
-
-            log("Combining documents: " + str(outFiles))
-            finalFile = mapUtils.combineImageDocuments(outFiles, formatStr)
-            finalFileName = path.split(finalFile)[-1]
-
-            resultObj["url"] = outputFolderUrl + "/" + finalFileName
+            if mapScaleStr:
+                mapScale = float(mapScaleStr)
+        except Exception as ex:
+            log("Unable to convert scale values to numbers.")
+
+        if formatStr is None or formatStr == "":
+            formatStr = settings.DEFAULT_FORMAT
+        formatStr = formatStr.lower()
+        if "." not in formatStr:
+            formatStr = "." + formatStr
+
+        quality = settings.DEFAULT_QUALITY
+        if qualityStr is not None and qualityStr != "":
+            try:
+                quality = int(qualityStr)
+            except Exception as parseEx:
+                log("Could not parse quality value \"" + qualityStr + "\" as an integer. Using default quality.")
+
+
+        webMapObj = None
+        if webmapJson is None or webmapJson == "":
+            webmapJson = "{}"
+        webMapObj = json.loads(webmapJson)
+        webMapIndex = None
+        if not isGetLayoutsRequest:
+            # lookup tables for the webmap, searched for every layer when filtering legends
+            webMapIndex = mapUtils.parseWebmap(webMapObj)
+            # compile legend exclude / include layer settings once for the request
+            mapUtils.compileLegendNameFilter(settings.LEGEND_EXCLUDE_LAYERS, settings.LEGEND_INCLUDE_LAYERS)
+
+        if textElementsListJson is None or textElementsListJson == "":
+            textElementsListJson = "{}"
+        textElementsList = json.loads(textElementsListJson)
+
+        extentObj = None
+        if extentJson != None and extentJson != "":
+            extentObj = json.loads(extentJson)
+        # a list of extents is an atlas print, with a page for each extent
+        atlasPages = None
+        if not isGetLayoutsRequest:
+            atlasPages = mapUtils.getAtlasPages(extentObj)
+        if atlasPages is not None:
+            log("Atlas print of " + str(len(atlasPages)) + " extents")
+            extentObj = None
+            if not atlasPages:
+                raise Exception("No extents were given for the atlas print")
+
+        if layoutNameStr is None or layoutNameStr == "":
+            layoutNameStr = settings.DEFAULT_LAYOUT
+        if not ".mxd" in layoutNameStr.lower():
+            layoutNameStr += ".mxd"
+
+        lodsArray = []
+        if lodsJson and not isGetLayoutsRequest:
+            # sorted and validated once, every map doc of the request snaps to the same list
+            lodsArray = mapUtils.prepareLods(json.loads(lodsJson), log)
+
+        # include legend by default
+        includeLegend = True
+        if includeLegendStr == "false":
+            includeLegend = False
+
+        outputFolder = settings.AGS_OUTPUT_DIRECTORY
+        outputFolderUrl = settings.AGS_VIRTUAL_OUTPUT_DIRECTORY
+
+        # templates may be requested as a singele string 'standard', or a json array '["standard", "LIM 1"]'
+        templateList = []
+        if templateStr.find("[") == 0:
+            templateList = json.loads(templateStr)
         else:
-            raise Exception("No files were generated")
-
+            templateList = [templateStr]
+
+        # identical print requests are answered from the output cache
+        outputCacheKey = None
+        cachedFile = None
+        if not isGetLayoutsRequest and settings.OUTPUT_CACHE_TTL_SECONDS > 0:
+            outputCacheKey = fileUtils.getOutputCacheKey({
+                "webmap": fileUtils.normalizeWebmapForCache(webMapObj),
+                "templates": templateList,
+                "layout": layoutNameStr,
+                "textElements": textElementsList,
+                "format": formatStr,
+                "quality": quality,
+                "scale": mapScale,
+                "extent": extentObj,
+                "atlasPages": atlasPages,
+                "lods": lodsArray,
+                "includeLegend": includeLegend,
+                "imageMultipageOutput": settings.IMAGE_MULTIPAGE_OUTPUT
+            })
+            cachedFile = fileUtils.getCachedOutput(outputFolder, outputCacheKey, settings.OUTPUT_CACHE_TTL_SECONDS)
+
+        if isCancelRequest:
+            resultObj["cancelled"] = jobUtils.requestJobCancel(outputFolder, templateStr)
+            log("Cancel requested for print job " + templateStr + ": " + str(resultObj["cancelled"]))
+
+        # just return the layout styles from the template folders - NOT producing a map export
+        elif isGetLayoutsRequest:
+
+            templatesOnDiskList = fileUtils.getTemplateNameList(settings.TEMPLATES_PATH)
+            resultObj["templates"] = templatesOnDiskList
+
+            if len(templateList) > 0:
+                template = templateList[0]
+                templateRootPath = path.join(settings.TEMPLATES_PATH, template)
+                layoutNameList = fileUtils.getLayoutNameList(templateRootPath)
+                layoutNameList = [a for a in layoutNameList if a.lower().find(noLegendMxdNameSuffix) < 0]
+                resultObj["layouts"] = layoutNameList
+
+        elif cachedFile:
+            log("Returning cached print: " + cachedFile)
+            resultObj["url"] = outputFolderUrl + "/" + path.split(cachedFile)[-1]
+            resultObj["cached"] = True
 
+        else:
+            # progress is written to a status file named with the job id, see extended_print_job_utils
+            jobId = jobUtils.getJobId(arcpy.env.scratchFolder)
+            resultObj["jobId"] = jobId
+            jobUtils.startJob(outputFolder, jobId)
+
+            signInToPortal()
+
+            # process each file and combine
+            outFiles = []
+            workerCount = settings.PRINT_WORKER_PROCESSES
+
+            # images are delivered as a single file. unless they're zipped, only the first page is printed
+            pageLimit = None
+            if formatStr != ".pdf" and settings.IMAGE_MULTIPAGE_OUTPUT != "zip":
+                log("Only the first page is printed for " + formatStr + " output")
+                pageLimit = 1
+                templateList = templateList[:1]
+
+            printJobs = getPrintJobs(templateList, layoutNameStr, outputFolder, formatStr, quality, mapScale, extentObj,
+                                     textElementsList, lodsArray, includeLegend, webmapJson, workerCount > 1, pageLimit,
+                                     atlasPages)
+
+            workerResults = None
+            if workerCount > 1 and len(printJobs) > 1:
+                log("Processing " + str(len(printJobs)) + " print jobs in worker processes...")
+                # workers stop at their next page if the print is cancelled, but only the main process writes progress.
+                # the pages of each job are added as its worker finishes
+                for printJob in printJobs:
+                    printJob["jobId"] = jobId
+                jobUtils.setJobStage("printingInWorkers")
+                workerResults = parallelUtils.mapInProcessPool(processJobInWorker, printJobs, workerCount, log,
+                                                                 settings.WORKER_TIMEOUT_SECONDS, addWorkerJobPages)
+
+            if workerResults is None:
+                for printJob in printJobs:
+                    jobUtils.checkJobCancelled()
+                    generatedOutFiles = processJob(printJob, webMapIndex)
+                    outFiles.extend(generatedOutFiles)
+            else:
+                # results are in print job order. the files of every worker are registered before the first error
+                # is raised, so the pages of jobs after a failed one are still tidied up
+                for workerResult in workerResults:
+                    for message in workerResult["messages"]:
+                        arcpy.AddMessage(message)
+                    stageTimings.extend(workerResult["timings"])
+                    fileUtils.addMapDocIoCounts(workerResult["mapDocIo"])
+                    profileUtils.mergeMappingProfileReport(workerResult["mappingCalls"])
+                    legendEstimateChecks.extend(workerResult["legendEstimateChecks"])
+                    for workerArtifact in workerResult["artifacts"]:
+                        fileUtils.registerTempArtifact(workerArtifact)
+                for workerResult in workerResults:
+                    if workerResult["error"]:
+                        raise Exception(workerResult["error"])
+                    outFiles.extend(workerResult["files"])
+
+            if len(outFiles) > 0:
+
+                log("Combining documents: " + str(outFiles))
+                jobUtils.setJobStage("combining")
+                with timeStage("combine"):
+                    finalFile = mapUtils.combineImageDocuments(outFiles, formatStr, outputFolder)
+                if outputCacheKey:
+                    finalFile = fileUtils.storeCachedOutput(finalFile, outputCacheKey)
+                    fileUtils.evictOutputCache(outputFolder, settings.OUTPUT_CACHE_TTL_SECONDS, settings.OUTPUT_CACHE_MAX_MB)
+                if settings.LEGEND_PAGE_CACHE_TTL_SECONDS > 0:
+                    fileUtils.evictOutputCache(outputFolder, settings.LEGEND_PAGE_CACHE_TTL_SECONDS, settings.LEGEND_PAGE_CACHE_MAX_MB,
+                                               fileUtils.LEGEND_PAGE_CACHE_PREFIX)
+                finalFileName = path.split(finalFile)[-1]
+
+                # page files, clones and the webmap geodatabase are no longer needed
+                mapUtils.clearMapDocListings()
+                mapUtils.releaseWebmapMapDocuments(settings.WEBMAP_CACHE_SECONDS)
+                lockedArtifactCount = fileUtils.deleteTempArtifacts([finalFile])
+                if lockedArtifactCount > 0:
+                    log(str(lockedArtifactCount) + " temporary files are locked and will be removed later")
+
+                resultObj["url"] = outputFolderUrl + "/" + finalFileName
+                log("Map documents opened: " + str(fileUtils.mapDocIoCounts["opens"]) + ", saved: " + str(fileUtils.mapDocIoCounts["saves"]))
+                resultObj["mapDocIo"] = dict(fileUtils.mapDocIoCounts)
+            else:
+                raise Exception("No files were generated")
 
-except Exception as e:
-    log(e, True)
 
 
-finally:
-    resultObjJson = json.dumps(resultObj)
-    log("Result object: ")
-    log(resultObjJson)
-    arcpy.SetParameterAsText(0, resultObjJson)
+    except Exception as e:
+        if isinstance(e, jobUtils.JobCancelled) or jobUtils.isJobCancelled():
+            jobState = "cancelled"
+        else:
+            jobState = "failed"
+        log(e, True)
+
+
+    finally:
+        jobUtils.finishJob(jobState, resultObj.get("url"), resultObj["error"])
+        addStageTiming("total", int((time.time() - requestStartTime) * 1000))
+        resultObj["timings"] = stageTimings
+        if settings.PROFILE_MAPPING_CALLS and profileUtils is not None:
+            resultObj["mappingCalls"] = profileUtils.stopMappingProfile()
+        if settings.LEGEND_ESTIMATE_TEST_MODE:
+            matchCount = len([a for a in legendEstimateChecks if a["predictedOverflow"] == a["overflow"]])
+            resultObj["legendEstimates"] = {"checks": legendEstimateChecks, "matched": matchCount}
+        if settings.METRICS_LOG_FILE:
+            try:
+                writeMetrics(settings.METRICS_LOG_FILE, resultObj)
+            except Exception as e:
+                log("Unable to write metrics: " + str(e))
+
+        resultObjJson = json.dumps(resultObj)
+        log("Result object: ")
+        log(resultObjJson)
+        arcpy.SetParameterAsText(0, resultObjJson)
+
+        if mapUtils is not None:
+            mapUtils.clearMapDocListings()
+            mapUtils.releaseWebmapMapDocuments(settings.WEBMAP_CACHE_SECONDS)
+
+        if not isGetLayoutsRequest:
+            if not fileUtils.saveClassCountCache():
+                log("Unable to save symbology class counts to: " + settings.SYMBOLOGY_CLASS_COUNT_CACHE_FILE)
+
+            # remove old temporary files left by failed or interrupted prints
+            fileUtils.sweepOutputDirectory(settings.AGS_OUTPUT_DIRECTORY, settings.OUTPUT_SWEEP_MAX_AGE_HOURS * 3600,
+                                           settings.OUTPUT_SWEEP_MAX_MB, settings.OUTPUT_SWEEP_INTERVAL_SECONDS)
+
+        if settings.TEMPLATE_CATALOGUE_FILE_NAME:
+            catalogueFilePath = path.join(settings.AGS_OUTPUT_DIRECTORY, settings.TEMPLATE_CATALOGUE_FILE_NAME)
+            if not fileUtils.writeTemplateCatalogueFile(settings.TEMPLATES_PATH, catalogueFilePath, noLegendMxdNameSuffix):
+                log("Unable to write the template catalogue to: " + catalogueFilePath)
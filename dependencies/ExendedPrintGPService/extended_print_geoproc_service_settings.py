@@ -12,18 +12,68 @@
 # cannot use the root output dir as AGS does not allow saving there
 AGS_OUTPUT_DIRECTORY = r'D:\arcgisserver\directories\arcgisoutput\WidgetUtilities\Print_GPServer'
 
+# temporary files and old prints (names starting with "_ags_") are removed from the output directory once they are
+# older than this, or the oldest are removed once the directory is larger than OUTPUT_SWEEP_MAX_MB
+OUTPUT_SWEEP_MAX_AGE_HOURS = 24
+OUTPUT_SWEEP_MAX_MB = 2000
+# seconds between checks of the output directory by each service process
+OUTPUT_SWEEP_INTERVAL_SECONDS = 600
+
 # virtual dir, this will exist when the service has been run
 AGS_VIRTUAL_OUTPUT_DIRECTORY = 'https://maps.waimakariri.govt.nz/arcgis/rest/directories/arcgisoutput/WidgetUtilities/Print_GPServer'
 
+# template and layout names are written to this json file in the output directory after each request, so the widget
+# can list them from AGS_VIRTUAL_OUTPUT_DIRECTORY without starting a geoprocessing job, see templateCatalogueURL in
+# the widget config. the file is only rewritten when the templates change. "" turns it off
+TEMPLATE_CATALOGUE_FILE_NAME = "print_templates.json"
+
+# identical print requests within this many seconds return the file already printed. 0 turns the cache off
+OUTPUT_CACHE_TTL_SECONDS = 600
+
+# maximum size of cached prints kept in the output directory, the oldest are deleted first
+OUTPUT_CACHE_MAX_MB = 500
+
+# legend pages are reused for this many seconds by prints with the same legend layers, scale, format and quality
+# 0 turns the legend page cache off
+LEGEND_PAGE_CACHE_TTL_SECONDS = 3600
+
+# maximum size of cached legend pages kept in the output directory
+LEGEND_PAGE_CACHE_MAX_MB = 200
+
 # must match an mxd existing in the "TEMPLATE_LAYOUT_DIR_NAME" folder below
 DEFAULT_LAYOUT = "A4 landscape.mxd"
 
 # PDF, JPG, PNG
 DEFAULT_FORMAT = "PDF"
 
+# output for multi page prints (legends, several templates) in JPG or PNG format
+# "zip" returns a zip file of all pages, "first" returns the first page only and skips printing the others
+IMAGE_MULTIPAGE_OUTPUT = "first"
+
 # DPI value
 DEFAULT_QUALITY = 96
 
+# when the client sends the LODs of its tiled basemap, the print scale is snapped to one of them
+# "next-larger" - the next LOD scale out from the print scale, or the largest LOD scale (the original behaviour)
+# "next-smaller" - the LOD scale at or in from the print scale, or the smallest LOD scale
+# "nearest" - the closest LOD scale
+LOD_SNAP_POLICY = "next-larger"
+
+# optional file that the stage timings of every request are appended to, one JSON object per line
+# timings are always returned to the client in the "timings" property of the result
+METRICS_LOG_FILE = r""
+
+# count the arcpy.mapping calls made by each request and the functions making them, to find redundant calls
+# the report is returned in the "mappingCalls" property of the result and written to METRICS_LOG_FILE
+# wrapping every call adds a little overhead, leave this off in production
+PROFILE_MAPPING_CALLS = False
+
+# the webmap is converted to a map document once per request and shared by all templates
+# the converted map document is also kept for this many seconds for later prints of the same webmap by the same
+# server process. keep it below 600 seconds, the minimum age at which other processes sweep the webmap gdb
+# 0 converts the webmap again for every request
+WEBMAP_CACHE_SECONDS = 300
+
 # add a portal administrative user here if the print service needs to sign in on behalf of the user
 PORTAL_USER = ""
 PORTAL_PASSWORD = ""
@@ -34,6 +84,23 @@ PORTAL_URL = ""
 # <TEMPLATES_PATH>\Unitary Plan
 TEMPLATES_PATH = r"D:\PrintTemplates"
 
+# template folders are indexed once and cached by the service between requests
+# seconds to wait before checking the template folders for changes again
+TEMPLATE_CATALOGUE_CHECK_SECONDS = 30
+
+# number of worker processes used to print multiple templates, or the pages of templates with replacement layers,
+# at the same time. 0 or 1 prints each page in the service process, one after the other
+PRINT_WORKER_PROCESSES = 0
+
+# number of worker processes used to export the map and legend pages of a print at the same time
+# pages are saved to temporary mxds for the workers. 0 or 1 exports pages one after the other in the service process
+# worker processes can't start their own workers, so this has no effect on pages printed by PRINT_WORKER_PROCESSES
+EXPORT_WORKER_PROCESSES = 0
+
+# seconds to wait for print or export worker processes before stopping them and failing the print
+# keep this under the maximum time a client can use the service, set on the service in ArcGIS Server
+WORKER_TIMEOUT_SECONDS = 540
+
 # relative to TEMPLATES_PATH. contains layout mxds used for printing
 TEMPLATE_LAYOUT_DIR_NAME = "layouts"
 
@@ -103,6 +170,26 @@ LEGEND_TEMPLATE_CONFIG = [
         "mxd": "LegendA3"
 }]
 
+# when a layout has an item limit below, the legend size is estimated from the webmap's legendCount and
+# cached layer class counts, and a legend estimated to overflow is printed on a second page without
+# checking it in arcpy. set LEGEND_ESTIMATE_TEST_MODE to always run the arcpy check and return how often
+# the estimate agreed with it in the "legendEstimates" property of the result
+LEGEND_ESTIMATE_TEST_MODE = False
+
+# the legend estimate has to be over the layout's item limit by this fraction of the limit before the arcpy check
+# is skipped, e.g. 0.2 with a limit of 30 items skips the check above 36 items. estimates closer to the limit are
+# checked in arcpy as they were before the estimate
+LEGEND_ESTIMATE_OVERFLOW_MARGIN = 0.2
+
+# legend class counts of unique value layers are saved to this file, keyed by service url, sublayer and data source,
+# so arcpy only reads a layer's symbology once. the file is shared by all server processes and reread when it changes
+# leave empty to only keep the counts in memory
+# don't put it in TEMPLATES_PATH or a template folder, saving it changes the folder's modified time, which makes
+# every server process walk the templates again, see TEMPLATE_CATALOGUE_CHECK_SECONDS
+SYMBOLOGY_CLASS_COUNT_CACHE_FILE = r"D:\PrintCache\symbology_class_counts.json"
+# counts older than this are read from the layer again, e.g. after a map service has been republished
+SYMBOLOGY_CLASS_COUNT_MAX_AGE_HOURS = 24
+
 # match the layout structures from the
 # TEMPLATES_PATH
 LEGEND_STYLE_TEMPLATE_LIMITS_CONFIG = {
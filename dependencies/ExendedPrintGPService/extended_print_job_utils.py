@@ -0,0 +1,145 @@
+# helper functions to report the progress of Auckland Council 10.2 print service jobs
+#
+# while a print runs, its progress is written to _ags_job_<job id>.json in the output directory, where the widget
+# can poll it through the virtual output directory. creating _ags_job_<job id>.cancel next to it stops the print
+# at the next page. the widget asks for this with a cancel request, see requestJobCancel
+#
+from os import path, remove, rename, getpid
+from datetime import datetime
+import json
+import re
+import uuid
+
+JOB_FILE_PREFIX = "_ags_job_"
+
+# the job of the current request, see startJob
+_currentJob = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def getJobId(scratchFolder):
+    # on ArcGIS Server the scratch folder is <jobs directory>\<service>\<job id>\scratch, so the status file
+    # uses the job id the client was given when submitting the job. elsewhere a new id is made up
+    if scratchFolder:
+        jobFolder = path.dirname(path.normpath(scratchFolder))
+        if path.basename(path.normpath(scratchFolder)).lower() == "scratch" and path.basename(jobFolder):
+            return path.basename(jobFolder)
+    return uuid.uuid4().hex
+
+
+def getJobStatusPath(outputFolder, jobId):
+    return path.join(outputFolder, JOB_FILE_PREFIX + jobId + ".json")
+
+
+def getJobCancelPath(outputFolder, jobId):
+    return path.join(outputFolder, JOB_FILE_PREFIX + jobId + ".cancel")
+
+
+def isValidJobId(jobId):
+    # job ids are used in file names, so only ids made by ArcGIS Server or getJobId are accepted
+    return bool(jobId) and re.match(r"^[A-Za-z0-9_-]+$", jobId) is not None
+
+
+def requestJobCancel(outputFolder, jobId):
+    # creates the cancel file of a running job, from a separate cancel request
+    # returns False if the job isn't known or has already finished
+    if not isValidJobId(jobId):
+        return False
+    try:
+        statusFile = open(getJobStatusPath(outputFolder, jobId), "r")
+        try:
+            status = json.load(statusFile)
+        finally:
+            statusFile.close()
+        if status.get("state") != "running":
+            return False
+        open(getJobCancelPath(outputFolder, jobId), "w").close()
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+
+def startJob(outputFolder, jobId, writeStatus = True):
+    # writeStatus is off in worker processes, they only check for cancellation and the main process reports progress
+    global _currentJob
+    _currentJob = {
+        "statusPath": getJobStatusPath(outputFolder, jobId),
+        "cancelPath": getJobCancelPath(outputFolder, jobId),
+        "writeStatus": writeStatus,
+        "status": {"jobId": jobId, "state": "running", "stage": "started", "pagesExported": 0, "pageCount": 0}
+    }
+    _writeJobStatus()
+    return _currentJob["status"]
+
+
+def _writeJobStatus():
+    # progress is best effort, a print isn't stopped because the status file couldn't be written
+    if _currentJob is None or not _currentJob["writeStatus"]:
+        return
+    _currentJob["status"]["updated"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    statusPath = _currentJob["statusPath"]
+    tempStatusPath = statusPath + "." + str(getpid()) + ".tmp"
+    try:
+        statusFile = open(tempStatusPath, "w")
+        try:
+            json.dump(_currentJob["status"], statusFile)
+        finally:
+            statusFile.close()
+        if path.exists(statusPath):
+            remove(statusPath)
+        rename(tempStatusPath, statusPath)
+    except (IOError, OSError):
+        pass
+
+
+def setJobStage(stage):
+    if _currentJob is not None:
+        _currentJob["status"]["stage"] = stage
+        _writeJobStatus()
+
+
+def addJobPages(pageCount):
+    # pages are added as each template's pages are known, so the total can grow while the print runs
+    if _currentJob is not None:
+        _currentJob["status"]["pageCount"] += pageCount
+        _writeJobStatus()
+
+
+def jobPageExported(pageCount = 1):
+    if _currentJob is not None:
+        _currentJob["status"]["pagesExported"] += pageCount
+        _currentJob["status"]["stage"] = "exporting"
+        _writeJobStatus()
+
+
+def isJobCancelled():
+    return _currentJob is not None and path.exists(_currentJob["cancelPath"])
+
+
+def checkJobCancelled():
+    # raises JobCancelled if the job's cancel file has been created, called between pages
+    if isJobCancelled():
+        raise JobCancelled("Print cancelled")
+
+
+def finishJob(state, url = None, error = None):
+    # state is "succeeded", "failed" or "cancelled"
+    global _currentJob
+    if _currentJob is None:
+        return
+    _currentJob["status"]["state"] = state
+    _currentJob["status"]["stage"] = "finished"
+    if url:
+        _currentJob["status"]["url"] = url
+    if error:
+        _currentJob["status"]["error"] = error
+    _writeJobStatus()
+    try:
+        if _currentJob["writeStatus"] and path.exists(_currentJob["cancelPath"]):
+            remove(_currentJob["cancelPath"])
+    except OSError:
+        pass
+    _currentJob = None
@@ -5,21 +5,200 @@ from os import path, listdir
 from os.path import join
 from arcpy import mapping
 import uuid
+import re
+import bisect
+import time
+import zipfile
 import extended_print_geoproc_service_settings as settings
+import extended_print_file_utils as fileUtils
+
+# optional, PyPDF2 combines pdf pages into a new file in one pass
+# if it isn't installed, arcpy's PDFDocument is used
+try:
+    from PyPDF2 import PdfMerger
+except ImportError:
+    try:
+        from PyPDF2 import PdfFileMerger as PdfMerger
+    except ImportError:
+        PdfMerger = None
+
+# legend include/exclude name filter for the current request, see compileLegendNameFilter
+_legendNameFilter = None
+
+# converted webmaps by hash of the webmap json, each is {"mapDoc": map document, "gdb": graphics gdb, "converted": time}
+# shared by all templates of a request and kept for later requests, see getWebmapMapDocument
+_convertedWebmaps = {}
+
+# sorted scales of the last LOD list snapped to, {"lods": lod list, "scales": [scale, ...]}, see getLodScales
+_lodScales = {"lods": None, "scales": []}
+
+# data frame, layer and layout element listings of the map documents used by the current request
+# {id(mapDoc): {"mapDoc": mapDoc, "listings": {listingKey: list}}}, see listDataFrames, listLayers and listLayoutElements
+_mapDocListings = {}
+# id(dataFrame) -> id(mapDoc) for the data frames returned by listDataFrames
+_dataFrameMapDocIds = {}
+
+
+def clearMapDocListings():
+    # the listings hold references to their map documents, so clear them before temporary mxds are deleted
+    # and at the start of each request, converted webmap map documents are reused between requests
+    _mapDocListings.clear()
+    _dataFrameMapDocIds.clear()
+
+
+def _getMapDocListings(mapDoc):
+    mapDocEntry = _mapDocListings.get(id(mapDoc))
+    if mapDocEntry is None or mapDocEntry["mapDoc"] is not mapDoc:
+        mapDocEntry = {"mapDoc": mapDoc, "listings": {}}
+        _mapDocListings[id(mapDoc)] = mapDocEntry
+    return mapDocEntry
+
+
+def _getListing(mapDoc, listingKey, listFunction, *listArgs):
+    # returns a copy of the cached listing, so callers can change the list they're given
+    # listFunction(*listArgs) lists the map document when it isn't cached
+    mapDocEntry = _getMapDocListings(mapDoc)
+    listing = mapDocEntry["listings"].get(listingKey)
+    if listing is None:
+        listing = listFunction(*listArgs)
+        mapDocEntry["listings"][listingKey] = listing
+    return list(listing)
+
+
+def listDataFrames(mapDoc, wildcard = None):
+    # mapping.ListDataFrames, listed once per map document
+    dataFrames = _getListing(mapDoc, ("dataFrames", wildcard), mapping.ListDataFrames, mapDoc, wildcard)
+    for dataFrame in dataFrames:
+        _dataFrameMapDocIds[id(dataFrame)] = id(mapDoc)
+    return dataFrames
+
+
+def listLayers(mapDoc, wildcard = None, dataFrame = None):
+    # mapping.ListLayers, listed again after layers are added, inserted or removed through the functions below
+    dataFrameId = id(dataFrame) if dataFrame else None
+    return _getListing(mapDoc, ("layers", wildcard, dataFrameId), mapping.ListLayers, mapDoc, wildcard, dataFrame)
+
+
+def listLayoutElements(mapDoc, elementType = None, wildcard = None):
+    # mapping.ListLayoutElements, listed once per map document
+    return _getListing(mapDoc, ("layoutElements", elementType, wildcard), mapping.ListLayoutElements,
+                       mapDoc, elementType, wildcard)
+
+
+def _invalidateLayerListings(dataFrame):
+    # layer listings of the data frame's map document are out of date
+    # if the data frame wasn't returned by listDataFrames, its map document is unknown so all are dropped
+    mapDocId = _dataFrameMapDocIds.get(id(dataFrame))
+    if mapDocId in _mapDocListings:
+        mapDocEntries = [_mapDocListings[mapDocId]]
+    else:
+        mapDocEntries = list(_mapDocListings.values())
+    for mapDocEntry in mapDocEntries:
+        listings = mapDocEntry["listings"]
+        for listingKey in list(listings.keys()):
+            if listingKey[0] == "layers":
+                del listings[listingKey]
+
+
+def addLayer(dataFrame, layer, position = "AUTO_ARRANGE"):
+    mapping.AddLayer(dataFrame, layer, position)
+    _invalidateLayerListings(dataFrame)
+
+
+def insertLayer(dataFrame, referenceLayer, layer, position = "BEFORE"):
+    mapping.InsertLayer(dataFrame, referenceLayer, layer, position)
+    _invalidateLayerListings(dataFrame)
+
+
+def removeLayer(dataFrame, layer):
+    mapping.RemoveLayer(dataFrame, layer)
+    _invalidateLayerListings(dataFrame)
+
+
+def getTextElementIndex(mapDoc):
+    # text elements of the map doc by lower case name, built once per map doc
+    # where several elements share a name, the first one listed is used
+    mapDocEntry = _getMapDocListings(mapDoc)
+    textElementIndex = mapDocEntry["listings"].get(("textElementIndex",))
+    if textElementIndex is None:
+        textElementIndex = {}
+        for mapTextElement in listLayoutElements(mapDoc, "TEXT_ELEMENT"):
+            textElementIndex.setdefault(mapTextElement.name.lower(), mapTextElement)
+        mapDocEntry["listings"][("textElementIndex",)] = textElementIndex
+    return textElementIndex
+
+
+def _getTextElementValues(textElementDict):
+    # client keys in lower case, with empty values replaced by a space so the element is cleared
+    textElementValues = {}
+    for key, value in textElementDict.items():
+        #value = value.encode('ascii','ignore')
+        if value is None or value == "":
+            value = " "
+        textElementValues.setdefault(key.lower(), value)
+    return textElementValues
 
 
 def processTextElements(mapDoc, textElementDict):
     # iterates through a dictionary provided by client
     # if an item key matches an element name in mxd, set text to the item value
-    mapTextElements = mapping.ListLayoutElements(mapDoc, "TEXT_ELEMENT")
-    for key, value in textElementDict.items():
-        for mapTextElement in mapTextElements:
-            if mapTextElement.name.lower() == key.lower():
-                #value = value.encode('ascii','ignore')
-                if value is None or value == "":
-                    value = " "
+    processTextElementsForPages([mapDoc], textElementDict)
+
+
+def processTextElementsForPages(mapDocList, textElementDict):
+    # sets the same client text on every map doc of a multi-page print
+    textElementValues = _getTextElementValues(textElementDict)
+    for mapDoc in mapDocList:
+        textElementIndex = getTextElementIndex(mapDoc)
+        for key, value in textElementValues.items():
+            mapTextElement = textElementIndex.get(key)
+            if mapTextElement is not None:
                 mapTextElement.text = value
-                break
+
+
+class WebmapIndex(object):
+    # lookup tables for a webmap object, see parseWebmap
+
+    def __init__(self, webmap):
+        self.webmap = webmap
+        # operational layer objects by id or title, first match in webmap order wins
+        self.layers = {}
+        # per operational layer, ids of sublayers with showLegend set to false
+        self.hiddenLegendSublayers = {}
+
+
+def parseWebmap(webmap):
+    # builds lookup tables for a webmap object once per request
+    # the legend and substitution functions search the webmap for every layer, a linear scan each time is slow
+    # for webmaps with many operational layers and map service sublayers
+
+    webmapIndex = WebmapIndex(webmap)
+
+    jsonOperLayerObjs = []
+    if webmap and "operationalLayers" in webmap:
+        jsonOperLayerObjs = webmap["operationalLayers"]
+
+    for jsonOperLayerObj in jsonOperLayerObjs:
+        if "id" in jsonOperLayerObj and jsonOperLayerObj["id"] not in webmapIndex.layers:
+            webmapIndex.layers[jsonOperLayerObj["id"]] = jsonOperLayerObj
+        if "title" in jsonOperLayerObj and jsonOperLayerObj["title"] not in webmapIndex.layers:
+            webmapIndex.layers[jsonOperLayerObj["title"]] = jsonOperLayerObj
+
+        hiddenSublayers = set()
+        if "layers" in jsonOperLayerObj:
+            for layerVisObj in jsonOperLayerObj["layers"]:
+                if "showLegend" in layerVisObj and layerVisObj["showLegend"] == False:
+                    hiddenSublayers.add(layerVisObj["id"])
+        webmapIndex.hiddenLegendSublayers[id(jsonOperLayerObj)] = hiddenSublayers
+
+    return webmapIndex
+
+
+def _getWebmapIndex(webmap):
+    # the webmap functions are given the index created by parseWebmap, parsing a raw webmap on every call is slow
+    if not isinstance(webmap, WebmapIndex):
+        raise Exception("Webmap has not been indexed, see parseWebmap")
+    return webmap
 
 
 def _getParentOperationalLayerObject(webmap, longLayerId, logFunction = None):
@@ -33,23 +212,15 @@ def _getOperationalLayerObject(webmap, layerId, logFunction = None):
     if logFunction:
         logFunction("_getOperationalLayerObject: Searching webmap JSON for match: " + layerId)
 
-    resultObj = None
-    jsonOperLayerObjs = webmap["operationalLayers"]
-    for jsonOperLayerObj in jsonOperLayerObjs:
-        jsonObjLayerId = jsonOperLayerObj["id"]
+    webmapIndex = _getWebmapIndex(webmap)
+    return webmapIndex.layers.get(layerId)
 
-        jsonObjLayerTitle = None
-        if "title" in jsonOperLayerObj:
-            jsonObjLayerTitle = jsonOperLayerObj["title"]
 
-        if layerId == jsonObjLayerId:
-            resultObj = jsonOperLayerObj
-            break
-        elif layerId == jsonObjLayerTitle:
-            resultObj = jsonOperLayerObj
-            break
-
-    return resultObj
+def _isSublayerHiddenFromLegend(webmap, operLayerObj, layerIndexInt):
+    # true if the map service sublayer has showLegend set to false in the webmap
+    webmapIndex = _getWebmapIndex(webmap)
+    hiddenSublayers = webmapIndex.hiddenLegendSublayers.get(id(operLayerObj), set())
+    return layerIndexInt in hiddenSublayers
 
 
 def _getVisibleLayersFromIdInWebmap(webmap, layerId):
@@ -182,10 +353,64 @@ def getAddLayers(subLayers, visLayerArray):
     return returnLayers
 
 
+def _compileLayerNameMatcher(nameMatchList, allowLeadingWildcard):
+    # exact names go in a set, wildcard items are matched anywhere in the layer name through one regex
+    # wildcard (*) is supported at end of item, and at start of item if allowLeadingWildcard is set
+    exactNames = set()
+    containsList = []
+    for nameMatch in nameMatchList:
+        if not nameMatch:
+            continue
+        if nameMatch[-1] == "*":
+            containsList.append(nameMatch[:-1])
+        elif allowLeadingWildcard and nameMatch[0] == "*":
+            containsList.append(nameMatch[1:])
+        else:
+            exactNames.add(nameMatch)
+
+    containsRegex = None
+    if containsList:
+        containsRegex = re.compile("|".join([re.escape(a) for a in containsList]))
+
+    return {"exact": exactNames, "contains": containsRegex}
+
+
+def _matchLayerName(matcher, layerName):
+    if layerName in matcher["exact"]:
+        return True
+    if matcher["contains"] and matcher["contains"].search(layerName):
+        return True
+    return False
+
+
+def compileLegendNameFilter(excludeLayers, includeLayers):
+    # compiles the legend exclude and include settings once per request
+    # decisions are memoized per layer name, legend passes see the same layers several times
+    global _legendNameFilter
+
+    _legendNameFilter = {
+        "exclude": _compileLayerNameMatcher(excludeLayers, True),
+        "include": _compileLayerNameMatcher(includeLayers, False),
+        "decisions": {}
+    }
+    return _legendNameFilter
+
+
+def _getLegendNameDecision(layerName):
+    # returns (excluded, included) for a layer name, based on the print config
+    nameFilter = _legendNameFilter
+    if nameFilter is None:
+        nameFilter = compileLegendNameFilter(settings.LEGEND_EXCLUDE_LAYERS, settings.LEGEND_INCLUDE_LAYERS)
+
+    decision = nameFilter["decisions"].get(layerName)
+    if decision is None:
+        decision = (_matchLayerName(nameFilter["exclude"], layerName), _matchLayerName(nameFilter["include"], layerName))
+        nameFilter["decisions"][layerName] = decision
+    return decision
+
+
 def _includeLayerInLegend(legendAddLayer, layerIndexInt, webmapObj, logFunction):
 
-    excludeLayers = settings.LEGEND_EXCLUDE_LAYERS
-    includeLayers = settings.LEGEND_INCLUDE_LAYERS
     excludeRasters = settings.LEGEND_EXCLUDE_RASTERS
     excludeBasemaps = settings.LEGEND_EXCLUDE_BASEMAPS
 
@@ -242,68 +467,28 @@ def _includeLayerInLegend(legendAddLayer, layerIndexInt, webmapObj, logFunction)
             logFunction("RemoveLayers: Map service layer excluded in webmap setting: " + legendAddLayer.longName)
             shouldAdd = False
     elif parentLayerWebmapObj:
-        if "layers" in parentLayerWebmapObj:
-            for layerVisObj in parentLayerWebmapObj["layers"]:
-                if layerVisObj["id"] == layerIndexInt:
-                    if "showLegend" in layerVisObj and layerVisObj["showLegend"] == False:
-                        logFunction("RemoveLayers: Sublayer excluded in webmap setting: " + legendAddLayer.longName)
-                        shouldAdd = False
-
-    for excludeNameMatch in excludeLayers:
-        if excludeNameMatch == legendAddLayer.name:
-            logFunction("RemoveLayers: Layer excluded through print config: " + legendAddLayer.name)
+        if _isSublayerHiddenFromLegend(webmapObj, parentLayerWebmapObj, layerIndexInt):
+            logFunction("RemoveLayers: Sublayer excluded in webmap setting: " + legendAddLayer.longName)
             shouldAdd = False
-            break
-        elif excludeNameMatch[-1] == "*":
-            match = "".join(excludeNameMatch[:-1])
-            if legendAddLayer.name.find(match) > -1:
-                # wildcard match found
-                logFunction("RemoveLayers: Layer excluded through print config: " + legendAddLayer.name)
-                shouldAdd = False
-                break
-        elif excludeNameMatch[0] == "*":
-            match = "".join(excludeNameMatch[1:])
-            if legendAddLayer.name.find(match) > -1:
-                # wildcard match found
-                logFunction("RemoveLayers: Layer excluded through print config: " + legendAddLayer.name)
-                shouldAdd = False
-                break
-
 
+    nameExcluded, nameIncluded = _getLegendNameDecision(legendAddLayer.name)
+    if nameExcluded:
+        logFunction("RemoveLayers: Layer excluded through print config: " + legendAddLayer.name)
+        shouldAdd = False
 
     # finally check settings for layers to include by name
     # needs to be last as should take precedence over other logic
-    for includeNameMatch in includeLayers:
-        if includeNameMatch == legendAddLayer.name:
-            logFunction("RemoveLayers: Layer INCLUDED through config: " + legendAddLayer.name)
-            shouldAdd = True
-            break
-        elif includeNameMatch[-1] == "*":
-            match = "".join(includeNameMatch[:-1])
-            if legendAddLayer.name.find(match) > -1:
-                # wildcard match found
-                logFunction("RemoveLayers: Layer INCLUDED through config: " + legendAddLayer.name)
-                shouldAdd = True
-                break
+    if nameIncluded:
+        logFunction("RemoveLayers: Layer INCLUDED through config: " + legendAddLayer.name)
+        shouldAdd = True
 
     return shouldAdd
 
 
-def removeLayers(mapDoc, removeFromLegendOnly, excludeLayers, removeRasters, webmapObj, logFunction):
-
-
-    logFunction("RemoveLayers: Removing raster layers and exclude layers")
-    logFunction("Exclude layer settings:")
-    logFunction(excludeLayers)
-    dataFrame = mapping.ListDataFrames(mapDoc)[0]
-    mapDocLayers = mapping.ListLayers(mapDoc, None, dataFrame)
-
-    # if removeFromLegendOnly is true, only remove from legend. Otherwise remove from map.
-    legendElement = None
-    try:
-        legendElement = mapping.ListLayoutElements(mapDoc, "LEGEND_ELEMENT", "Legend")[0]
-    except:
-        pass
+def _listLegendLayers(mapDocLayers, webmapObj, logFunction, legendVerdicts):
+    # yields each layer with whether it's kept in the legend, a layer is left out when it's excluded itself,
+    # see _includeLayerInLegend, or its map service or group layer is excluded
+    # legendVerdicts is a dictionary of (layer longName, layer index) -> include in legend, see removeLayers
 
     # layer index of -1 is a map service layer
     layerIndex = -1
@@ -331,7 +516,12 @@ def removeLayers(mapDoc, removeFromLegendOnly, excludeLayers, removeRasters, web
             lastGroupLayer = legendAddLayer
             lastGroupLayerIncluded = True
 
-        shouldAdd = _includeLayerInLegend(legendAddLayer, layerIndex, webmapObj, logFunction)
+        verdictKey = (legendAddLayer.longName, layerIndex)
+        if verdictKey in legendVerdicts:
+            shouldAdd = legendVerdicts[verdictKey]
+        else:
+            shouldAdd = _includeLayerInLegend(legendAddLayer, layerIndex, webmapObj, logFunction)
+            legendVerdicts[verdictKey] = shouldAdd
 
         if mapServiceName and shouldAdd is False:
             lastMapServiceParentIncluded = False
@@ -344,8 +534,37 @@ def removeLayers(mapDoc, removeFromLegendOnly, excludeLayers, removeRasters, web
             if not lastGroupLayerIncluded:
                 excludeBecauseOfGroupLayer = True
 
+        yield legendAddLayer, not (shouldAdd is False or lastMapServiceParentIncluded is False or excludeBecauseOfGroupLayer)
+
+        layerIndex += 1
+
+
+def removeLayers(mapDoc, removeFromLegendOnly, excludeLayers, removeRasters, webmapObj, logFunction, legendVerdicts = None):
+    # legendVerdicts is an optional dictionary of (layer longName, layer index) -> include in legend
+    # pass the same dictionary for every legend of an output map so each layer is only evaluated once
+    # the layer index is part of the key as sublayers of a service can share a long name
+
+    logFunction("RemoveLayers: Removing raster layers and exclude layers")
+    if legendVerdicts is None:
+        legendVerdicts = {}
+    else:
+        logFunction("RemoveLayers: Reusing " + str(len(legendVerdicts)) + " legend decisions")
+    logFunction("Exclude layer settings:")
+    logFunction(excludeLayers)
+    dataFrame = listDataFrames(mapDoc)[0]
+    mapDocLayers = listLayers(mapDoc, None, dataFrame)
+
+    # if removeFromLegendOnly is true, only remove from legend. Otherwise remove from map.
+    legendElement = None
+    try:
+        legendElement = listLayoutElements(mapDoc, "LEGEND_ELEMENT", "Legend")[0]
+    except:
+        pass
+
+    for legendAddLayer, isInLegend in _listLegendLayers(mapDocLayers, webmapObj, logFunction, legendVerdicts):
+
         # remove from mxd
-        if shouldAdd is False or lastMapServiceParentIncluded is False or excludeBecauseOfGroupLayer:
+        if not isInLegend:
             if removeFromLegendOnly:
                 try:
                     legendElement.removeItem(legendAddLayer)
@@ -353,44 +572,114 @@ def removeLayers(mapDoc, removeFromLegendOnly, excludeLayers, removeRasters, web
                     logFunction("RemoveLayers: Unable to remove layer from legend: " + legendAddLayer.name)
 
             else:
-                mapping.RemoveLayer(dataFrame, legendAddLayer)
+                removeLayer(dataFrame, legendAddLayer)
 
-        layerIndex += 1
 
 ## test if legend has overflowed through arcpy function and height check
 def isLegendOverflowing(mapDoc, logFunction):
 
-    legendElement = mapping.ListLayoutElements(mapDoc, "LEGEND_ELEMENT", "Legend")[0]
+    legendElement = listLayoutElements(mapDoc, "LEGEND_ELEMENT", "Legend")[0]
     logFunction("legendElement.isOverflowing: " + str(legendElement.isOverflowing))
     return legendElement.isOverflowing
     
 
 
+def _getLayerSource(legendAddLayer):
+    # service url and data source of a layer, empty strings where the layer has none
+    serviceUrl = ""
+    dataSource = ""
+    try:
+        if legendAddLayer.supports("SERVICEPROPERTIES"):
+            serviceUrl = legendAddLayer.serviceProperties.get("URL", "")
+        if legendAddLayer.supports("DATASOURCE"):
+            dataSource = legendAddLayer.dataSource
+    except Exception as ex:
+        pass
+    return serviceUrl, dataSource
+
+
+def _getLayerClassCountKey(legendAddLayer):
+    # service url, sublayer path within the service and data source
+    # the root of the long name is the webmap layer id, which changes between prints, so it's left out
+    serviceUrl, dataSource = _getLayerSource(legendAddLayer)
+    if not serviceUrl and not dataSource:
+        return None
+
+    sublayerPath = ""
+    if "\\" in legendAddLayer.longName:
+        sublayerPath = legendAddLayer.longName.split("\\", 1)[1]
+    return "|".join([serviceUrl, sublayerPath, dataSource])
+
+
+def getLayerClassCount(legendAddLayer):
+    # number of classes in a unique values layer's legend, 0 for other layers
+    # reading symbology.classValues is slow through arcpy, so counts are kept in the class count cache,
+    # see SYMBOLOGY_CLASS_COUNT_CACHE_FILE
+    try:
+        # most layers used at AC are "UNIQUE_VALUES" or "OTHER"
+        if legendAddLayer.symbologyType != "UNIQUE_VALUES":
+            return 0
+        layerKey = _getLayerClassCountKey(legendAddLayer)
+        classCount = fileUtils.getCachedClassCount(layerKey) if layerKey else None
+        if classCount is None:
+            classCount = len(legendAddLayer.symbology.classValues)
+            if layerKey:
+                fileUtils.storeClassCount(layerKey, classCount)
+        return classCount
+    except Exception as ex:
+        return 0
+
+
 def getSwatchCount(layers, logFunction):
 
     legendItemCount = 0
     for legendAddLayer in layers:
         # count number of items in legend, approximate
         if not legendAddLayer.isGroupLayer and legendAddLayer.visible:
-            legendItemCount += 1
-            try:
-                # most layers used at AC are "UNIQUE_VALUES" or "OTHER"
-                if legendAddLayer.symbologyType == "UNIQUE_VALUES":
-                    symVals = legendAddLayer.symbology.classValues
-                    legendItemCount = legendItemCount + len(symVals)
-            except Exception as ex:
-                pass
+            legendItemCount += 1 + getLayerClassCount(legendAddLayer)
     return legendItemCount
 
+
+def estimateLegendItemCount(mapDoc, webmap, logFunction, legendVerdicts = None):
+    # estimates the legend size of a map doc before it's cloned for the legend
+    # layers are left out as removeLayers leaves them out of the legend, pass the same legendVerdicts to
+    # getMapDocForLegend so they're only decided once. map services with a client side legendCount use it,
+    # other layers are counted with getSwatchCount
+    if legendVerdicts is None:
+        legendVerdicts = {}
+    legendItemCount = 0
+    clientCountedLayerId = None
+    for legendAddLayer, isInLegend in _listLegendLayers(listLayers(mapDoc), webmap, logFunction, legendVerdicts):
+        rootLayerId = legendAddLayer.longName.split("\\")[0]
+        if not isInLegend or rootLayerId == clientCountedLayerId:
+            continue
+
+        layerWebmapObj = _getOperationalLayerObject(webmap, rootLayerId)
+        if layerWebmapObj and "legendCount" in layerWebmapObj:
+            legendItemCount += int(layerWebmapObj["legendCount"])
+            clientCountedLayerId = rootLayerId
+            continue
+
+        legendItemCount += getSwatchCount([legendAddLayer], logFunction)
+
+    return legendItemCount
+
+
+def predictLegendOverflow(estimatedItemCount, layoutItemLimit):
+    # True or False when the layout has an item limit in LEGEND_STYLE_TEMPLATE_LIMITS_CONFIG, otherwise None
+    if layoutItemLimit is None or layoutItemLimit < 0:
+        return None
+    return estimatedItemCount > layoutItemLimit
+
 # calculation of legend count wass made on client side, is in operationalLayers
 def getSwatchCountFromWebmap(webmap, logFunction):
 
     legendItemCount = 0
 
-    jsonOperLayerObjs = webmap["operationalLayers"]
+    jsonOperLayerObjs = _getWebmapIndex(webmap).webmap["operationalLayers"]
     for jsonOperLayerObj in jsonOperLayerObjs:
-        if jsonOperLayerObj.has_key('legendCount'):
-            if not jsonOperLayerObj.has_key('showLegend') or jsonOperLayerObj['showLegend'] == True:
+        if 'legendCount' in jsonOperLayerObj:
+            if 'showLegend' not in jsonOperLayerObj or jsonOperLayerObj['showLegend'] == True:
                 logFunction(str(jsonOperLayerObj['id']) + ' clientItemCount : ' + str(jsonOperLayerObj['legendCount']))
                 legendItemCount += int(jsonOperLayerObj['legendCount'])
     return legendItemCount
@@ -399,8 +688,8 @@ def substituteLayers(mapDoc, webmap, substitutePath, substituteAlternatives, log
     # for map and legend quality, substitute mxds can be supplied
     # mxds should the ones used to publish the map service originally
 
-    dataFrame = mapping.ListDataFrames(mapDoc)[0]
-    webLayers = mapping.ListLayers(mapDoc, None, dataFrame)
+    dataFrame = listDataFrames(mapDoc)[0]
+    webLayers = listLayers(mapDoc, None, dataFrame)
 
     for webLayerIndex, webLayer in enumerate(webLayers):
 
@@ -418,10 +707,10 @@ def substituteLayers(mapDoc, webmap, substitutePath, substituteAlternatives, log
                 logFunction("Substitute layer found")
 
                 # if mxd exists, substitute layers
-                subMapDocOrLayer = mapping.MapDocument(possibleMxdOrLayerPath)
-                subMapDocDataframe = mapping.ListDataFrames(subMapDocOrLayer)[0]
+                subMapDocOrLayer = fileUtils.openMapDoc(possibleMxdOrLayerPath)
+                subMapDocDataframe = listDataFrames(subMapDocOrLayer)[0]
 
-                subLayers = mapping.ListLayers(subMapDocOrLayer)
+                subLayers = listLayers(subMapDocOrLayer)
 
                 if layerIndex > -1:
                     # feature layer or stand alone map service layer
@@ -432,8 +721,8 @@ def substituteLayers(mapDoc, webmap, substitutePath, substituteAlternatives, log
                         if webLayer.supports("transparency") and webLayer.transparency > 0:
                             subLayer.transparency = webLayer.transparency
                         warnIfRasterising(subLayer, logFunction)
-                        mapping.InsertLayer(dataFrame, webLayer, subLayer, "AFTER")
-                        mapping.RemoveLayer(dataFrame, webLayer)
+                        insertLayer(dataFrame, webLayer, subLayer, "AFTER")
+                        removeLayer(dataFrame, webLayer)
 
                 else:
                     # map service layer, add in all layers from sub mxd
@@ -444,10 +733,10 @@ def substituteLayers(mapDoc, webmap, substitutePath, substituteAlternatives, log
                             addSubLayer.transparency = webLayer.transparency
                         warnIfRasterising(addSubLayer, logFunction)
                         logFunction("Inserting " + addSubLayer.name)
-                        mapping.InsertLayer(dataFrame, webLayer, addSubLayer, "BEFORE")
+                        insertLayer(dataFrame, webLayer, addSubLayer, "BEFORE")
 
                     # remove substituted layer
-                    mapping.RemoveLayer(dataFrame, webLayer)
+                    removeLayer(dataFrame, webLayer)
             else:
                 # no mxd exists on disk
                 pass
@@ -459,7 +748,7 @@ def clearScaleRangeBasemaps(mapDoc, scale):
     # clear up scale / rounding issues
     # if basemap should be visible, remove any scale limits
 
-    layers = mapping.ListLayers(mapDoc)
+    layers = listLayers(mapDoc)
     for layer in layers:
         if scale > 0:
             intScale = int(scale)
@@ -470,8 +759,9 @@ def clearScaleRangeBasemaps(mapDoc, scale):
 def cloneMapDoc(mapDoc, outputFolder):
     newMxdName = "_ags_cl_" + str(uuid.uuid4()) + ".mxd"
     newMxdPath = path.join(outputFolder, newMxdName)
-    mapDoc.saveACopy(newMxdPath)
-    cloneMxd = mapping.MapDocument(newMxdPath)
+    fileUtils.saveMapDocCopy(mapDoc, newMxdPath)
+    fileUtils.registerTempArtifact(newMxdPath)
+    cloneMxd = fileUtils.openMapDoc(newMxdPath)
     return cloneMxd
 
 
@@ -481,21 +771,69 @@ def copyLayers(fromLayerList, toMapDoc, outputFolder, removeExistingLayers = Fal
         # make a copy of map doc so we can edit it
         toMapDoc = cloneMapDoc(toMapDoc, outputFolder)
 
-    toDataFrame = mapping.ListDataFrames(toMapDoc)[0]
+    toDataFrame = listDataFrames(toMapDoc)[0]
 
     if removeExistingLayers:
-        for removeLayer in mapping.ListLayers(toMapDoc, None, toDataFrame):
-            mapping.RemoveLayer(toDataFrame, removeLayer)
+        for existingLayer in listLayers(toMapDoc, None, toDataFrame):
+            removeLayer(toDataFrame, existingLayer)
 
     for fromLayer in fromLayerList:
         # check if is a root layer and add if so
         if not "\\" in fromLayer.longName:
-            mapping.AddLayer(toDataFrame, fromLayer, "BOTTOM")
+            addLayer(toDataFrame, fromLayer, "BOTTOM")
 
     return toMapDoc
 
+def prepareLods(lodsArray, logFunction):
+    # validates the client LOD list once per request, returning the LODs with a usable scale sorted by scale
+    # pass the same list to every setExtentAndScale call of the request, its scales are only sorted once
+    validLods = []
+    for lodObj in lodsArray or []:
+        try:
+            lodScale = float(lodObj["scale"])
+        except (KeyError, TypeError, ValueError):
+            logFunction("Ignoring LOD without a valid scale: " + str(lodObj))
+            continue
+        if lodScale > 0:
+            validLods.append(lodObj)
+        else:
+            logFunction("Ignoring LOD with scale " + str(lodObj["scale"]))
+    validLods.sort(key = lambda lodObj: float(lodObj["scale"]))
+    return validLods
+
+
+def getLodScales(lodsArray):
+    # LOD scales in ascending order, worked out once for each LOD list
+    if _lodScales["lods"] is not lodsArray:
+        _lodScales["scales"] = sorted([float(lodObj["scale"]) for lodObj in lodsArray])
+        _lodScales["lods"] = lodsArray
+    return _lodScales["scales"]
+
+
+def snapScaleToLods(scale, lodsArray, snapPolicy = "next-larger"):
+    # returns the LOD scale a map at scale is printed at, see LOD_SNAP_POLICY in the settings
+    # "next-larger" - the smallest LOD scale larger than scale, or the largest LOD scale
+    # "next-smaller" - the largest LOD scale no larger than scale, or the smallest LOD scale
+    # "nearest" - the closest LOD scale
+    lodScales = getLodScales(lodsArray)
+    if not lodScales:
+        return scale
+
+    if snapPolicy == "next-smaller":
+        lodIndex = bisect.bisect_right(lodScales, scale) - 1
+        return lodScales[max(lodIndex, 0)]
+
+    if snapPolicy == "nearest":
+        lodIndex = bisect.bisect_left(lodScales, scale)
+        nearScales = lodScales[max(lodIndex - 1, 0):lodIndex + 1]
+        return min(nearScales, key = lambda lodScale: abs(lodScale - scale))
+
+    lodIndex = bisect.bisect_right(lodScales, scale)
+    return lodScales[min(lodIndex, len(lodScales) - 1)]
+
+
 def setExtentAndScale(mapDoc, extent = None, scale = -1, lodsArray = []):
-    dataFrame = mapping.ListDataFrames(mapDoc)[0]
+    dataFrame = listDataFrames(mapDoc)[0]
 
     # set extent and scale
     if extent:
@@ -504,11 +842,7 @@ def setExtentAndScale(mapDoc, extent = None, scale = -1, lodsArray = []):
         dataFrame.scale = scale
 
     if lodsArray:
-        closestScale = lodsArray[0]["scale"]
-        for lodObj in lodsArray:
-            lodScale = lodObj["scale"]
-            if lodScale < closestScale and lodScale > dataFrame.scale:
-                closestScale = lodScale
+        closestScale = snapScaleToLods(dataFrame.scale, lodsArray, settings.LOD_SNAP_POLICY)
         if closestScale > 0:
             dataFrame.scale = closestScale
 
@@ -546,31 +880,83 @@ def exportMapDocToFile(exportableMapDoc, formatStr, outputFolder, quality):
         mapping.ExportToPNG(exportableMapDoc, outputFilePath, "PAGE_LAYOUT", 0, 0, quality)
     else:
         raise Exception("Format not supported: " + formatStr)
+    fileUtils.registerTempArtifact(outputFilePath)
     return outputFilePath
 
 
-def combineImageDocuments(fileList, format):
+def exportSavedMapDocToFile(exportArgs):
+    # exports an mxd saved on disk, used by worker processes that can't be passed a map document object
+    # exportArgs is (mxd path, format, output folder, quality). returns the exported file path, export time in ms
+    # and the map documents opened and saved by the worker, see fileUtils.mapDocIoCounts
+    mxdPath, formatStr, outputFolder, quality = exportArgs
+
+    # a worker process exports many pages, only this one is counted
+    fileUtils.resetMapDocIoCounts()
+    startTime = time.time()
+    exportableMapDoc = fileUtils.openMapDoc(mxdPath)
+    outputFilePath = exportMapDocToFile(exportableMapDoc, formatStr, outputFolder, quality)
+    del exportableMapDoc
 
-    # if not pdf, return first image
-    # at some point could zip them together
+    return outputFilePath, int((time.time() - startTime) * 1000), dict(fileUtils.mapDocIoCounts)
+
+
+def combineImageDocuments(fileList, format, outputFolder = None):
+
+    if len(fileList) == 1:
+        return fileList[0]
+
+    # pages are written to a new file, so page files are left unchanged
+    if not outputFolder:
+        outputFolder = path.dirname(fileList[0])
+
+    # if not pdf, zip the pages together or return the first image
     if format.find("pdf") < 0:
+        if settings.IMAGE_MULTIPAGE_OUTPUT == "zip":
+            outFilePath = path.join(outputFolder, "_ags_" + str(uuid.uuid4()) + ".zip")
+            _zipPages(fileList, outFilePath)
+            return outFilePath
         return fileList[0]
 
-    pdfDoc = None
-    outFilePath = ""
-    count = 0
-    for file in fileList:
-        if count == 0:
-            pdfDoc = mapping.PDFDocumentOpen(file)
-            outFilePath = file
-        else:
-            pdfDoc.appendPages(file)
-        count += 1
-    pdfDoc.saveAndClose()
+    outFilePath = path.join(outputFolder, "_ags_" + str(uuid.uuid4()) + ".pdf")
+
+    if PdfMerger:
+        _combinePdfsWithMerger(fileList, outFilePath)
+    else:
+        _combinePdfsWithArcpy(fileList, outFilePath)
 
     return outFilePath
 
 
+def _zipPages(fileList, outFilePath):
+    # images are already compressed, so they are stored rather than deflated
+    # pages are named in print order, e.g. page_01.jpg, page_02.pdf for appended legend pdfs
+    zipFile = zipfile.ZipFile(outFilePath, "w", zipfile.ZIP_STORED, True)
+    try:
+        for pageIndex, file in enumerate(fileList):
+            pageName = "page_" + str(pageIndex + 1).zfill(2) + "." + fileUtils.getExtension(file)
+            zipFile.write(file, pageName)
+    finally:
+        zipFile.close()
+
+
+def _combinePdfsWithMerger(fileList, outFilePath):
+    # reads each page file once and writes the combined pdf in a single pass
+    pdfMerger = PdfMerger()
+    try:
+        for file in fileList:
+            pdfMerger.append(file)
+        pdfMerger.write(outFilePath)
+    finally:
+        pdfMerger.close()
+
+
+def _combinePdfsWithArcpy(fileList, outFilePath):
+    pdfDoc = mapping.PDFDocumentCreate(outFilePath)
+    for file in fileList:
+        pdfDoc.appendPages(file)
+    pdfDoc.saveAndClose()
+
+
 def getTargetLegendMxd(legendItemCount, config, layoutName = None):
 
     # if layoutName is supplied, this takes precedence
@@ -586,45 +972,99 @@ def getTargetLegendMxd(legendItemCount, config, layoutName = None):
 
     return targetMxd
 
-def getMapDocForLegend(mapDoc, excludeLayers, outFolder, logFunction, webmapObj):
+def getMapDocForLegend(mapDoc, excludeLayers, outFolder, logFunction, webmapObj, legendVerdicts = None):
 
     # get original layers list
-    mapDocDataFrame = mapping.ListDataFrames(mapDoc)[0]
-    mapDocLayers = mapping.ListLayers(mapDoc)
+    mapDocDataFrame = listDataFrames(mapDoc)[0]
+    mapDocLayers = listLayers(mapDoc)
 
     # clone, remove exclude and raster layers
     mapDocClone = copyLayers(mapDocLayers, mapDoc, outFolder, True)
-    removeLayers(mapDocClone, True, excludeLayers, True, webmapObj, logFunction)
+    removeLayers(mapDocClone, True, excludeLayers, True, webmapObj, logFunction, legendVerdicts)
     #mapDocClone.saveACopy(outFolder + "/" + "removedLayers.mxd")
 
     return mapDocClone
 
-def processInlineLegend(mapDoc, showLegend, excludeLayers, webmapObj, logFunction):
 
-    legendDataFrame = mapping.ListDataFrames(mapDoc)[0]
-    legendElement = None
-    try:
-        legendElement = mapping.ListLayoutElements(mapDoc, "LEGEND_ELEMENT", "Legend")[0]
-    except:
-        pass
-    if legendElement:
-        if showLegend:
-            logFunction("Processing inline legend")
-            removeLayers(mapDoc, True, excludeLayers, True, webmapObj, logFunction)
-        else:
-            logFunction("Hiding inline legend")
-            legendElement.elementPositionX = 90000
-
-
-
-def getMxdLegends(legendMxdList, mapDoc, layoutNameStr, outFolder, logFunction, config, excludeLayers, webmapObj, styleItemPath = None, styleItemName = None):
+def createPage(mapDoc = None, file = None, cacheKey = None, isMapPage = False):
+    # a page of the print output, either a map doc still to be exported or a file that has already been exported
+    # if cacheKey is set, the exported file is kept in a page cache under that key
+    # isMapPage is set on map pages, as opposed to legend pages. in an atlas print these are exported once per extent
+    return {"mapDoc": mapDoc, "file": file, "cacheKey": cacheKey, "isMapPage": isMapPage}
+
+
+def setExtentFromJson(extent, extentObj):
+    # copies the client extent json onto an arcpy extent, returns the extent
+    extent.XMin = extentObj['xmin']
+    extent.YMin = extentObj['ymin']
+    extent.XMax = extentObj['xmax']
+    extent.YMax = extentObj['ymax']
+    return extent
+
+
+def getAtlasPages(extentJsonObj):
+    # an atlas print has a list of extents in extentJson rather than a single extent, returns None otherwise
+    # each item is an extent, or {"extent": extent, "scale": map scale, "textElements": {element name: text}}
+    # where scale and textElements are optional and override the request's values for that page
+    if not isinstance(extentJsonObj, list):
+        return None
+
+    atlasPages = []
+    for atlasItem in extentJsonObj:
+        if "extent" not in atlasItem:
+            atlasItem = {"extent": atlasItem}
+        atlasPages.append({
+            "extent": atlasItem["extent"],
+            "scale": atlasItem.get("scale"),
+            "textElements": atlasItem.get("textElements") or {}
+        })
+    return atlasPages
+
+
+def getLegendPageCacheKey(legendMxdPath, legendLayers, legendVerdicts, scale, styleItemPath, styleItemName, legendPageCache):
+    # a legend page only depends on the legend mxd, the layers shown, scale and export settings
+    # so prints that differ in extent or title can reuse it
+    # verdicts are keyed by long name and layer index, see removeLayers
+    # long names are made of webmap layer ids and titles, which can match between webmaps showing different services,
+    # so each layer's service url and data source are part of the key
+    verdictsByName = {}
+    for (longName, layerIndex), verdict in sorted(legendVerdicts.items()):
+        verdictsByName.setdefault(longName, []).append(verdict)
+
+    layerStates = []
+    for legendLayer in legendLayers:
+        serviceUrl, dataSource = _getLayerSource(legendLayer)
+        layerStates.append([legendLayer.longName, serviceUrl, dataSource, legendLayer.visible,
+                            verdictsByName.get(legendLayer.longName)])
+
+    return fileUtils.getOutputCacheKey({
+        "legendMxd": legendMxdPath,
+        "legendMxdModified": path.getmtime(legendMxdPath),
+        "layers": layerStates,
+        "scale": scale,
+        "style": [styleItemPath, styleItemName],
+        "format": legendPageCache["format"],
+        "quality": legendPageCache["quality"]
+    })
+
+
+def getMxdLegends(legendMxdList, mapDoc, layoutNameStr, outFolder, logFunction, config, excludeLayers, webmapObj, styleItemPath = None, styleItemName = None,
+                  legendVerdicts = None, mapDocClone = None, legendPageCache = None):
+    # returns a list of pages, see createPage
+    # mapDocClone can be a map doc already prepared by getMapDocForLegend with the same layers as mapDoc
+    # this saves cloning the map doc again
+    # legendPageCache is an optional dictionary of "folder", "format", "quality" and "ttl" in seconds. if set,
+    # legend pages exported by earlier prints are reused
 
     returnMxdList = []
 
-    mapDocDataFrame = mapping.ListDataFrames(mapDoc)[0]
-    mapDocClone = getMapDocForLegend(mapDoc, excludeLayers, outFolder, logFunction, webmapObj)
+    mapDocDataFrame = listDataFrames(mapDoc)[0]
+    if legendVerdicts is None:
+        legendVerdicts = {}
+    if mapDocClone is None:
+        mapDocClone = getMapDocForLegend(mapDoc, excludeLayers, outFolder, logFunction, webmapObj, legendVerdicts)
 
-    outLayers = mapping.ListLayers(mapDocClone)
+    outLayers = listLayers(mapDocClone)
     # get approx swatch count, used for selecting legend mxd
     legendItemCount = getSwatchCount(outLayers, logFunction)
     legendAddLayers = getAddLayers(outLayers, None)
@@ -643,32 +1083,45 @@ def getMxdLegends(legendMxdList, mapDoc, layoutNameStr, outFolder, logFunction,
 
     for legendMxdPath in legendMxdList:
         if targetMxd.lower() in legendMxdPath.lower():
+
+            legendPageKey = None
+            if legendPageCache:
+                legendPageKey = getLegendPageCacheKey(legendMxdPath, outLayers, legendVerdicts, mapDocDataFrame.scale,
+                                                      styleItemPath, styleItemName, legendPageCache)
+                cachedLegendFile = fileUtils.getCachedOutput(legendPageCache["folder"], legendPageKey, legendPageCache["ttl"],
+                                                             fileUtils.LEGEND_PAGE_CACHE_PREFIX)
+                if cachedLegendFile:
+                    logFunction("Using cached legend page: " + cachedLegendFile)
+                    returnMxdList.append(createPage(None, cachedLegendFile))
+                    continue
+
             logFunction("Creating legend from mxd: " + legendMxdPath)
 
-            legendMxd = mapping.MapDocument(legendMxdPath)
-            legendDataFrame = mapping.ListDataFrames(legendMxd)[0]
-            legendElement = mapping.ListLayoutElements(legendMxd, "LEGEND_ELEMENT", "Legend")[0]
+            legendMxd = fileUtils.openMapDoc(legendMxdPath)
+            legendDataFrame = listDataFrames(legendMxd)[0]
+            legendElement = listLayoutElements(legendMxd, "LEGEND_ELEMENT", "Legend")[0]
 
             # set legend columns
             #legendElement.adjustColumnCount(3)
 
             for legendAddLayer in legendAddLayers:
-                mapping.AddLayer(legendDataFrame, legendAddLayer, "BOTTOM")
+                addLayer(legendDataFrame, legendAddLayer, "BOTTOM")
 
             legendDataFrame.extent = mapDocDataFrame.extent
             legendDataFrame.scale = mapDocDataFrame.scale
 
-            removeLayers(legendMxd, True, excludeLayers, True, webmapObj, logFunction)
+            removeLayers(legendMxd, True, excludeLayers, True, webmapObj, logFunction, legendVerdicts)
 
             if style:
                 for addedLayer in legendElement.listLegendItemLayers():
                     legendElement.updateItem(addedLayer, style)
 
-            returnMxdList.append(legendMxd)
+            returnMxdList.append(createPage(legendMxd, None, legendPageKey))
 
     return returnMxdList
 
-def webmapToMapDocument(webmapJson, outputFolder, serverConnectionSettings):
+def _convertWebmap(webmapJson, outputFolder, serverConnectionSettings):
+    # returns the converted map document and the path of its graphics gdb
 
     # extra server connections can be used where the log in to portal does not give enough access
     extraWebmapConversionOptions = {}
@@ -678,7 +1131,35 @@ def webmapToMapDocument(webmapJson, outputFolder, serverConnectionSettings):
     # create temp gdb path used by arcpy for graphics layers
     newGdbFile = path.join(outputFolder, "_ags_" + str(newUuid) + ".gdb")
     convertWebmapResult = mapping.ConvertWebMapToMapDocument(webmapJson, None, newGdbFile, extraWebmapConversionOptions)
-    return convertWebmapResult.mapDocument
+    return convertWebmapResult.mapDocument, newGdbFile
+
+
+def getWebmapMapDocument(webmapJson, outputFolder, serverConnectionSettings):
+    # converts the webmap once, templates and later requests printing the same webmap json get the same map document
+    # the map document is only read from, layers are copied from it onto the layouts
+    webmapKey = fileUtils.getOutputCacheKey([webmapJson, outputFolder, serverConnectionSettings])
+    convertedWebmap = _convertedWebmaps.get(webmapKey)
+    if convertedWebmap:
+        return convertedWebmap["mapDoc"]
+
+    webmapMapDoc, newGdbFile = _convertWebmap(webmapJson, outputFolder, serverConnectionSettings)
+    # the gdb is in use while the map document is kept, so the output directory sweep leaves it alone
+    fileUtils.retainArtifact(newGdbFile)
+    _convertedWebmaps[webmapKey] = {"mapDoc": webmapMapDoc, "gdb": newGdbFile, "converted": time.time()}
+    return webmapMapDoc
+
+
+def releaseWebmapMapDocuments(maxAgeSeconds):
+    # drops converted webmaps older than maxAgeSeconds, called at the start and the end of each print request
+    # so a converted webmap is not reused after other processes may have swept its gdb
+    # their gdbs are deleted with the other temporary files of the request
+    # returns the number of converted webmaps still kept
+    for webmapKey, convertedWebmap in list(_convertedWebmaps.items()):
+        if time.time() - convertedWebmap["converted"] >= maxAgeSeconds:
+            del _convertedWebmaps[webmapKey]
+            fileUtils.releaseArtifact(convertedWebmap["gdb"])
+            fileUtils.registerTempArtifact(convertedWebmap["gdb"])
+    return len(_convertedWebmaps)
 
 
 def getTemplateLegendItemLimit(config, template, layoutNameStr):
@@ -0,0 +1,68 @@
+# helper functions to run parts of the Auckland Council 10.2 print service for Portal in worker processes
+#
+# worker functions must be importable by the worker process, so they need to be defined in a module or
+# in a script that only runs its main body under "if __name__ == '__main__'"
+#
+import multiprocessing
+import sys
+import time
+from os import path
+
+
+def _setWorkerExecutable():
+    # within ArcGIS Server or ArcMap, sys.executable is not python, so workers have to be started with python.exe
+    pythonExe = path.join(sys.exec_prefix, "python.exe")
+    if path.isfile(pythonExe) and path.split(sys.executable)[-1].lower() != "python.exe":
+        multiprocessing.set_executable(pythonExe)
+
+
+def canStartWorkers():
+    # worker processes are daemons and can't start workers of their own
+    return not multiprocessing.current_process().daemon
+
+
+def mapInProcessPool(workerFunction, argsList, workerCount, logFunction, timeoutSeconds = None, resultFunction = None):
+    # calls workerFunction for every item in argsList using a pool of worker processes
+    # returns the results in the same order as argsList
+    # returns None if the worker processes could not be used, the caller should then process serially
+    # if the workers haven't finished after timeoutSeconds they are terminated and an exception is raised
+    # resultFunction is called in this process with each result as it arrives, in argsList order. once it has been
+    # called, a failure raises an exception rather than returning None, so results aren't handled twice
+
+    if not canStartWorkers():
+        return None
+
+    try:
+        _setWorkerExecutable()
+        pool = multiprocessing.Pool(min(workerCount, len(argsList)))
+    except Exception as ex:
+        logFunction("Unable to start worker processes, processing serially: " + str(ex))
+        return None
+
+    results = []
+    if timeoutSeconds is not None:
+        endTime = time.time() + timeoutSeconds
+    try:
+        resultIterator = pool.imap(workerFunction, argsList, 1)
+        for a in range(len(argsList)):
+            if timeoutSeconds is not None:
+                results.append(resultIterator.next(max(endTime - time.time(), 0)))
+            else:
+                results.append(resultIterator.next())
+            if resultFunction is not None:
+                resultFunction(results[-1])
+        pool.close()
+    except multiprocessing.TimeoutError:
+        pool.terminate()
+        pool.join()
+        raise Exception("Worker processes did not finish within " + str(timeoutSeconds) + " seconds")
+    except Exception as ex:
+        pool.terminate()
+        if resultFunction is not None and results:
+            pool.join()
+            raise
+        logFunction("Worker processes failed, processing serially: " + str(ex))
+        results = None
+    pool.join()
+
+    return results
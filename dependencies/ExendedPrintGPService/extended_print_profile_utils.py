@@ -0,0 +1,115 @@
+# helper functions to count the arcpy.mapping calls made by the Auckland Council 10.2 print service for Portal
+#
+# profiling is opt-in, see PROFILE_MAPPING_CALLS in the settings. While it runs, the listed arcpy.mapping
+# functions and MapDocument methods are replaced by wrappers that record call counts and cumulative time,
+# per function and per calling function, so repeated calls for the same document show up in the report
+#
+import sys
+import time
+from os import path
+from arcpy import mapping
+
+# arcpy.mapping functions that are wrapped while profiling
+MAPPING_FUNCTION_NAMES = ["MapDocument", "Layer", "ListLayers", "ListDataFrames", "ListLayoutElements",
+                          "ListStyleItems", "AddLayer", "InsertLayer", "RemoveLayer", "ExportToPDF",
+                          "ExportToJPEG", "ExportToPNG", "PDFDocumentCreate", "PDFDocumentOpen",
+                          "ConvertWebMapToMapDocument"]
+
+# MapDocument methods that are wrapped while profiling
+MAP_DOCUMENT_METHOD_NAMES = ["saveACopy", "save"]
+
+# (module, function) of helpers that make arcpy.mapping calls on behalf of their callers. calls are recorded
+# against the function that called the helper, so cached listings are reported where they are used
+HELPER_FRAMES = set([("extended_print_map_utils", "_getListing"), ("extended_print_map_utils", "listDataFrames"),
+                     ("extended_print_map_utils", "listLayers"), ("extended_print_map_utils", "listLayoutElements"),
+                     ("extended_print_map_utils", "addLayer"), ("extended_print_map_utils", "insertLayer"),
+                     ("extended_print_map_utils", "removeLayer"), ("extended_print_file_utils", "openMapDoc"),
+                     ("extended_print_file_utils", "saveMapDocCopy")])
+
+# original functions and methods, keyed by (owner, name), while profiling is running
+_originals = {}
+
+# {"ListLayers": {"count": 3, "ms": 12.5, "callers": {"extended_print_map_utils.copyLayers": {"count": 3, "ms": 12.5}}}}
+_callStats = {}
+
+
+def _recordCall(functionName, callerName, callMs):
+    functionStats = _callStats.setdefault(functionName, {"count": 0, "ms": 0.0, "callers": {}})
+    functionStats["count"] += 1
+    functionStats["ms"] += callMs
+    callerStats = functionStats["callers"].setdefault(callerName, {"count": 0, "ms": 0.0})
+    callerStats["count"] += 1
+    callerStats["ms"] += callMs
+
+
+def _getCallerName(callerFrame):
+    # module.function of the first caller that isn't one of the HELPER_FRAMES
+    while callerFrame is not None:
+        callerModule = path.splitext(path.basename(callerFrame.f_code.co_filename))[0]
+        if (callerModule, callerFrame.f_code.co_name) not in HELPER_FRAMES or callerFrame.f_back is None:
+            return callerModule + "." + callerFrame.f_code.co_name
+        callerFrame = callerFrame.f_back
+
+
+def _wrap(functionName, originalFunction):
+    def profiledFunction(*args, **kwargs):
+        callerName = _getCallerName(sys._getframe(1))
+        startTime = time.time()
+        try:
+            return originalFunction(*args, **kwargs)
+        finally:
+            _recordCall(functionName, callerName, (time.time() - startTime) * 1000)
+    return profiledFunction
+
+
+def _patch(owner, name, reportName):
+    originalFunction = getattr(owner, name, None)
+    if originalFunction is None or (owner, name) in _originals:
+        return
+    _originals[(owner, name)] = originalFunction
+    setattr(owner, name, _wrap(reportName, originalFunction))
+
+
+def startMappingProfile():
+    # wraps the arcpy.mapping calls and clears the call counts from any previous request
+    _callStats.clear()
+
+    # the methods are patched on the class before MapDocument itself is replaced by a wrapper
+    mapDocumentClass = mapping.MapDocument
+    for methodName in MAP_DOCUMENT_METHOD_NAMES:
+        _patch(mapDocumentClass, methodName, "MapDocument." + methodName)
+    for functionName in MAPPING_FUNCTION_NAMES:
+        _patch(mapping, functionName, functionName)
+
+
+def stopMappingProfile():
+    # restores the original arcpy.mapping calls and returns the report, see getMappingProfileReport
+    for (owner, name), originalFunction in _originals.items():
+        setattr(owner, name, originalFunction)
+    _originals.clear()
+    return getMappingProfileReport()
+
+
+def getMappingProfileReport():
+    # call counts and times per function, most expensive first, with each function's callers
+    report = []
+    for functionName, functionStats in _callStats.items():
+        callers = [{"caller": callerName, "count": callerStats["count"], "ms": int(callerStats["ms"])}
+                   for callerName, callerStats in functionStats["callers"].items()]
+        callers.sort(key=lambda caller: caller["ms"], reverse=True)
+        report.append({"function": functionName, "count": functionStats["count"], "ms": int(functionStats["ms"]),
+                       "callers": callers})
+    report.sort(key=lambda function: function["ms"], reverse=True)
+    return report
+
+
+def mergeMappingProfileReport(report):
+    # adds a report returned by a worker process to the call counts of this process
+    for function in report:
+        for caller in function["callers"]:
+            functionStats = _callStats.setdefault(function["function"], {"count": 0, "ms": 0.0, "callers": {}})
+            functionStats["count"] += caller["count"]
+            functionStats["ms"] += caller["ms"]
+            callerStats = functionStats["callers"].setdefault(caller["caller"], {"count": 0, "ms": 0.0})
+            callerStats["count"] += caller["count"]
+            callerStats["ms"] += caller["ms"]
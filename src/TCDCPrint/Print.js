@@ -116,6 +116,9 @@ define([
 
             this.printUtil = new PrintUtil();
             this.printUtil.setServiceUrl(this.printTaskURL);
+            if (this.config.templateCatalogueURL) {
+                this.printUtil.setTemplateCatalogueUrl(this.config.templateCatalogueURL);
+            }
 
             this._setPrintTemplates();
             this._setPrintQualityVisibility();
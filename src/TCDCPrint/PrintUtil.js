@@ -6,6 +6,8 @@ Helper class for printing
 
     var printUtil = new PrintUtil();
     printUtil.setServiceUrl("<URL>");
+    // optional, templates and layouts are read from the catalogue file the service writes to its output directory
+    printUtil.setTemplateCatalogueUrl("<output directory URL>/print_templates.json");
 
     // to get available layouts
     var deferred = printUtil.getLayouts("Standard");
@@ -85,6 +87,7 @@ define(
     var PrintUtil = declare("PrintUtil", null, {
         _currentJobId: null,
         _serviceUrl: "",
+        _templateCatalogueUrl: "",
         _geoprocessor: null,
 
         // URL always needs to be set here
@@ -92,6 +95,11 @@ define(
             this._serviceUrl = serviceUrl;
             this._geoprocessor = new Geoprocessor(this._serviceUrl);
         },
+        // URL of the template catalogue file written by the service, see TEMPLATE_CATALOGUE_FILE_NAME
+        // templates and layouts are read from it without a geoprocessing job. optional
+        setTemplateCatalogueUrl: function (templateCatalogueUrl) {
+            this._templateCatalogueUrl = templateCatalogueUrl;
+        },
         // Do an async call to get available layouts
         getLayouts: function (template) {
 
@@ -101,7 +109,15 @@ define(
             }
 
             // the deferred returns an array of strings
-            return this.doGeoprocCallAsync(params, "layouts");
+            return this.getFromTemplateCatalogueAsync(params, "layouts", function (catalogue) {
+                for (var templateName in catalogue.layouts) {
+                    // template folders are matched without case, as in the service
+                    if (templateName.toLowerCase() === template.toLowerCase()) {
+                        return catalogue.layouts[templateName];
+                    }
+                }
+                return null;
+            });
 
         },
         // call to get available templates
@@ -120,7 +136,9 @@ define(
             if (!this._serviceUrl) {
                 deferred.reject("PrintUtil service URL is not set.");
             } else {
-                deferred = this.doGeoprocCallAsync(params, "templates");
+                deferred = this.getFromTemplateCatalogueAsync(params, "templates", function (catalogue) {
+                    return catalogue.templates;
+                });
             }
             return deferred;
 
@@ -194,8 +212,43 @@ define(
                 gp.cancelJob(me._currentJobId, function (resp) {
                     // successfully stopped geoprocessing job
                 });
+                // the print service also stops a running print at its next page when sent the job id to cancel
+                gp.submitJob({
+                    template: me._currentJobId,
+                    getlayouts: "cancel"
+                });
             }
         },
+        // reads a value from the template catalogue file, falling back to a geoprocessing job when the file isn't set,
+        // can't be read or doesn't have the value, e.g. before the service has written it
+        getFromTemplateCatalogueAsync: function (params, outputValue, getCatalogueValue) {
+            var me = this;
+            if (!this._templateCatalogueUrl) {
+                return this.doGeoprocCallAsync(params, outputValue);
+            }
+
+            var deferred = new Deferred();
+            function doGeoprocCall() {
+                me.doGeoprocCallAsync(params, outputValue).then(function (val) {
+                    deferred.resolve(val);
+                }, function (err) {
+                    deferred.reject(err);
+                });
+            }
+            esriRequest({
+                url: this._templateCatalogueUrl,
+                handleAs: "json"
+            }).then(function (catalogue) {
+                var val = catalogue ? getCatalogueValue(catalogue) : null;
+                if (val) {
+                    deferred.resolve(val);
+                } else {
+                    doGeoprocCall();
+                }
+            }, doGeoprocCall);
+
+            return deferred.promise;
+        },
         doGeoprocCallAsync: function (params, outputValue) {
             this._currentJobId = null;
             var me = this;
@@ -0,0 +1,71 @@
+# times combining 50 one page pdfs with PyPDF2 against arcpy's PDFDocument, using the fake arcpy
+#
+# run from anywhere with the python used by the service, e.g.
+#   python tests/bench_combine.py
+#   python tests/bench_combine.py --pages 100 --latencies arcgis
+#
+# PyPDF2 is optional, see the install steps in extended_print_geoproc_service.py. without it only the arcpy
+# fallback is timed. with --latencies arcgis each appendPages and saveAndClose call waits for a rough guess of its
+# cost on a server, see ARCGIS_LATENCIES
+#
+from __future__ import print_function
+import argparse
+import shutil
+import tempfile
+import time
+from os import path, remove
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+from arcpy import mapping
+import extended_print_map_utils as mapUtils
+
+
+def timeCombine(combineFunction, fileList, outputFolder, repeat):
+    # median ms of combineFunction over repeat runs, checking the page count of the combined pdf
+    runMs = []
+    for a in range(repeat):
+        outFilePath = path.join(outputFolder, "combined.pdf")
+        startTime = time.time()
+        combineFunction(fileList, outFilePath)
+        runMs.append((time.time() - startTime) * 1000)
+        if mapping.countPdfPages(outFilePath) != len(fileList):
+            raise Exception("Combined pdf has " + str(mapping.countPdfPages(outFilePath)) + " pages, expected " +
+                            str(len(fileList)))
+        remove(outFilePath)
+    runMs.sort()
+    return runMs[len(runMs) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times combining one page pdfs")
+    parser.add_argument("--pages", type = int, default = 50, help = "one page pdfs to combine")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per method, the median is reported")
+    parser.add_argument("--latencies", default = "none", choices = ["none", "arcgis"])
+    args = parser.parse_args()
+
+    if args.latencies == "arcgis":
+        mapping.setLatencies(**mapping.ARCGIS_LATENCIES)
+    else:
+        mapping.setLatencies()
+
+    outputFolder = tempfile.mkdtemp(prefix = "print_bench_")
+    try:
+        fileList = []
+        for pageIndex in range(args.pages):
+            fileList.append(path.join(outputFolder, "page_" + str(pageIndex + 1) + ".pdf"))
+            mapping.writePdf(fileList[-1], 1)
+
+        print("method                  pages  median ms")
+        if mapUtils.PdfMerger:
+            mergerMs = timeCombine(mapUtils._combinePdfsWithMerger, fileList, outputFolder, args.repeat)
+            print("PyPDF2 merger          %6d  %9.1f" % (args.pages, mergerMs))
+        else:
+            print("PyPDF2 merger          %6d  not installed" % args.pages)
+        arcpyMs = timeCombine(mapUtils._combinePdfsWithArcpy, fileList, outputFolder, args.repeat)
+        print("arcpy PDFDocument      %6d  %9.1f" % (args.pages, arcpyMs))
+    finally:
+        shutil.rmtree(outputFolder, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# times the cold start of a get layouts request against importing the print modules, each in a new python process
+#
+# run from anywhere with the python used by the service, e.g.
+#   python tests/bench_import.py
+#   python tests/bench_import.py --repeat 10 --arcpy-import-seconds 3
+#
+# "layouts" runs extended_print_geoproc_service as __main__ for a get layouts request, as the widget does when the
+# print panel opens without a templateCatalogueURL, and checks the print modules were not imported. "print modules"
+# imports the service and then calls importPrintModules, which every print request does
+#
+# importing arcpy loads arcpy.mapping as well, in the real package and in the fake, so both modes load it and a
+# layouts request only saves importing the three print modules. the fake arcpy waits --arcpy-import-seconds on
+# import to stand in for its cold start on a server, which a layouts request can't avoid. the widget avoids it by
+# reading the template catalogue file the service writes, see TEMPLATE_CATALOGUE_FILE_NAME
+#
+# "process ms" is the whole new process, "after start ms" leaves out starting python and "step ms" also leaves out
+# importing arcpy, which is imported first in both modes
+#
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PRINT_MODULE_NAMES = ["extended_print_map_utils", "extended_print_parallel_utils", "extended_print_profile_utils"]
+
+
+def _runLayoutsRequest():
+    import runpy
+    # print_fixtures puts the fake arcpy and the service modules on sys.path
+    import print_fixtures
+    import arcpy
+
+    workspace = print_fixtures.createWorkspace()
+    try:
+        arcpy.setParameters({2: print_fixtures.TEMPLATE_NAME, 9: "true"})
+        startTime = time.time()
+        runpy.run_path(os.path.join(print_fixtures.SERVICE_DIR, "extended_print_geoproc_service.py"),
+                       run_name = "__main__")
+        requestMs = (time.time() - startTime) * 1000
+    finally:
+        print_fixtures.removeWorkspace(workspace)
+
+    resultObj = json.loads(arcpy.parameters[0])
+    if resultObj["error"] or resultObj.get("layouts") != [print_fixtures.LAYOUT_NAME]:
+        raise Exception("Unexpected get layouts result: " + arcpy.parameters[0])
+    return {"ms": requestMs}
+
+
+def _importPrintModules():
+    # print_fixtures puts the fake arcpy on sys.path, arcpy is imported before timing as for a layouts request
+    import print_fixtures
+    import arcpy
+
+    startTime = time.time()
+    import extended_print_geoproc_service as service
+    service.importPrintModules()
+    return {"ms": (time.time() - startTime) * 1000}
+
+
+def runChild(mode):
+    # runs in the new process, prints the timings as json
+    startTime = time.time()
+    childStdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        if mode == "layouts":
+            childResult = _runLayoutsRequest()
+        else:
+            childResult = _importPrintModules()
+    finally:
+        sys.stdout.close()
+        sys.stdout = childStdout
+    childResult["totalMs"] = (time.time() - startTime) * 1000
+    childResult["printModules"] = len([a for a in PRINT_MODULE_NAMES if a in sys.modules])
+    childResult["mappingLoaded"] = "arcpy.mapping" in sys.modules
+    print(json.dumps(childResult))
+
+
+def timeChild(mode, repeat, arcpyImportSeconds):
+    # median timings of repeat new processes running mode
+    childEnv = dict(os.environ)
+    childEnv["FAKE_ARCPY_IMPORT_SECONDS"] = str(arcpyImportSeconds)
+    childResults = []
+    for a in range(repeat):
+        startTime = time.time()
+        childOutput = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", mode],
+                                              env = childEnv)
+        childResult = json.loads(childOutput.decode("utf-8").strip().splitlines()[-1])
+        childResult["processMs"] = (time.time() - startTime) * 1000
+        childResults.append(childResult)
+    childResults.sort(key = lambda childResult: childResult["processMs"])
+    return childResults[len(childResults) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times get layouts requests and print module imports")
+    parser.add_argument("--repeat", type = int, default = 5, help = "processes per mode, the median is reported")
+    parser.add_argument("--arcpy-import-seconds", type = float, default = 0, help = "fake arcpy import time")
+    parser.add_argument("--child", choices = ["layouts", "print-modules"], help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        runChild(args.child)
+        return
+
+    print("mode           process ms  after start ms  step ms  print modules loaded  arcpy.mapping loaded")
+    for mode, label in [("layouts", "layouts"), ("print-modules", "print modules")]:
+        childResult = timeChild(mode, args.repeat, args.arcpy_import_seconds)
+        print("%-13s  %10d  %14.1f  %7.1f  %d of %-16d  %s" % (label, childResult["processMs"], childResult["totalMs"],
+                                                               childResult["ms"], childResult["printModules"],
+                                                               len(PRINT_MODULE_NAMES), childResult["mappingLoaded"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# times extended_print_geoproc_service.process() for webmaps of 10 to 1000 layers, using the fake arcpy
+#
+# run from anywhere with the python used by the service, e.g.
+#   python tests/bench_process.py
+#   python tests/bench_process.py --layers 10,100,1000 --repeat 5 --latencies arcgis
+#
+# with --latencies none the fake arcpy calls return straight away, so the times are the service's own python.
+# with --latencies arcgis each call waits for a rough guess of its cost on a server, see ARCGIS_LATENCIES
+#
+from __future__ import print_function
+import argparse
+import sys
+import time
+
+import print_fixtures
+from arcpy import mapping
+import extended_print_geoproc_service as service
+
+
+class _NullWriter(object):
+    # the service prints every log line, they are dropped while timing
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def timePrint(workspace, webmap, formatStr, includeLegend):
+    # returns the request time in ms, the stage timings and the arcpy.mapping call counts of one print
+    del service.stageTimings[:]
+    del service.logMessages[:]
+    mapping.resetCallCounts()
+    service.fileUtils.resetMapDocIoCounts()
+
+    stdout = sys.stdout
+    sys.stdout = _NullWriter()
+    try:
+        startTime = time.time()
+        finalFile = print_fixtures.runPrint(service, workspace, webmap, formatStr, includeLegend)
+        printMs = (time.time() - startTime) * 1000
+    finally:
+        sys.stdout = stdout
+    service.fileUtils.registerTempArtifact(finalFile)
+    print_fixtures.deletePrintArtifacts(service)
+
+    stageMs = {}
+    for stageTiming in service.stageTimings:
+        stageMs[stageTiming["stage"]] = stageMs.get(stageTiming["stage"], 0) + stageTiming["ms"]
+    return printMs, stageMs, dict(mapping.callCounts), dict(service.fileUtils.mapDocIoCounts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times process() with the fake arcpy")
+    parser.add_argument("--layers", default = "10,100,500,1000", help = "comma separated webmap layer counts")
+    parser.add_argument("--services", type = int, default = 4, help = "map services the layers are split between")
+    parser.add_argument("--repeat", type = int, default = 3, help = "prints per layer count, the median is reported")
+    parser.add_argument("--format", default = ".pdf", choices = [".pdf", ".jpg", ".png"])
+    parser.add_argument("--no-legend", action = "store_true", help = "print without legends")
+    parser.add_argument("--latencies", default = "none", choices = ["none", "arcgis"])
+    args = parser.parse_args()
+
+    if args.latencies == "arcgis":
+        mapping.setLatencies(**mapping.ARCGIS_LATENCIES)
+    else:
+        mapping.setLatencies()
+
+    workspace = print_fixtures.createWorkspace()
+    try:
+        # the print modules are imported once, as in a server process that has already printed
+        service.importPrintModules()
+
+        print("layers  median ms  convert  copy  legends  export  mapping calls  mxd opens/saves")
+        for layerCount in [int(a) for a in args.layers.split(",")]:
+            webmap = print_fixtures.makeWebmap(layerCount, min(args.services, layerCount))
+            results = [timePrint(workspace, webmap, args.format, not args.no_legend) for a in range(args.repeat)]
+            results.sort(key = lambda result: result[0])
+            printMs, stageMs, callCounts, mapDocIoCounts = results[len(results) // 2]
+            print("%6d  %9d  %7d  %4d  %7d  %6d  %13d  %d/%d" % (
+                layerCount, printMs, stageMs.get("convertWebmap", 0), stageMs.get("copyLayers", 0),
+                stageMs.get("legends", 0), stageMs.get("export", 0), sum(callCounts.values()),
+                mapDocIoCounts["opens"], mapDocIoCounts["saves"]))
+    finally:
+        print_fixtures.removeWorkspace(workspace)
+
+
+if __name__ == "__main__":
+    main()
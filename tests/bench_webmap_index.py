@@ -0,0 +1,93 @@
+# times the legend filtering of a 500 sublayer webmap with the webmap index against scanning the webmap per lookup
+#
+# run from anywhere with the python used by the service, e.g.
+#   python tests/bench_webmap_index.py
+#   python tests/bench_webmap_index.py --layers 1000 --services 1,20,100
+#
+# removeLayers looks up the operational layer and the showLegend settings of every layer in the converted map
+# document. "indexed" is the service as it is, with the index built once by parseWebmap. "scanned" builds the
+# index again for every lookup, which costs a pass over the operational layers and their sublayer settings, as the
+# linear searches before parseWebmap did
+#
+from __future__ import print_function
+import argparse
+import json
+import time
+
+import print_fixtures
+from arcpy import mapping
+import extended_print_map_utils as mapUtils
+
+
+def _ignoreLog(message):
+    pass
+
+
+def _convertWebmap(webmap):
+    mapUtils.clearMapDocListings()
+    return mapping.ConvertWebMapToMapDocument(json.dumps(webmap)).mapDocument
+
+
+def timeRemoveLayers(webmap, webmapIndex, repeat):
+    # median ms of removeLayers over fresh conversions of the webmap, with the number of webmap lookups made
+    getWebmapIndex = mapUtils._getWebmapIndex
+    lookupCounts = [0]
+
+    def countingGetWebmapIndex(webmap):
+        lookupCounts[0] += 1
+        return getWebmapIndex(webmap)
+
+    mapUtils._getWebmapIndex = countingGetWebmapIndex
+    try:
+        runMs = []
+        for a in range(repeat):
+            mapDoc = _convertWebmap(webmap)
+            lookupCounts[0] = 0
+            startTime = time.time()
+            mapUtils.removeLayers(mapDoc, True, [], True, webmapIndex, _ignoreLog)
+            runMs.append((time.time() - startTime) * 1000)
+    finally:
+        mapUtils._getWebmapIndex = getWebmapIndex
+    runMs.sort()
+    return runMs[len(runMs) // 2], lookupCounts[0]
+
+
+def timeScannedRemoveLayers(webmap, webmapIndex, repeat):
+    # as timeRemoveLayers, with the index built again for every lookup
+    getWebmapIndex = mapUtils._getWebmapIndex
+    mapUtils._getWebmapIndex = lambda webmapIndex: getWebmapIndex(mapUtils.parseWebmap(webmapIndex.webmap))
+    try:
+        return timeRemoveLayers(webmap, webmapIndex, repeat)
+    finally:
+        mapUtils._getWebmapIndex = getWebmapIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times removeLayers with and without the webmap index")
+    parser.add_argument("--layers", type = int, default = 500, help = "map service sublayers in the webmap")
+    parser.add_argument("--services", default = "1,10,50", help = "comma separated map service counts")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per service count, the median is reported")
+    args = parser.parse_args()
+
+    mapping.setLatencies()
+    mapUtils.compileLegendNameFilter([], [])
+
+    print("layers  services  lookups  parseWebmap ms  indexed ms  scanned ms")
+    for serviceCount in [int(a) for a in args.services.split(",")]:
+        webmap = print_fixtures.makeWebmap(args.layers, serviceCount)
+
+        startTime = time.time()
+        webmapIndex = mapUtils.parseWebmap(webmap)
+        parseMs = (time.time() - startTime) * 1000
+
+        indexedMs, lookupCount = timeRemoveLayers(webmap, webmapIndex, args.repeat)
+        scannedMs = timeScannedRemoveLayers(webmap, webmapIndex, args.repeat)[0]
+        print("%6d  %8d  %7d  %14.2f  %10.1f  %10.1f" % (args.layers, serviceCount, lookupCount, parseMs, indexedMs,
+                                                          scannedMs))
+
+    mapUtils.clearMapDocListings()
+    mapping.clearMapServices()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# stand-in for the arcpy package, used to run the print service scripts outside ArcGIS Server
+#
+# only the functions used by the service are provided. put tests/fake_arcpy ahead of the real arcpy on sys.path,
+# see tests/README.md. arcpy.mapping is in mapping.py, with the latency settings used by the benchmarks
+#
+import os
+import time
+
+# seconds to wait when arcpy is imported, standing in for its cold start on a server, see tests/bench_import.py
+IMPORT_SECONDS = float(os.environ.get("FAKE_ARCPY_IMPORT_SECONDS") or 0)
+if IMPORT_SECONDS:
+    time.sleep(IMPORT_SECONDS)
+
+from arcpy import mapping
+
+# parameter values by index, set with setParameters before running the service as __main__
+# SetParameterAsText stores the result here as well
+parameters = {}
+
+# messages passed to AddMessage
+messages = []
+
+
+class env(object):
+    scratchFolder = ""
+
+
+def setParameters(parameterValues):
+    parameters.clear()
+    parameters.update(parameterValues)
+
+
+def GetParameterAsText(index):
+    return parameters.get(index, "")
+
+
+def SetParameterAsText(index, text):
+    parameters[index] = text
+
+
+def AddMessage(message):
+    messages.append(message)
+
+
+def AddError(message):
+    messages.append(message)
+
+
+def SignInToPortal_server(username, password, portalUrl):
+    mapping._wait("SignInToPortal_server")
@@ -0,0 +1,564 @@
+# stand-in for arcpy.mapping, used to run the print service scripts outside ArcGIS Server
+#
+# map documents hold data frames of layer trees and a legend and text elements. saveACopy pickles the document to
+# the mxd path, so clones and the temporary mxds of export workers can be opened again, in any process.
+# an mxd that isn't a saved fake document, e.g. an empty file in a test template folder, opens as a blank layout
+#
+# map services don't exist, ConvertWebMapToMapDocument builds each operational layer's sublayers from the trees
+# registered with registerMapService, see syntheticSublayers
+#
+# calls return straight away unless latencies are set, see setLatencies. ARCGIS_LATENCIES is a rough guess at the
+# cost of the real calls, so time spent in arcpy.mapping can be weighed against time spent in the service's python
+#
+import fnmatch
+import json
+import os
+import pickle
+import re
+import time
+from os import path
+
+# seconds added to every call, by function name
+LATENCY_SECONDS = {}
+# seconds added for each layer a call handles, e.g. each layer listed, copied or exported
+LATENCY_SECONDS_PER_LAYER = {}
+
+# rough figures for a 10.2 server, not measured. use with setLatencies(**ARCGIS_LATENCIES)
+ARCGIS_LATENCIES = {
+    "seconds": {
+        "MapDocument": 0.05, "MapDocument.saveACopy": 0.05, "ConvertWebMapToMapDocument": 0.5,
+        "ExportToPDF": 0.3, "ExportToJPEG": 0.3, "ExportToPNG": 0.3, "PDFDocument.appendPages": 0.01,
+        "PDFDocument.saveAndClose": 0.05, "LegendElement.isOverflowing": 0.02, "Symbology.classValues": 0.02,
+        "SignInToPortal_server": 0.2
+    },
+    "secondsPerLayer": {
+        "MapDocument": 0.0005, "MapDocument.saveACopy": 0.0005, "ConvertWebMapToMapDocument": 0.002,
+        "ListLayers": 0.0001, "AddLayer": 0.001, "InsertLayer": 0.001, "RemoveLayer": 0.001,
+        "ExportToPDF": 0.002, "ExportToJPEG": 0.002, "ExportToPNG": 0.002
+    }
+}
+
+# number of legend items that fit in a layout legend before isOverflowing is set
+LEGEND_ITEM_CAPACITY = 30
+
+# text elements of a blank layout
+LAYOUT_TEXT_ELEMENT_NAMES = ["title", "subtitle", "author", "date", "legal", "scale"]
+
+# width of the map on the page in metres, used to work out a data frame's scale from its extent
+MAP_WIDTH_METRES = 0.25
+
+# names of the style items returned by ListStyleItems
+STYLE_ITEM_NAMES = ["Legend Item"]
+
+# sublayer trees by map service url, see registerMapService
+_mapServices = {}
+
+# number of calls made to each function since resetCallCounts
+callCounts = {}
+
+
+def setLatencies(seconds = None, secondsPerLayer = None):
+    # replaces the latencies, setLatencies() turns them off
+    LATENCY_SECONDS.clear()
+    LATENCY_SECONDS.update(seconds or {})
+    LATENCY_SECONDS_PER_LAYER.clear()
+    LATENCY_SECONDS_PER_LAYER.update(secondsPerLayer or {})
+
+
+def resetCallCounts():
+    callCounts.clear()
+
+
+def _wait(functionName, layerCount = 0):
+    callCounts[functionName] = callCounts.get(functionName, 0) + 1
+    waitSeconds = LATENCY_SECONDS.get(functionName, 0) + LATENCY_SECONDS_PER_LAYER.get(functionName, 0) * layerCount
+    if waitSeconds > 0:
+        time.sleep(waitSeconds)
+
+
+def registerMapService(url, sublayers):
+    # sublayers is a list of layer specs, {"name": name, "classCount": unique value classes, "raster": False,
+    # "visible": True, "sublayers": [...]}, where a spec with sublayers is a group layer
+    _mapServices[url] = sublayers
+
+
+def clearMapServices():
+    _mapServices.clear()
+
+
+def syntheticSublayers(layerCount, groupSize = 10, classCount = 5):
+    # a map service tree of layerCount layers, in group layers of groupSize. every other layer is a unique values
+    # layer with classCount classes
+    sublayers = []
+    group = None
+    for layerIndex in range(layerCount):
+        if groupSize and layerIndex % (groupSize + 1) == 0:
+            group = {"name": "Group " + str(layerIndex), "sublayers": []}
+            sublayers.append(group)
+            continue
+        layerSpec = {"name": "Layer " + str(layerIndex), "classCount": classCount if layerIndex % 2 else 0}
+        if group is not None:
+            group["sublayers"].append(layerSpec)
+        else:
+            sublayers.append(layerSpec)
+    return sublayers
+
+
+class Extent(object):
+
+    def __init__(self, XMin = 0.0, YMin = 0.0, XMax = 0.0, YMax = 0.0):
+        self.XMin = XMin
+        self.YMin = YMin
+        self.XMax = XMax
+        self.YMax = YMax
+
+    @property
+    def width(self):
+        return self.XMax - self.XMin
+
+    @property
+    def height(self):
+        return self.YMax - self.YMin
+
+    def _copy(self):
+        return Extent(self.XMin, self.YMin, self.XMax, self.YMax)
+
+
+class Symbology(object):
+
+    def __init__(self, classCount = 0):
+        self._classValues = ["Class " + str(a) for a in range(classCount)]
+
+    @property
+    def classValues(self):
+        # slow in arcpy, the service caches class counts
+        _wait("Symbology.classValues")
+        return list(self._classValues)
+
+
+class Layer(object):
+
+    def __init__(self, lyr_file_path = None):
+        # a layer file saved by Layer.saveACopy, otherwise a layer named after the file
+        _wait("Layer")
+        savedLayer = _readPickle(lyr_file_path) if lyr_file_path else None
+        if isinstance(savedLayer, Layer):
+            self.__dict__.update(savedLayer.__dict__)
+            return
+        name = path.splitext(path.basename(lyr_file_path))[0] if lyr_file_path else "Layer"
+        self._setFromSpec({"name": name})
+
+    def _setFromSpec(self, layerSpec, parent = None, serviceUrl = None):
+        self.name = layerSpec["name"]
+        self._parent = parent
+        self._children = []
+        self._inLegend = True
+        self.visible = layerSpec.get("visible", True)
+        self.isRasterLayer = layerSpec.get("raster", False)
+        self.isRasterizingLayer = False
+        self.transparency = layerSpec.get("transparency", 0)
+        self.minScale = layerSpec.get("minScale", 0)
+        self.maxScale = layerSpec.get("maxScale", 0)
+        self.serviceProperties = {"URL": serviceUrl, "ServiceType": "MapServer"} if serviceUrl else {}
+        self.dataSource = layerSpec.get("dataSource", "")
+        classCount = layerSpec.get("classCount", 0)
+        self.symbologyType = "UNIQUE_VALUES" if classCount else "OTHER"
+        self.symbology = Symbology(classCount)
+        for sublayerSpec in layerSpec.get("sublayers", []):
+            self._children.append(_newLayer(sublayerSpec, self, serviceUrl))
+
+    @property
+    def longName(self):
+        if self._parent is None:
+            return self.name
+        return self._parent.longName + "\\" + self.name
+
+    @property
+    def isGroupLayer(self):
+        return len(self._children) > 0
+
+    def supports(self, layer_property):
+        layerProperty = layer_property.upper()
+        if layerProperty == "SERVICEPROPERTIES":
+            return bool(self.serviceProperties)
+        if layerProperty == "DATASOURCE":
+            return bool(self.dataSource)
+        return layerProperty in ["NAME", "LONGNAME", "VISIBLE", "TRANSPARENCY", "MINSCALE", "MAXSCALE", "SYMBOLOGYTYPE"]
+
+    def saveACopy(self, file_name, version = None):
+        _writePickle(file_name, _copyLayer(self))
+
+    def __repr__(self):
+        return "<Layer " + self.longName + ">"
+
+
+def _newLayer(layerSpec, parent = None, serviceUrl = None):
+    layer = Layer.__new__(Layer)
+    layer._setFromSpec(layerSpec, parent, serviceUrl)
+    return layer
+
+
+def _copyLayer(layer, parent = None):
+    # arcpy adds a copy of a layer and its sublayers, the copy is back in the legend of its new map document
+    layerCopy = Layer.__new__(Layer)
+    layerCopy.__dict__.update(layer.__dict__)
+    layerCopy.serviceProperties = dict(layer.serviceProperties)
+    layerCopy._parent = parent
+    layerCopy._inLegend = True
+    layerCopy._children = [_copyLayer(child, layerCopy) for child in layer._children]
+    return layerCopy
+
+
+def _flattenLayers(layers):
+    # layers and their sublayers in drawing order, as listed by ListLayers
+    flatLayers = []
+    for layer in layers:
+        flatLayers.append(layer)
+        flatLayers.extend(_flattenLayers(layer._children))
+    return flatLayers
+
+
+def _matchName(name, wildcard):
+    return not wildcard or fnmatch.fnmatch(name.lower(), wildcard.lower())
+
+
+class DataFrame(object):
+
+    def __init__(self, name = "Layers"):
+        self.name = name
+        self._layers = []
+        self._extent = Extent(0, 0, 1000, 1000)
+        self._scale = 1000 / MAP_WIDTH_METRES
+
+    @property
+    def extent(self):
+        # a copy, as in arcpy, so the extent has to be set again after it's changed
+        return self._extent._copy()
+
+    @extent.setter
+    def extent(self, extent):
+        self._extent = extent._copy()
+        if extent.width > 0:
+            self._scale = extent.width / MAP_WIDTH_METRES
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, scale):
+        # zooms about the centre of the extent
+        centreX = (self._extent.XMin + self._extent.XMax) / 2.0
+        centreY = (self._extent.YMin + self._extent.YMax) / 2.0
+        ratio = self._extent.height / self._extent.width if self._extent.width else 1.0
+        halfWidth = scale * MAP_WIDTH_METRES / 2.0
+        self._extent = Extent(centreX - halfWidth, centreY - halfWidth * ratio, centreX + halfWidth, centreY + halfWidth * ratio)
+        self._scale = float(scale)
+
+
+class LegendElement(object):
+
+    def __init__(self, dataFrame, name = "Legend"):
+        self.name = name
+        self.type = "LEGEND_ELEMENT"
+        self.elementPositionX = 0
+        self.elementPositionY = 0
+        self._dataFrame = dataFrame
+
+    def listLegendItemLayers(self):
+        return [a for a in _flattenLayers(self._dataFrame._layers) if a._inLegend]
+
+    @property
+    def isOverflowing(self):
+        _wait("LegendElement.isOverflowing")
+        itemCount = 0
+        for layer in self.listLegendItemLayers():
+            if not layer.isGroupLayer and layer.visible:
+                itemCount += 1 + len(layer.symbology._classValues)
+        return itemCount > LEGEND_ITEM_CAPACITY
+
+    def removeItem(self, legend_item_layer, index = 0):
+        _wait("LegendElement.removeItem")
+        legend_item_layer._inLegend = False
+
+    def updateItem(self, legend_item_layer, legend_item_style_item = None, preserve_item_sizes = False,
+                   use_visible_extent = False, show_feature_count = False, use_ddp_extent = False, index = 0):
+        _wait("LegendElement.updateItem")
+
+    def adjustColumnCount(self, column_count):
+        pass
+
+
+class TextElement(object):
+
+    def __init__(self, name, text = ""):
+        self.name = name
+        self.text = text
+        self.type = "TEXT_ELEMENT"
+        self.elementPositionX = 0
+        self.elementPositionY = 0
+
+
+class MapDocument(object):
+
+    def __init__(self, mxd_path):
+        savedDocument = _readPickle(mxd_path)
+        if isinstance(savedDocument, dict) and "dataFrames" in savedDocument:
+            self.__dict__.update(savedDocument)
+        else:
+            # a blank layout, "no legend" layouts don't have a legend
+            self._setBlankLayout("no legend" not in path.basename(mxd_path).lower())
+        self.filePath = mxd_path
+        _wait("MapDocument", len(self._listAllLayers()))
+
+    def _setBlankLayout(self, includeLegend = True):
+        self.title = ""
+        self.dataFrames = [DataFrame()]
+        self.elements = [TextElement(a) for a in LAYOUT_TEXT_ELEMENT_NAMES]
+        if includeLegend:
+            self.elements.append(LegendElement(self.dataFrames[0]))
+
+    def _listAllLayers(self):
+        allLayers = []
+        for dataFrame in self.dataFrames:
+            allLayers.extend(_flattenLayers(dataFrame._layers))
+        return allLayers
+
+    def saveACopy(self, file_name, version = None):
+        _wait("MapDocument.saveACopy", len(self._listAllLayers()))
+        _writePickle(file_name, {"title": self.title, "dataFrames": self.dataFrames, "elements": self.elements})
+
+    def save(self):
+        self.saveACopy(self.filePath)
+
+
+def _newMapDocument(includeLegend = True):
+    mapDoc = MapDocument.__new__(MapDocument)
+    mapDoc._setBlankLayout(includeLegend)
+    mapDoc.filePath = ""
+    return mapDoc
+
+
+def _readPickle(filePath):
+    try:
+        pickleFile = open(filePath, "rb")
+    except IOError:
+        return None
+    try:
+        return pickle.load(pickleFile)
+    except Exception:
+        return None
+    finally:
+        pickleFile.close()
+
+
+def _writePickle(filePath, obj):
+    pickleFile = open(filePath, "wb")
+    try:
+        pickle.dump(obj, pickleFile, 2)
+    finally:
+        pickleFile.close()
+
+
+def ListDataFrames(map_document, wildcard = None):
+    _wait("ListDataFrames")
+    return [a for a in map_document.dataFrames if _matchName(a.name, wildcard)]
+
+
+def ListLayers(map_document_or_layer, wildcard = None, data_frame = None):
+    if isinstance(map_document_or_layer, Layer):
+        layers = _flattenLayers([map_document_or_layer])
+    elif data_frame is not None:
+        layers = _flattenLayers(data_frame._layers)
+    else:
+        layers = map_document_or_layer._listAllLayers()
+    layers = [a for a in layers if _matchName(a.name, wildcard)]
+    _wait("ListLayers", len(layers))
+    return layers
+
+
+def ListLayoutElements(map_document, element_type = None, wildcard = None):
+    _wait("ListLayoutElements")
+    return [a for a in map_document.elements if (not element_type or a.type == element_type) and _matchName(a.name, wildcard)]
+
+
+def ListStyleItems(style_file_path, style_folder_name, wildcard = None):
+    _wait("ListStyleItems")
+    return [StyleItem(a, style_folder_name) for a in STYLE_ITEM_NAMES if _matchName(a, wildcard)]
+
+
+class StyleItem(object):
+
+    def __init__(self, itemName, styleFolderName):
+        self.itemName = itemName
+        self.styleFolderName = styleFolderName
+
+
+def _getSiblings(data_frame, layer):
+    return layer._parent._children if layer._parent is not None else data_frame._layers
+
+
+def _indexOfLayer(layers, layer):
+    for layerIndex, siblingLayer in enumerate(layers):
+        if siblingLayer is layer:
+            return layerIndex
+    raise ValueError("Layer is not in the data frame: " + layer.longName)
+
+
+def AddLayer(data_frame, add_layer, add_position = "AUTO_ARRANGE"):
+    layerCopy = _copyLayer(add_layer)
+    _wait("AddLayer", len(_flattenLayers([layerCopy])))
+    if add_position == "TOP":
+        data_frame._layers.insert(0, layerCopy)
+    else:
+        data_frame._layers.append(layerCopy)
+
+
+def InsertLayer(data_frame, reference_layer, insert_layer, insert_position = "BEFORE"):
+    siblings = _getSiblings(data_frame, reference_layer)
+    layerIndex = _indexOfLayer(siblings, reference_layer)
+    layerCopy = _copyLayer(insert_layer, reference_layer._parent)
+    _wait("InsertLayer", len(_flattenLayers([layerCopy])))
+    siblings.insert(layerIndex + 1 if insert_position == "AFTER" else layerIndex, layerCopy)
+
+
+def RemoveLayer(data_frame, remove_layer):
+    siblings = _getSiblings(data_frame, remove_layer)
+    _wait("RemoveLayer", len(_flattenLayers([remove_layer])))
+    del siblings[_indexOfLayer(siblings, remove_layer)]
+
+
+class ConversionResult(object):
+
+    def __init__(self, mapDocument):
+        self.mapDocument = mapDocument
+        self.DPI = 96
+        self.outputSizeHeight = 0
+        self.outputSizeWidth = 0
+
+
+def _getOperationalLayerSpec(jsonOperLayerObj):
+    # map service layers get the sublayers registered for their url, graphics become a group of feature layers
+    layerSpec = {"name": jsonOperLayerObj.get("id") or jsonOperLayerObj.get("title") or "Layer",
+                 "visible": jsonOperLayerObj.get("visibility", True),
+                 "transparency": int(round((1 - jsonOperLayerObj.get("opacity", 1)) * 100)),
+                 "minScale": jsonOperLayerObj.get("minScale", 0), "maxScale": jsonOperLayerObj.get("maxScale", 0)}
+    if "url" in jsonOperLayerObj:
+        layerSpec["sublayers"] = _mapServices.get(jsonOperLayerObj["url"].split("?")[0], [])
+    elif "featureCollection" in jsonOperLayerObj:
+        layerSpec["sublayers"] = [{"name": a.get("layerDefinition", {}).get("name", "pointLayer")}
+                                  for a in jsonOperLayerObj["featureCollection"].get("layers", [])]
+    return layerSpec
+
+
+def ConvertWebMapToMapDocument(webmap_json, template_mxd = None, notes_gdb = None, extra_conversion_options = None):
+    webmap = json.loads(webmap_json)
+    mapDoc = MapDocument(template_mxd) if template_mxd else _newMapDocument()
+    dataFrame = mapDoc.dataFrames[0]
+
+    for jsonOperLayerObj in webmap.get("operationalLayers", []):
+        layerSpec = _getOperationalLayerSpec(jsonOperLayerObj)
+        dataFrame._layers.append(_newLayer(layerSpec, None, jsonOperLayerObj.get("url", "").split("?")[0] or None))
+
+    mapOptions = webmap.get("mapOptions", {})
+    if "extent" in mapOptions:
+        extentObj = mapOptions["extent"]
+        dataFrame.extent = Extent(extentObj["xmin"], extentObj["ymin"], extentObj["xmax"], extentObj["ymax"])
+    if mapOptions.get("scale"):
+        dataFrame.scale = mapOptions["scale"]
+
+    if notes_gdb and not path.isdir(notes_gdb):
+        os.makedirs(notes_gdb)
+
+    _wait("ConvertWebMapToMapDocument", len(mapDoc._listAllLayers()))
+    return ConversionResult(mapDoc)
+
+
+def writePdf(filePath, pageCount):
+    # writes a valid, blank pdf with pageCount A4 pages
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [" + " ".join([str(a + 3) + " 0 R" for a in range(pageCount)]) + "] /Count " +
+               str(pageCount) + " >>"]
+    for pageIndex in range(pageCount):
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>")
+
+    pdfText = "%PDF-1.4\n"
+    offsets = []
+    for objectIndex, objectText in enumerate(objects):
+        offsets.append(len(pdfText))
+        pdfText += str(objectIndex + 1) + " 0 obj\n" + objectText + "\nendobj\n"
+    xrefOffset = len(pdfText)
+    pdfText += "xref\n0 " + str(len(objects) + 1) + "\n0000000000 65535 f \n"
+    for offset in offsets:
+        pdfText += str(offset).zfill(10) + " 00000 n \n"
+    pdfText += "trailer\n<< /Size " + str(len(objects) + 1) + " /Root 1 0 R >>\nstartxref\n" + str(xrefOffset) + "\n%%EOF\n"
+
+    pdfFile = open(filePath, "wb")
+    try:
+        pdfFile.write(pdfText.encode("ascii"))
+    finally:
+        pdfFile.close()
+
+
+def countPdfPages(filePath):
+    pdfFile = open(filePath, "rb")
+    try:
+        return len(re.findall(b"/Type\\s*/Page\\b(?!s)", pdfFile.read()))
+    finally:
+        pdfFile.close()
+
+
+def _writeImage(filePath, header):
+    imageFile = open(filePath, "wb")
+    try:
+        imageFile.write(header + b" fake image")
+    finally:
+        imageFile.close()
+
+
+def _countExportedLayers(map_document):
+    return len([a for a in map_document._listAllLayers() if a.visible])
+
+
+def ExportToPDF(map_document, out_pdf, data_frame = "PAGE_LAYOUT", df_export_width = 640, df_export_height = 480,
+                resolution = 300, image_quality = "BEST", *args, **kwargs):
+    _wait("ExportToPDF", _countExportedLayers(map_document))
+    writePdf(out_pdf, 1)
+
+
+def ExportToJPEG(map_document, out_jpeg, data_frame = "PAGE_LAYOUT", df_export_width = 640, df_export_height = 480,
+                 resolution = 96, *args, **kwargs):
+    _wait("ExportToJPEG", _countExportedLayers(map_document))
+    _writeImage(out_jpeg, b"\xff\xd8\xff\xe0")
+
+
+def ExportToPNG(map_document, out_png, data_frame = "PAGE_LAYOUT", df_export_width = 640, df_export_height = 480,
+                resolution = 96, *args, **kwargs):
+    _wait("ExportToPNG", _countExportedLayers(map_document))
+    _writeImage(out_png, b"\x89PNG\r\n\x1a\n")
+
+
+class PDFDocument(object):
+
+    def __init__(self, pdfPath, pageCount = 0):
+        self._pdfPath = pdfPath
+        self.pageCount = pageCount
+
+    def appendPages(self, pdf_path, input_pdf_password = None):
+        pageCount = countPdfPages(pdf_path)
+        _wait("PDFDocument.appendPages", pageCount)
+        self.pageCount += pageCount
+
+    def saveAndClose(self):
+        _wait("PDFDocument.saveAndClose", self.pageCount)
+        writePdf(self._pdfPath, self.pageCount)
+
+
+def PDFDocumentCreate(pdf_path):
+    _wait("PDFDocumentCreate")
+    return PDFDocument(pdf_path)
+
+
+def PDFDocumentOpen(pdf_path, user_password = None, master_password = None):
+    _wait("PDFDocumentOpen")
+    return PDFDocument(pdf_path, countPdfPages(pdf_path))
@@ -0,0 +1,139 @@
+# shared set up for the tests and benchmarks in this folder
+#
+# importing this module puts tests/fake_arcpy and the service modules at the front of sys.path, so the service
+# imports the fake arcpy. createWorkspace builds template folders in a temporary directory and points the
+# settings at them, makeWebmap builds webmaps with synthetic map service layer trees
+#
+import json
+import shutil
+import sys
+import tempfile
+from os import path, makedirs
+
+TESTS_DIR = path.dirname(path.abspath(__file__))
+SERVICE_DIR = path.join(path.dirname(TESTS_DIR), "dependencies", "ExendedPrintGPService")
+FAKE_ARCPY_DIR = path.join(TESTS_DIR, "fake_arcpy")
+
+for importPath in [SERVICE_DIR, FAKE_ARCPY_DIR]:
+    if importPath in sys.path:
+        sys.path.remove(importPath)
+    sys.path.insert(0, importPath)
+
+TEMPLATE_NAME = "Standard"
+LAYOUT_NAME = "A4 Landscape"
+
+# url of the nth synthetic map service
+SERVICE_URL = "https://example.com/arcgis/rest/services/Benchmark/Service{0}/MapServer"
+
+
+def _writeEmptyFile(filePath):
+    open(filePath, "wb").close()
+
+
+def createWorkspace(legendPdfCount = 0):
+    # a temporary directory with a template folder and an output folder, see removeWorkspace
+    # layout and legend mxds are empty files, which the fake arcpy opens as blank layouts
+    from arcpy import mapping
+    import extended_print_geoproc_service_settings as settings
+
+    rootPath = tempfile.mkdtemp(prefix = "print_bench_")
+    workspace = {
+        "root": rootPath,
+        "templates": path.join(rootPath, "templates"),
+        "output": path.join(rootPath, "output"),
+        "templateRoot": path.join(rootPath, "templates", TEMPLATE_NAME)
+    }
+    layoutPath = path.join(workspace["templateRoot"], settings.TEMPLATE_LAYOUT_DIR_NAME)
+    legendPath = path.join(workspace["templateRoot"], settings.TEMPLATE_LEGEND_DIR_NAME)
+    for dirPath in [layoutPath, legendPath, workspace["output"]]:
+        makedirs(dirPath)
+
+    _writeEmptyFile(path.join(layoutPath, LAYOUT_NAME + ".mxd"))
+    _writeEmptyFile(path.join(layoutPath, LAYOUT_NAME + " no legend.mxd"))
+    # the legend mxd is picked by layout name, see mapUtils.getTargetLegendMxd
+    _writeEmptyFile(path.join(legendPath, LAYOUT_NAME + ".mxd"))
+    for legendIndex in range(legendPdfCount):
+        mapping.writePdf(path.join(legendPath, "Legend " + str(legendIndex + 1) + ".pdf"), 1)
+
+    settings.TEMPLATES_PATH = workspace["templates"]
+    settings.AGS_OUTPUT_DIRECTORY = workspace["output"]
+    settings.SYMBOLOGY_CLASS_COUNT_CACHE_FILE = path.join(rootPath, "symbology_class_counts.json")
+    settings.METRICS_LOG_FILE = ""
+    settings.PORTAL_USER = ""
+    # every run does the full print, nothing is reused from an earlier one
+    settings.OUTPUT_CACHE_TTL_SECONDS = 0
+    settings.LEGEND_PAGE_CACHE_TTL_SECONDS = 0
+    settings.WEBMAP_CACHE_SECONDS = 0
+    settings.PRINT_WORKER_PROCESSES = 0
+    settings.EXPORT_WORKER_PROCESSES = 0
+    return workspace
+
+
+def removeWorkspace(workspace):
+    shutil.rmtree(workspace["root"], True)
+
+
+def makeWebmap(layerCount, serviceCount = 1, groupSize = 10, classCount = 5, hiddenLegendEvery = 7):
+    # a webmap of serviceCount map services sharing layerCount sublayers, registered with the fake arcpy
+    # every hiddenLegendEvery-th sublayer has showLegend set to false in the webmap
+    from arcpy import mapping
+
+    operationalLayers = []
+    for serviceIndex in range(serviceCount):
+        serviceLayerCount = layerCount // serviceCount + (1 if serviceIndex < layerCount % serviceCount else 0)
+        serviceUrl = SERVICE_URL.format(serviceIndex)
+        mapping.registerMapService(serviceUrl, mapping.syntheticSublayers(serviceLayerCount, groupSize, classCount))
+
+        operationalLayer = {
+            "id": "Service" + str(serviceIndex) + "_" + str(1000 + serviceIndex),
+            "title": "Service " + str(serviceIndex),
+            "url": serviceUrl,
+            "opacity": 1,
+            "minScale": 0,
+            "maxScale": 0,
+            "visibleLayers": list(range(serviceLayerCount))
+        }
+        if hiddenLegendEvery:
+            operationalLayer["layers"] = [{"id": a, "showLegend": False}
+                                          for a in range(0, serviceLayerCount, hiddenLegendEvery)]
+        operationalLayers.append(operationalLayer)
+
+    return {
+        "mapOptions": {
+            "extent": {"xmin": 1570000, "ymin": 5180000, "xmax": 1575000, "ymax": 5183000,
+                       "spatialReference": {"wkid": 2193}},
+            "spatialReference": {"wkid": 2193}
+        },
+        "operationalLayers": operationalLayers
+    }
+
+
+def runPrint(service, workspace, webmap, formatStr = ".pdf", includeLegend = True, lodsArray = None,
+             textElements = None):
+    # prints the webmap with the workspace template through process() and combines the pages, as the service
+    # does for a single template. returns the combined file
+    service.importPrintModules()
+    service.configureModules()
+    settings = service.settings
+    mapUtils = service.mapUtils
+    fileUtils = service.fileUtils
+
+    fileUtils.loadClassCountCache(settings.SYMBOLOGY_CLASS_COUNT_CACHE_FILE)
+    mapUtils.clearMapDocListings()
+    mapUtils.compileLegendNameFilter(settings.LEGEND_EXCLUDE_LAYERS, settings.LEGEND_INCLUDE_LAYERS)
+    webmapIndex = mapUtils.parseWebmap(webmap)
+    layoutItemLimit = mapUtils.getTemplateLegendItemLimit(settings.LEGEND_STYLE_TEMPLATE_LIMITS_CONFIG, TEMPLATE_NAME,
+                                                          LAYOUT_NAME + ".mxd")
+    try:
+        outFiles = service.process(workspace["templateRoot"], LAYOUT_NAME + ".mxd", workspace["output"], formatStr, 96, -1,
+                                   None, textElements or {"title": "Benchmark"}, mapUtils.prepareLods(lodsArray, service.log),
+                                   includeLegend, layoutItemLimit, json.dumps(webmap), webmapIndex)
+        return mapUtils.combineImageDocuments(outFiles, formatStr, workspace["output"])
+    finally:
+        mapUtils.clearMapDocListings()
+        mapUtils.releaseWebmapMapDocuments(0)
+        fileUtils.saveClassCountCache()
+
+
+def deletePrintArtifacts(service, keepPaths = None):
+    return service.fileUtils.deleteTempArtifacts(keepPaths)
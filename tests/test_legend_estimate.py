@@ -0,0 +1,82 @@
+# legend size estimates against the legend removeLayers leaves, see estimateLegendItemCount
+#
+import json
+import shutil
+import tempfile
+import unittest
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+from arcpy import mapping
+import extended_print_map_utils as mapUtils
+
+SERVICE_URL = "https://example.com/arcgis/rest/services/Legend/MapServer"
+
+
+def _ignoreLog(message):
+    pass
+
+
+class EstimateLegendItemCountTest(unittest.TestCase):
+
+    def setUp(self):
+        mapping.setLatencies()
+        mapUtils.compileLegendNameFilter([], [])
+        self.outputFolder = tempfile.mkdtemp(prefix = "print_test_")
+
+    def tearDown(self):
+        mapUtils.clearMapDocListings()
+        mapping.clearMapServices()
+        shutil.rmtree(self.outputFolder, True)
+
+    def _webmap(self, sublayers, operationalLayer = None):
+        mapping.registerMapService(SERVICE_URL, sublayers)
+        jsonOperLayerObj = {"id": "Legend_1", "title": "Legend", "url": SERVICE_URL}
+        jsonOperLayerObj.update(operationalLayer or {})
+        return {"operationalLayers": [jsonOperLayerObj]}
+
+    def _legendItemCounts(self, webmap):
+        # the estimate, and the items left in the legend of the map doc cloned for the legend
+        mapUtils.clearMapDocListings()
+        mapDoc = mapping.ConvertWebMapToMapDocument(json.dumps(webmap)).mapDocument
+        webmapIndex = mapUtils.parseWebmap(webmap)
+        legendVerdicts = {}
+        estimatedItemCount = mapUtils.estimateLegendItemCount(mapDoc, webmapIndex, _ignoreLog, legendVerdicts)
+
+        legendMapDoc = mapUtils.getMapDocForLegend(mapDoc, [], self.outputFolder, _ignoreLog, webmapIndex,
+                                                   legendVerdicts)
+        legendElement = mapping.ListLayoutElements(legendMapDoc, "LEGEND_ELEMENT")[0]
+        legendItemCount = 0
+        for layer in legendElement.listLegendItemLayers():
+            if not layer.isGroupLayer and layer.visible:
+                legendItemCount += 1 + len(layer.symbology._classValues)
+        return estimatedItemCount, legendItemCount
+
+    def testHiddenSublayers(self):
+        webmap = self._webmap(mapping.syntheticSublayers(40, 0, 0),
+                              {"layers": [{"id": a, "showLegend": False} for a in range(0, 40, 2)]})
+        self.assertEqual(self._legendItemCounts(webmap), (20, 20))
+
+    def testHiddenGroupLayer(self):
+        # ids 0 and 6 are group layers of 5 layers, odd ids have 5 classes. only layers 1 to 5 are in the legend
+        webmap = self._webmap(mapping.syntheticSublayers(12, 5, 5), {"layers": [{"id": 6, "showLegend": False}]})
+        self.assertEqual(self._legendItemCounts(webmap), (20, 20))
+
+    def testHiddenMapService(self):
+        webmap = self._webmap(mapping.syntheticSublayers(40, 0, 0), {"showLegend": False})
+        self.assertEqual(self._legendItemCounts(webmap), (0, 0))
+
+    def testRasterSublayers(self):
+        sublayers = [{"name": "Imagery", "raster": True}, {"name": "Parcels"}, {"name": "Roads", "classCount": 3}]
+        self.assertEqual(self._legendItemCounts(self._webmap(sublayers)), (5, 5))
+
+    def testBasemap(self):
+        webmap = self._webmap(mapping.syntheticSublayers(10, 0, 0), {"baseMapLayer": True})
+        self.assertEqual(self._legendItemCounts(webmap), (0, 0))
+
+    def testClientLegendCount(self):
+        webmap = self._webmap(mapping.syntheticSublayers(40, 0, 0), {"legendCount": 12})
+        self.assertEqual(self._legendItemCounts(webmap)[0], 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# keys of the legend page cache, see getLegendPageCacheKey
+#
+import json
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+from arcpy import mapping
+import extended_print_map_utils as mapUtils
+
+LEGEND_PAGE_CACHE = {"format": "PDF", "quality": "1"}
+
+
+class LegendPageCacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        mapping.setLatencies()
+        self.outputFolder = tempfile.mkdtemp(prefix = "print_test_")
+        self.legendMxdPath = path.join(self.outputFolder, "legend.mxd")
+        open(self.legendMxdPath, "w").close()
+
+    def tearDown(self):
+        mapUtils.clearMapDocListings()
+        mapping.clearMapServices()
+        shutil.rmtree(self.outputFolder, True)
+
+    def _cacheKey(self, serviceUrl):
+        # the same layer id and title in both webmaps, only the service differs
+        mapping.registerMapService(serviceUrl, mapping.syntheticSublayers(5, 0, 2))
+        webmap = {"operationalLayers": [{"id": "Layer_1", "title": "Layer", "url": serviceUrl}]}
+        mapDoc = mapping.ConvertWebMapToMapDocument(json.dumps(webmap)).mapDocument
+        return mapUtils.getLegendPageCacheKey(self.legendMxdPath, mapping.ListLayers(mapDoc), {}, 5000, None, None,
+                                              LEGEND_PAGE_CACHE)
+
+    def testSameService(self):
+        serviceUrl = "https://example.com/arcgis/rest/services/Parcels/MapServer"
+        self.assertEqual(self._cacheKey(serviceUrl), self._cacheKey(serviceUrl))
+
+    def testServicesWithTheSameLongNames(self):
+        self.assertNotEqual(self._cacheKey("https://example.com/arcgis/rest/services/Parcels/MapServer"),
+                            self._cacheKey("https://example.com/arcgis/rest/services/Roads/MapServer"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# snapping print scales to the LODs of a tiled basemap, see snapScaleToLods and prepareLods
+#
+import unittest
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+import extended_print_map_utils as mapUtils
+
+# the 14 levels of the NZTM tiling scheme, as a client sends them
+NZTM_SCALES = [1000000, 760000, 500000, 250000, 100000, 50000, 25000, 15000, 8000, 5000, 2500, 1000, 500, 250]
+NZTM_LODS = [{"level": level, "scale": scale} for level, scale in enumerate(NZTM_SCALES)]
+
+
+def _ignoreLog(message):
+    pass
+
+
+class SnapScaleToLodsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = []
+        self.lods = mapUtils.prepareLods(NZTM_LODS, self.messages.append)
+
+    def _snap(self, scale, snapPolicy):
+        return mapUtils.snapScaleToLods(scale, self.lods, snapPolicy)
+
+    def testNextLarger(self):
+        self.assertEqual(self._snap(6000, "next-larger"), 8000)
+        self.assertEqual(self._snap(300, "next-larger"), 500)
+        self.assertEqual(self._snap(800000, "next-larger"), 1000000)
+
+    def testNextLargerOnALod(self):
+        # an LOD scale goes out to the next LOD, as the original loop did
+        self.assertEqual(self._snap(5000, "next-larger"), 8000)
+        self.assertEqual(self._snap(250, "next-larger"), 500)
+
+    def testNextLargerBeyondTheLods(self):
+        self.assertEqual(self._snap(100, "next-larger"), 250)
+        self.assertEqual(self._snap(1000000, "next-larger"), 1000000)
+        self.assertEqual(self._snap(5000000, "next-larger"), 1000000)
+
+    def testNextSmaller(self):
+        self.assertEqual(self._snap(6000, "next-smaller"), 5000)
+        self.assertEqual(self._snap(300, "next-smaller"), 250)
+        self.assertEqual(self._snap(800000, "next-smaller"), 760000)
+
+    def testNextSmallerOnALod(self):
+        self.assertEqual(self._snap(5000, "next-smaller"), 5000)
+        self.assertEqual(self._snap(250, "next-smaller"), 250)
+        self.assertEqual(self._snap(1000000, "next-smaller"), 1000000)
+
+    def testNextSmallerBeyondTheLods(self):
+        self.assertEqual(self._snap(100, "next-smaller"), 250)
+        self.assertEqual(self._snap(5000000, "next-smaller"), 1000000)
+
+    def testNearest(self):
+        self.assertEqual(self._snap(6000, "nearest"), 5000)
+        self.assertEqual(self._snap(7000, "nearest"), 8000)
+        self.assertEqual(self._snap(700000, "nearest"), 760000)
+        self.assertEqual(self._snap(21000, "nearest"), 25000)
+
+    def testNearestOnALod(self):
+        for scale in NZTM_SCALES:
+            self.assertEqual(self._snap(scale, "nearest"), scale)
+
+    def testNearestHalfwayGoesIn(self):
+        self.assertEqual(self._snap(6500, "nearest"), 5000)
+        self.assertEqual(self._snap(375, "nearest"), 250)
+
+    def testNearestBeyondTheLods(self):
+        self.assertEqual(self._snap(100, "nearest"), 250)
+        self.assertEqual(self._snap(5000000, "nearest"), 1000000)
+
+    def testUnknownPolicyIsNextLarger(self):
+        self.assertEqual(self._snap(6000, "closest"), 8000)
+
+    def testNoLods(self):
+        self.assertEqual(mapUtils.snapScaleToLods(6000, [], "nearest"), 6000)
+
+    def testLodsOfAnotherRequest(self):
+        # the sorted scales are kept per LOD list, a new list must not reuse them
+        self.assertEqual(self._snap(6000, "next-larger"), 8000)
+        otherLods = mapUtils.prepareLods([{"scale": 10000}, {"scale": 2000}], _ignoreLog)
+        self.assertEqual(mapUtils.snapScaleToLods(6000, otherLods, "next-larger"), 10000)
+        self.assertEqual(self._snap(6000, "next-larger"), 8000)
+
+
+class PrepareLodsTest(unittest.TestCase):
+
+    def testSortsByScale(self):
+        lods = mapUtils.prepareLods(NZTM_LODS, _ignoreLog)
+        self.assertEqual([lodObj["scale"] for lodObj in lods], sorted(NZTM_SCALES))
+        # the client list is left as it was
+        self.assertEqual([lodObj["scale"] for lodObj in NZTM_LODS], NZTM_SCALES)
+
+    def testScaleStrings(self):
+        lods = mapUtils.prepareLods([{"scale": "5000"}, {"scale": "250.5"}], _ignoreLog)
+        self.assertEqual([lodObj["scale"] for lodObj in lods], ["250.5", "5000"])
+        self.assertEqual(mapUtils.snapScaleToLods(300, lods, "next-larger"), 5000)
+
+    def testDropsInvalidScales(self):
+        messages = []
+        lods = mapUtils.prepareLods([{"scale": 5000}, {"scale": 0}, {"scale": -250}, {"scale": "x"},
+                                     {"scale": None}, {"level": 3}, None, {"scale": 1000}], messages.append)
+        self.assertEqual([lodObj["scale"] for lodObj in lods], [1000, 5000])
+        self.assertEqual(len(messages), 6)
+
+    def testNoLods(self):
+        self.assertEqual(mapUtils.prepareLods(None, _ignoreLog), [])
+        self.assertEqual(mapUtils.prepareLods([], _ignoreLog), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+# running functions in worker processes, see mapInProcessPool
+#
+import unittest
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+import extended_print_parallel_utils as parallelUtils
+
+
+def _square(value):
+    return value * value
+
+
+def _ignoreLog(message):
+    pass
+
+
+class MapInProcessPoolTest(unittest.TestCase):
+
+    def testResultsInArgsOrder(self):
+        self.assertEqual(parallelUtils.mapInProcessPool(_square, [1, 2, 3, 4], 2, _ignoreLog, 60), [1, 4, 9, 16])
+
+    def testResultFunctionCalledWithEachResult(self):
+        handledResults = []
+        results = parallelUtils.mapInProcessPool(_square, [1, 2, 3, 4], 2, _ignoreLog, 60, handledResults.append)
+        self.assertEqual(handledResults, [1, 4, 9, 16])
+        self.assertEqual(results, handledResults)
+
+    def testFailedResultFunctionIsRaised(self):
+        # results already handled can't be processed again serially
+        def failResult(result):
+            raise ValueError("result " + str(result))
+
+        self.assertRaises(ValueError, parallelUtils.mapInProcessPool, _square, [1, 2], 2, _ignoreLog, 60, failResult)
+
+
+if __name__ == "__main__":
+    unittest.main()
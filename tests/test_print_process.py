@@ -0,0 +1,72 @@
+# end to end prints through process() with the fake arcpy, see print_fixtures
+#
+import sys
+import unittest
+from os import listdir, path
+
+import print_fixtures
+from arcpy import mapping
+import extended_print_geoproc_service as service
+
+
+class _NullWriter(object):
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class PrintProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        mapping.setLatencies()
+        self.workspace = print_fixtures.createWorkspace(legendPdfCount = 1)
+        self.stdout = sys.stdout
+        sys.stdout = _NullWriter()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        print_fixtures.removeWorkspace(self.workspace)
+
+    def _print(self, layerCount, **printArgs):
+        finalFile = print_fixtures.runPrint(service, self.workspace, print_fixtures.makeWebmap(layerCount), **printArgs)
+        print_fixtures.deletePrintArtifacts(service, [finalFile])
+        return finalFile
+
+    def testSmallWebmapFitsOnTheMapPage(self):
+        finalFile = self._print(3)
+        # map page and the legend pdf of the template
+        self.assertEqual(mapping.countPdfPages(finalFile), 2)
+
+    def testLargeWebmapGetsALegendPage(self):
+        finalFile = self._print(200)
+        # map page, legend page and the legend pdf of the template
+        self.assertEqual(mapping.countPdfPages(finalFile), 3)
+
+    def testTemporaryFilesAreDeleted(self):
+        finalFile = self._print(50)
+        self.assertEqual(listdir(self.workspace["output"]), [path.basename(finalFile)])
+
+    def testPrintWithoutLegend(self):
+        finalFile = self._print(50, includeLegend = False)
+        # map page only, legend pdfs are only appended with a legend
+        self.assertEqual(mapping.countPdfPages(finalFile), 1)
+
+    def testExportWorkersCountTheirMapDocs(self):
+        # each page exported by a worker is saved by this process and opened again by the worker
+        mapDocIoCounts = service.fileUtils.mapDocIoCounts
+        service.fileUtils.resetMapDocIoCounts()
+        self._print(200)
+        serialCounts = dict(mapDocIoCounts)
+
+        service.settings.EXPORT_WORKER_PROCESSES = 2
+        service.fileUtils.resetMapDocIoCounts()
+        self._print(200)
+        # map page and legend page
+        self.assertEqual(mapDocIoCounts, {"opens": serialCounts["opens"] + 2, "saves": serialCounts["saves"] + 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# the template catalogue file the widget reads instead of a get layouts request, see writeTemplateCatalogueFile
+#
+import json
+import unittest
+from os import makedirs, path, remove
+
+import print_fixtures  # puts the service and the fake arcpy on sys.path
+import extended_print_geoproc_service as service
+
+
+class TemplateCatalogueFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = print_fixtures.createWorkspace()
+        service.configureModules()
+        # the template folders are checked for changes on every call
+        service.fileUtils.CATALOGUE_CHECK_SECONDS = 0
+        self.filePath = path.join(self.workspace["output"], "print_templates.json")
+
+    def tearDown(self):
+        print_fixtures.removeWorkspace(self.workspace)
+
+    def _write(self):
+        return service.fileUtils.writeTemplateCatalogueFile(self.workspace["templates"], self.filePath,
+                                                            service.noLegendMxdNameSuffix)
+
+    def _read(self):
+        catalogueFile = open(self.filePath)
+        try:
+            return json.load(catalogueFile)
+        finally:
+            catalogueFile.close()
+
+    def testTemplatesAndLayouts(self):
+        self.assertTrue(self._write())
+        # the no legend layout is only used by the service
+        self.assertEqual(self._read(), {"templates": [print_fixtures.TEMPLATE_NAME],
+                                        "layouts": {print_fixtures.TEMPLATE_NAME: [print_fixtures.LAYOUT_NAME]}})
+
+    def testWrittenAgainWhenDeleted(self):
+        self._write()
+        remove(self.filePath)
+        self.assertTrue(self._write())
+        self.assertTrue(path.exists(self.filePath))
+
+    def testOnlyWrittenWhenTheTemplatesChange(self):
+        self._write()
+        catalogueFile = open(self.filePath, "w")
+        catalogueFile.write("{}")
+        catalogueFile.close()
+        self._write()
+        self.assertEqual(self._read(), {})
+
+        # a new template folder changes the modified time of the templates root
+        makedirs(path.join(self.workspace["templates"], "Second", service.settings.TEMPLATE_LAYOUT_DIR_NAME))
+        self._write()
+        self.assertEqual(sorted(self._read()["templates"]), ["Second", print_fixtures.TEMPLATE_NAME])
+        self.assertEqual(self._read()["layouts"]["Second"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()